@@ -0,0 +1,223 @@
+"""
+Benchmark api endpoints against synthetic dataset.
+
+Seeds temporary database (users, courses, medias and enrollments), drives every
+endpoint through Flask test client and reports latency percentiles, SQL
+queries per request and response size. Results can be saved as baseline, later
+runs are compared to it and exit with error when an endpoint got slower (p95
+over tolerance) or makes more queries.
+
+Usage (from bench directory):
+    python bench_api.py [--scale small|medium|large] [--requests N]
+                        [--save-baseline] [--baseline FILE] [--tolerance 0.25]
+"""
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import shutil
+import argparse
+import tempfile
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+from app import create_app, db, seed_database, QueryCounter
+
+#users, courses, medias, enrollments per course
+SCALES = {
+    "small": (10000, 1000, 10000, 20),
+    "medium": (100000, 10000, 100000, 100),
+    "large": (1000000, 10000, 100000, 1000),
+}
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baseline_api.json")
+SEED = 2019
+
+
+def countdown(last):
+    """
+    Id function giving ids from last down, each row is deleted once
+    """
+    ids = itertools.count(last, -1)
+    return lambda rnd: next(ids)
+
+def endpoints(users, courses, medias):
+    """
+    (name, method, url function, json body function, options) for every api
+    endpoint, functions take random generator so each request hits different
+    rows. Options are request headers and max number of requests (whole
+    table exports). Deletes are last, rows they remove are not used after.
+    """
+    user = lambda rnd: rnd.randint(1, users)
+    course = lambda rnd: rnd.randint(1, courses)
+    media = lambda rnd: rnd.randint(1, medias)
+    key = lambda rnd: "bench-{}".format(rnd.getrandbits(64))
+    deleted_user = countdown(users)
+    deleted_course = countdown(courses)
+    deleted_media = countdown(medias)
+    ndjson = {"headers": {"Accept": "application/x-ndjson"}, "requests": 10}
+    return [
+        ("users", "GET", lambda rnd: "/api/users/", None),
+        ("users-page", "GET", lambda rnd: "/api/users/?after={}".format(user(rnd)), None),
+        ("user", "GET", lambda rnd: "/api/users/{}/".format(user(rnd)), None),
+        ("user-courses", "GET", lambda rnd: "/api/users/{}/courses/".format(user(rnd)), None),
+        ("courses", "GET", lambda rnd: "/api/trainingcourses/", None),
+        ("courses-page", "GET", lambda rnd: "/api/trainingcourses/?after={}".format(course(rnd)), None),
+        ("course", "GET", lambda rnd: "/api/trainingcourses/{}/".format(course(rnd)), None),
+        ("course-content", "GET", lambda rnd: "/api/trainingcourses/{}/content/".format(course(rnd)), None),
+        ("course-stats", "GET", lambda rnd: "/api/trainingcourses/{}/stats/".format(course(rnd)), None),
+        ("course-medias", "GET", lambda rnd: "/api/trainingcourses/{}/medias/".format(course(rnd)), None),
+        ("course-users", "GET", lambda rnd: "/api/trainingcourses/{}/users/".format(course(rnd)), None),
+        ("media", "GET", lambda rnd: "/api/coursemedia/{}/".format(media(rnd)), None),
+        ("export-users", "GET", lambda rnd: "/api/export/users/", None, ndjson),
+        ("export-courses", "GET", lambda rnd: "/api/export/trainingcourses/", None, ndjson),
+        ("export-enrollments", "GET", lambda rnd: "/api/export/enrollments/", None, ndjson),
+        ("add-user", "POST", lambda rnd: "/api/users/",
+            lambda rnd: {"firstname": "bench", "lastname": "user", "isAdmin": False}),
+        ("edit-user", "PUT", lambda rnd: "/api/users/{}/".format(user(rnd)),
+            lambda rnd: {"firstname": "bench", "lastname": "edited", "email": "bench@example.com"}),
+        ("import-users", "POST", lambda rnd: "/api/users/import/",
+            lambda rnd: [{"firstname": "bench", "lastname": "import", "isAdmin": False} for i in range(100)]),
+        ("edit-course", "PUT", lambda rnd: "/api/trainingcourses/{}/".format(course(rnd)),
+            lambda rnd: {"name": key(rnd)}),
+        ("edit-media", "PUT", lambda rnd: "/api/coursemedia/{}/".format(media(rnd)),
+            lambda rnd: {"url": "https://example.com/bench/edited", "type": "video"}),
+        ("add-course-medias", "POST", lambda rnd: "/api/trainingcourses/{}/medias/".format(course(rnd)),
+            lambda rnd: [{"url": "https://example.com/bench/{}".format(i), "type": "image"} for i in range(10)]),
+        ("add-course-users", "POST", lambda rnd: "/api/trainingcourses/{}/users/".format(course(rnd)),
+            lambda rnd: [{"userid": user(rnd)} for i in range(10)]),
+        ("batch-create", "POST", lambda rnd: "/api/batch/", lambda rnd: {"operations": [
+            {"id": "user", "method": "POST", "path": "/api/users/",
+                "body": {"firstname": "bench", "lastname": "batch", "isAdmin": False}},
+            {"id": "course", "method": "POST", "path": "/api/trainingcourses/",
+                "body": {"name": "bench-batch-{}".format(rnd.getrandbits(64)), "coursedatajson": "{}"}},
+            {"method": "POST", "path": "/api/trainingcourses/${course.id}/medias/",
+                "body": [{"url": "https://example.com/bench/{}".format(i), "type": "image"} for i in range(3)]},
+            {"method": "POST", "path": "/api/trainingcourses/${course.id}/users/",
+                "body": {"userid": "${user.id}"}},
+        ]}),
+        ("add-completions", "POST", lambda rnd: "/api/completions/",
+            lambda rnd: [{"idempotencyKey": key(rnd), "courseid": course(rnd), "userid": user(rnd),
+                "score": rnd.randint(0, 100), "completed": True} for i in range(10)]),
+        #change log has entries of writes above
+        ("changes", "GET", lambda rnd: "/api/changes/?since=0", None),
+        ("delete-media", "DELETE", lambda rnd: "/api/coursemedia/{}/".format(deleted_media(rnd)), None),
+        ("delete-course", "DELETE", lambda rnd: "/api/trainingcourses/{}/".format(deleted_course(rnd)), None),
+        ("delete-user", "DELETE", lambda rnd: "/api/users/{}/".format(deleted_user(rnd)), None),
+    ]
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    index = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+def measure(client, endpoint, requests, rnd):
+    name, method, url, body = endpoint[:4]
+    options = endpoint[4] if len(endpoint) > 4 else {}
+    requests = min(requests, options.get("requests", requests))
+    latencies = []
+    queries = 0
+    size = 0
+    for i in range(requests):
+        kwargs = {"json": body(rnd)} if body else {}
+        target = url(rnd)
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            resp = client.open(target, method=method, headers=options.get("headers"), **kwargs)
+            data = resp.get_data()
+            latencies.append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            raise RuntimeError("{} {} returned {}".format(method, target, resp.status_code))
+        queries += counter.count
+        size += len(data)
+    latencies.sort()
+    return {
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "queries": queries / requests,
+        "bytes": size / requests,
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions of results against baseline results of same scale
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["p95"] > previous["p95"] * (1 + tolerance):
+            regressions.append("{}: p95 {:.2f} ms, baseline {:.2f} ms".format(
+                name, result["p95"], previous["p95"]))
+        if result["queries"] > previous["queries"]:
+            regressions.append("{}: {:.1f} queries per request, baseline {:.1f}".format(
+                name, result["queries"], previous["queries"]))
+    return regressions
+
+def run(scale, requests, baseline_file, save_baseline, tolerance):
+    users, courses, medias, enrollments = SCALES[scale]
+    tmpdir = tempfile.mkdtemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(tmpdir, "bench.db"),
+        "STORAGE_PROFILE": "production",
+        #measure handlers, not cache hits
+        "RESPONSE_CACHE_ENABLED": False,
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            with db.get_engine().begin() as conn:
+                counts = seed_database(conn, users, courses, medias, enrollments, seed=SEED)
+            print("scale {}: {users} users, {courses} courses, {medias} medias, {enrollments} enrollments, "
+                "seeded in {seconds:.1f} s".format(scale, seconds=time.perf_counter() - start, **counts))
+        client = app.test_client()
+        rnd = random.Random(SEED)
+        results = {}
+        print("{:20} {:>9} {:>9} {:>9} {:>8} {:>10}".format(
+            "endpoint", "p50 ms", "p95 ms", "p99 ms", "queries", "bytes"))
+        for endpoint in endpoints(users, courses, medias):
+            #warm up connection pool and statement caches
+            measure(client, endpoint, 5, rnd)
+            result = measure(client, endpoint, requests, rnd)
+            results[endpoint[0]] = result
+            print("{:20} {p50:9.2f} {p95:9.2f} {p99:9.2f} {queries:8.1f} {bytes:10.0f}".format(
+                endpoint[0], **result))
+        with app.app_context():
+            db.session.remove()
+            db.get_engine().dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    baselines = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as handle:
+            baselines = json.load(handle)
+    if save_baseline:
+        baselines[scale] = results
+        with open(baseline_file, "w") as handle:
+            json.dump(baselines, handle, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(baseline_file))
+        return 0
+    if scale not in baselines:
+        print("no baseline for scale {}, run with --save-baseline".format(scale))
+        return 0
+    regressions = compare(results, baselines[scale], tolerance)
+    for line in regressions:
+        print("REGRESSION " + line)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark api endpoints")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline json file")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 growth, 0.25 = 25%%")
+    args = parser.parse_args()
+    sys.exit(run(args.scale, args.requests, args.baseline, args.save_baseline, args.tolerance))
@@ -0,0 +1,49 @@
+"""
+Benchmark cold import of app module and app creation, as done by each new worker.
+Exits with error if median is over budget.
+
+Usage (from bench directory): python bench_import.py [budget_ms] [runs]
+"""
+import os
+import sys
+import subprocess
+import statistics
+
+SRC_DIR = os.path.dirname(os.path.realpath(__file__)) + "/../src"
+
+#measured in fresh interpreter, database connections are not allowed
+MEASURE = """
+import sqlite3, time
+def no_connect(*args, **kwargs):
+    raise RuntimeError("database opened during import")
+sqlite3.connect = no_connect
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(imported - start, created - imported)
+"""
+
+def measure(runs):
+    imports = []
+    creates = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", MEASURE], cwd=SRC_DIR)
+        import_time, create_time = [float(value) for value in output.split()]
+        imports.append(import_time * 1000)
+        creates.append(create_time * 1000)
+    return statistics.median(imports), statistics.median(creates)
+
+def run(budget_ms=1000, runs=5):
+    import_ms, create_ms = measure(runs)
+    print("import app    {:8.1f} ms".format(import_ms))
+    print("create_app()  {:8.1f} ms".format(create_ms))
+    total = import_ms + create_ms
+    print("total         {:8.1f} ms (budget {} ms)".format(total, budget_ms))
+    return total <= budget_ms
+
+if __name__ == "__main__":
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    sys.exit(0 if run(budget, runs) else 1)
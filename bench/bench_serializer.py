@@ -0,0 +1,42 @@
+"""
+Benchmark response serialization: previous json.dumps path against serializer.dumps.
+
+Usage (from bench directory): python bench_serializer.py [rows]
+"""
+import os
+import sys
+import json
+import timeit
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import serializer
+
+def build_body(rows):
+    """Body shaped like /api/trainingcourses/ response"""
+    items = []
+    for i in range(rows):
+        items.append({
+            "id": i,
+            "name": "course-{}".format(i),
+            "creationdate": datetime(2019, 8, 19, 17, 58, 28),
+            "startdate": datetime(2019, 9, 1),
+            "enddate": None,
+            "@controls": {"self": {"href": "/api/trainingcourses/{}/".format(i)}},
+        })
+    return {"@controls": {"self": {"href": "/api/trainingcourses/"}}, "items": items}
+
+def old_dumps(body):
+    #previous path, stdlib with isoformat for datetimes
+    return json.dumps(body, default=lambda value: value.isoformat())
+
+def run(rows=10000, repeat=5):
+    body = build_body(rows)
+    results = [("json.dumps", old_dumps), ("serializer.dumps", serializer.dumps)]
+    print("{} rows, encoder: {}".format(rows, "orjson" if serializer.orjson else "stdlib json"))
+    for name, func in results:
+        best = min(timeit.repeat(lambda: func(body), number=1, repeat=repeat))
+        print("{:20} {:8.2f} ms".format(name, best * 1000))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,19 +1,98 @@
-import json
-from flask import Flask, request, Response, abort
-from flask_sqlalchemy import SQLAlchemy
+import re
+import io
+import csv
+import hashlib
+import functools
+import weakref
+import time
+from urllib.parse import urlencode
+from datetime import datetime, timezone, timedelta
+import click
+from flask import Flask, request, Response, abort, stream_with_context, g, has_request_context, has_app_context, current_app
+from flask.cli import with_appcontext
 from flask_restful import Resource
 from flask_restful import Api
 
-from sqlalchemy import event
+from sqlalchemy import event, func, and_, bindparam, exists, inspect, text, select, tuple_, DDL
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload, raiseload, load_only
 from sqlalchemy.exc import IntegrityError, StatementError
-
-app = Flask(__name__, static_folder="static")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///../db/database.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
-api = Api(app)
+from werkzeug.exceptions import HTTPException
+
+import serializer
+from serializer import USER_FIELDS, COURSE_FIELDS, MEDIA_FIELDS, ENROLLMENT_FIELDS
+from cache import ResponseCache
+from storage import ProfiledSQLAlchemy
+import migrate
+import seed
+import profiling
+import metrics
+import ingest
+import eventhub
+
+#default configuration, create_app(config) overrides these
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///../db/database.db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    #sqlite pragmas and connection pool, see storage.STORAGE_PROFILES
+    "STORAGE_PROFILE": "production",
+    #collection paging, max page size is enforced even if client asks more
+    "PAGE_SIZE_DEFAULT": 100,
+    "PAGE_SIZE_MAX": 500,
+    #rows fetched from database at a time when streaming exports
+    "EXPORT_BATCH_SIZE": 1000,
+    #add X-Query-Count header (sql statements executed by request) to responses
+    "QUERY_COUNT_HEADER": False,
+    #in-process cache of course GET responses, invalidated by writes
+    "RESPONSE_CACHE_ENABLED": True,
+    "RESPONSE_CACHE_SIZE": 1000,
+    "RESPONSE_CACHE_TTL": 60,
+    #bulk user import, rows are inserted and committed in chunks
+    "IMPORT_CHUNK_SIZE": 5000,
+    "IMPORT_MAX_ROWS": 100000,
+    #user ids looked up at a time when enrolling (sqlite limits number of query parameters)
+    "ENROLL_CHUNK_SIZE": 500,
+    #Server-Timing header with sql, body construction and serialization times
+    "PROFILING_ENABLED": False,
+    #with profiling enabled, cProfile stats of slowest requests are kept in this directory
+    "PROFILE_DIR": None,
+    "PROFILE_SLOWEST": 10,
+    #request, sql and cache metrics at /trainingmanager/metrics
+    "METRICS_ENABLED": True,
+    #completion events are queued and written in groups of COMPLETION_BATCH_SIZE events or
+    #after COMPLETION_FLUSH_MS, full queue is answered with 429
+    "COMPLETION_QUEUE_SIZE": 10000,
+    "COMPLETION_BATCH_SIZE": 500,
+    "COMPLETION_FLUSH_MS": 50,
+    "COMPLETION_RETRY_AFTER": 1,
+    "COMPLETION_KEY_TTL": 86400,
+    #operations in one batch request
+    "BATCH_MAX_OPERATIONS": 100,
+    #change log entries older than CHANGELOG_RETENTION seconds are removed, at most once in
+    #CHANGELOG_COMPACT_INTERVAL seconds after a write request
+    "CHANGELOG_RETENTION": 7 * 86400,
+    "CHANGELOG_COMPACT_INTERVAL": 3600,
+    #change events at /api/events/: events kept for reconnecting clients, seconds between change log
+    #reads (changes of other worker processes), seconds between keepalive comments, entries per read
+    "EVENTS_BUFFER_SIZE": 1000,
+    "EVENTS_POLL_INTERVAL": 1.0,
+    "EVENTS_HEARTBEAT": 15,
+    "EVENTS_READ_LIMIT": 500,
+    #open event streams per process (None is no limit), more get 503. Stream holds a request
+    #thread of threaded server, gunicorn.conf.py sets this below threads of gthread worker
+    "EVENTS_MAX_STREAMS": None,
+    "EVENTS_RETRY_AFTER": 30,
+}
+
+#extensions are bound to app in create_app, engine is created on first use
+db = ProfiledSQLAlchemy()
+api = Api()
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
 LINK_RELATIONS_URL = "/trainingmanager/link-relations/"
+#query arguments of collection request repeated in next/prev hrefs
+PAGE_KEPT_ARGS = ("fields", "controls")
 
 
 #Course and user relation. this also holds information when user completed the training (now implemented in client or api yet)
@@ -23,8 +102,167 @@ courseuserrelation = db.Table("courseuserrelation",
     db.Column("addedtocourse", db.DateTime),
     db.Column("canModify", db.Boolean),
     db.Column("courseCompletionScore", db.Integer),
-    db.Column("courseCompletionDate", db.DateTime)
+    db.Column("courseCompletionDate", db.DateTime),
+    db.Index("ix_courseuserrelation_courseid_userid", "courseid", "userid", unique=True),
+    db.Index("ix_courseuserrelation_userid_courseid", "userid", "courseid")
+)
+
+#per course aggregates of enrollments, kept up to date by triggers on courseuserrelation
+coursestats = db.Table("coursestats",
+    db.Column("courseid", db.Integer, db.ForeignKey("TrainingCourse.id", ondelete="CASCADE"), primary_key=True),
+    db.Column("enrolled", db.Integer, nullable=False, default=0),
+    db.Column("completed", db.Integer, nullable=False, default=0),
+    db.Column("scored", db.Integer, nullable=False, default=0),
+    db.Column("score_sum", db.Integer, nullable=False, default=0)
+)
+#number of enrollments with each completion score, for score percentiles
+coursescorehistogram = db.Table("coursescorehistogram",
+    db.Column("courseid", db.Integer, db.ForeignKey("TrainingCourse.id", ondelete="CASCADE"), primary_key=True),
+    db.Column("score", db.Integer, primary_key=True),
+    db.Column("count", db.Integer, nullable=False)
+)
+#idempotency keys of written completion events, kept for COMPLETION_KEY_TTL seconds
+completionkey = db.Table("completionkey",
+    db.Column("key", db.String(100), primary_key=True),
+    db.Column("received", db.DateTime, nullable=False, index=True)
 )
+#inserts, updates and deletes of users, courses, medias and enrollments, written by triggers.
+#id is change token, autoincrement keeps tokens growing when old entries are compacted
+changelog = db.Table("changelog",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("entity", db.String(20), nullable=False),
+    db.Column("operation", db.String(10), nullable=False),
+    db.Column("itemid", db.Integer),
+    db.Column("parentid", db.Integer),
+    db.Column("changed_at", db.DateTime, nullable=False, server_default=func.current_timestamp(), index=True),
+    sqlite_autoincrement=True
+)
+
+def stats_add_sql(row):
+    return """
+    INSERT INTO coursestats (courseid, enrolled, completed, scored, score_sum)
+    SELECT {0}.courseid, 1, {0}."courseCompletionDate" IS NOT NULL, {0}."courseCompletionScore" IS NOT NULL,
+        COALESCE({0}."courseCompletionScore", 0)
+    WHERE {0}.courseid IS NOT NULL
+    ON CONFLICT (courseid) DO UPDATE SET enrolled = enrolled + 1, completed = completed + excluded.completed,
+        scored = scored + excluded.scored, score_sum = score_sum + excluded.score_sum;
+    INSERT INTO coursescorehistogram (courseid, score, count)
+    SELECT {0}.courseid, {0}."courseCompletionScore", 1
+    WHERE {0}.courseid IS NOT NULL AND {0}."courseCompletionScore" IS NOT NULL
+    ON CONFLICT (courseid, score) DO UPDATE SET count = count + 1;
+    """.format(row)
+
+def stats_remove_sql(row):
+    return """
+    UPDATE coursestats SET enrolled = enrolled - 1, completed = completed - ({0}."courseCompletionDate" IS NOT NULL),
+        scored = scored - ({0}."courseCompletionScore" IS NOT NULL),
+        score_sum = score_sum - COALESCE({0}."courseCompletionScore", 0)
+    WHERE courseid = {0}.courseid;
+    UPDATE coursescorehistogram SET count = count - 1
+    WHERE courseid = {0}.courseid AND score = {0}."courseCompletionScore";
+    DELETE FROM coursescorehistogram
+    WHERE courseid = {0}.courseid AND score = {0}."courseCompletionScore" AND count <= 0;
+    """.format(row)
+
+COURSE_STATS_TRIGGERS = {
+    "coursestats_insert": "AFTER INSERT ON courseuserrelation BEGIN {} END".format(stats_add_sql("NEW")),
+    "coursestats_delete": "AFTER DELETE ON courseuserrelation BEGIN {} END".format(stats_remove_sql("OLD")),
+    #canModify changes do not touch stats
+    "coursestats_update": 'AFTER UPDATE OF courseid, "courseCompletionScore", "courseCompletionDate" '
+        "ON courseuserrelation BEGIN {} {} END".format(stats_remove_sql("OLD"), stats_add_sql("NEW")),
+}
+
+#tracked table -> (entity name, item id column, parent id column)
+CHANGELOG_ENTITIES = {
+    "User": ("user", "id", None),
+    "TrainingCourse": ("course", "id", None),
+    "CourseMedia": ("media", "id", "course_id"),
+    "courseuserrelation": ("enrollment", "userid", "courseid"),
+}
+
+def changelog_sql(table, operation, row, condition=None):
+    entity, item, parent = CHANGELOG_ENTITIES[table]
+    return """
+    INSERT INTO changelog (entity, operation, itemid, parentid)
+    SELECT '{0}', {1}, {2}.{3}, {4}{5};
+    """.format(entity, operation, row, item, "{}.{}".format(row, parent) if parent else "NULL",
+        " WHERE " + condition if condition else "")
+
+def changelog_triggers():
+    triggers = {}
+    for table, (entity, item, parent) in CHANGELOG_ENTITIES.items():
+        triggers["changelog_{}_insert".format(entity)] = 'AFTER INSERT ON "{}" BEGIN {} END'.format(
+            table, changelog_sql(table, "'insert'", "NEW"))
+        triggers["changelog_{}_delete".format(entity)] = 'AFTER DELETE ON "{}" BEGIN {} END'.format(
+            table, changelog_sql(table, "'delete'", "OLD"))
+        if parent is None:
+            update = changelog_sql(table, "'update'", "NEW")
+        else:
+            #item moved to other parent is deleted from old and inserted to new parent
+            moved = "OLD.{0} IS NOT NEW.{0}".format(parent)
+            update = changelog_sql(table, "'delete'", "OLD", moved) + changelog_sql(table,
+                "CASE WHEN {} THEN 'insert' ELSE 'update' END".format(moved), "NEW")
+        triggers["changelog_{}_update".format(entity)] = 'AFTER UPDATE ON "{}" BEGIN {} END'.format(
+            table, update)
+    return triggers
+
+CHANGELOG_TRIGGERS = changelog_triggers()
+
+def create_trigger_sql(name):
+    body = COURSE_STATS_TRIGGERS.get(name) or CHANGELOG_TRIGGERS[name]
+    return "CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body)
+
+def table_exists(name):
+    def check(ddl, target, bind, **kwargs):
+        return inspect(bind).has_table(name)
+    return check
+
+for name in COURSE_STATS_TRIGGERS:
+    #created with whichever of the tables is created last
+    event.listen(courseuserrelation, "after_create", DDL(create_trigger_sql(name)))
+    event.listen(coursestats, "after_create",
+        DDL(create_trigger_sql(name)).execute_if(callable_=table_exists("courseuserrelation")))
+
+def rebuild_course_stats(conn):
+    """
+    Recompute course stats from enrollments, returns number of courses with stats
+    """
+    relation = courseuserrelation
+    conn.execute(coursestats.delete())
+    conn.execute(coursescorehistogram.delete())
+    conn.execute(coursestats.insert().from_select(
+        ["courseid", "enrolled", "completed", "scored", "score_sum"],
+        select(relation.c.courseid, func.count(), func.count(relation.c.courseCompletionDate),
+            func.count(relation.c.courseCompletionScore),
+            func.coalesce(func.sum(relation.c.courseCompletionScore), 0)
+        ).where(relation.c.courseid.isnot(None)).group_by(relation.c.courseid)
+    ))
+    conn.execute(coursescorehistogram.insert().from_select(
+        ["courseid", "score", "count"],
+        select(relation.c.courseid, relation.c.courseCompletionScore, func.count()).where(and_(
+            relation.c.courseid.isnot(None), relation.c.courseCompletionScore.isnot(None)
+        )).group_by(relation.c.courseid, relation.c.courseCompletionScore)
+    ))
+    return conn.execute(select(func.count()).select_from(coursestats)).scalar()
+
+def seed_database(conn, *args, **kwargs):
+    """
+    seed.seed_database with triggers off, stats are recomputed once after the
+    rows are in (same transaction). Seeded rows are not in change log.
+    """
+    #pysqlite begins transaction only before DML, each DROP TRIGGER would be
+    #committed alone and failed seed would leave triggers dropped. Write lock
+    #also keeps writes of other connections from running without triggers.
+    if not conn.connection.in_transaction:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    triggers = list(COURSE_STATS_TRIGGERS) + list(CHANGELOG_TRIGGERS)
+    for name in triggers:
+        conn.exec_driver_sql("DROP TRIGGER IF EXISTS " + name)
+    counts = seed.seed_database(conn, db.metadata, *args, **kwargs)
+    rebuild_course_stats(conn)
+    for name in triggers:
+        conn.exec_driver_sql(create_trigger_sql(name))
+    return counts
 
 class MasonBuilder(dict):
     """
@@ -49,6 +287,36 @@ class MasonBuilder(dict):
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
 
+    def add_control_template(self, ctrl_name, template_name, value=None):
+        """
+        Add control stamped from precompiled template in CONTROL_TEMPLATES
+        """
+        if "@controls" not in self:
+            self["@controls"] = {}
+        self["@controls"][ctrl_name] = CONTROL_TEMPLATES[template_name].stamp(value)
+
+    def add_page_controls(self, href, page):
+        """
+        Add next/prev controls for keyset paged collection, fields and controls
+        arguments of request are kept in their hrefs
+        """
+        kept = [(name, request.args[name]) for name in PAGE_KEPT_ARGS if name in request.args]
+        if page.has_next:
+            self.add_control("next", "{}?{}".format(href, urlencode(
+                [("after", page.last_id), ("limit", page.limit)] + kept, safe=",")
+            ))
+        if page.has_prev:
+            self.add_control("prev", "{}?{}".format(href, urlencode(
+                [("before", page.first_id), ("limit", page.limit)] + kept, safe=",")
+            ))
+
+def encode_body(body):
+    """
+    Serialize response body, timed when request is profiled
+    """
+    with profiling.timed_serialize():
+        return serializer.dumps(body)
+
 def create_error_response(status_code, title, message=None):
     """
     Class from course examples.
@@ -56,88 +324,321 @@ def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return Response(encode_body(body), status_code, mimetype=MASON)
+
+class KeysetPage(object):
+    """
+    One page of collection rows, paged by id (keyset pagination).
+    Query parameters: ?limit= page size, ?after= id of last row in previous page,
+    ?before= id of first row in next page (used by prev control)
+    """
+    def __init__(self, query, id_column):
+        self.limit = self._get_int_arg("limit", current_app.config["PAGE_SIZE_DEFAULT"])
+        if self.limit < 1:
+            raise ValueError("limit must be positive")
+        self.limit = min(self.limit, current_app.config["PAGE_SIZE_MAX"])
+        after = self._get_int_arg("after", None)
+        before = self._get_int_arg("before", None)
+        if after is not None and before is not None:
+            raise ValueError("after and before can not be used together")
+
+        if before is not None:
+            #read backwards from before, one extra row tells if there is previous page
+            rows = query.filter(id_column < before).order_by(id_column.desc()).limit(self.limit + 1).all()
+            self.has_prev = len(rows) > self.limit
+            #before may be past last row
+            self.has_next = query.session.query(query.filter(id_column >= before).exists()).scalar()
+            self.items = rows[:self.limit][::-1]
+        else:
+            if after is not None:
+                query = query.filter(id_column > after)
+            rows = query.order_by(id_column).limit(self.limit + 1).all()
+            self.has_next = len(rows) > self.limit
+            self.has_prev = after is not None
+            self.items = rows[:self.limit]
+
+        if not self.items:
+            self.has_next = self.has_prev = False
+            self.first_id = self.last_id = None
+        else:
+            self.first_id = self.items[0].id
+            self.last_id = self.items[-1].id
+
+    @staticmethod
+    def _get_int_arg(name, default):
+        value = request.args.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError("{} must be integer".format(name))
+
+def read_fieldset(allowed, default=None):
+    """
+    Field names asked with ?fields=a,b (sparse fieldset), default (or all
+    allowed) fields when not given. Raises ValueError for unknown fields.
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return allowed if default is None else default
+    names = tuple(name.strip() for name in value.split(",") if name.strip())
+    unknown = [name for name in names if name not in allowed]
+    if unknown or not names:
+        raise ValueError("Unknown fields: {}. Allowed fields: {}".format(
+            ", ".join(unknown), ", ".join(allowed)))
+    return names
+
+def load_fields(model, names, *always):
+    """
+    load_only option for model columns of fieldset, id and always columns are loaded anyway
+    """
+    columns = [model.id] + [getattr(model, name) for name in always]
+    columns += [getattr(model, name) for name in names if name not in ("id",) + always]
+    return load_only(*columns)
+
+def wants_controls():
+    """
+    False if client asked ?controls=false, bulk consumers skip hypermedia
+    """
+    return request.args.get("controls", "true").lower() not in ("false", "0", "no")
+
+def strip_controls(body):
+    """
+    Remove controls except next/prev, bulk consumers need them to read all pages
+    """
+    controls = body.pop("@controls", {})
+    body.pop("@namespaces", None)
+    paging = dict((name, controls[name]) for name in ("next", "prev") if name in controls)
+    if paging:
+        body["@controls"] = paging
+    return body
+
+class ControlTemplate(object):
+    """
+    Mason control whose href is resolved once from the resource route. Per item
+    controls are stamped from the template with string substitution, which is
+    much cheaper than api.url_for in collection loops. Resolved href is kept
+    per app and script root (prefix the app is mounted under).
+    """
+    PLACEHOLDER = "__control_template_param__"
+    #values which url_for would not quote, others fall back to url_for
+    SAFE_VALUE = re.compile(r"^[A-Za-z0-9_.~-]+$")
+
+    def __init__(self, resource, param=None, **kwargs):
+        self.resource = resource
+        self.param = param
+        self.kwargs = kwargs
+        self._parts = weakref.WeakKeyDictionary()
+
+    def _resolve(self):
+        if self.param is None:
+            return (api.url_for(self.resource), "")
+        href = api.url_for(self.resource, **{self.param: self.PLACEHOLDER})
+        return tuple(href.split(self.PLACEHOLDER, 1))
+
+    def href(self, value=None):
+        parts = self._parts.setdefault(current_app._get_current_object(), {})
+        script_root = request.script_root if has_request_context() else None
+        if script_root not in parts:
+            parts[script_root] = self._resolve()
+        prefix, suffix = parts[script_root]
+        if self.param is None:
+            return prefix
+        value = str(value)
+        if not self.SAFE_VALUE.match(value):
+            return api.url_for(self.resource, **{self.param: value})
+        return prefix + value + suffix
+
+    def stamp(self, value=None):
+        control = dict(self.kwargs)
+        control["href"] = self.href(value)
+        return control
 
 #Mason json helper classes, based on course examples
 class UserBuilder(MasonBuilder):
         def add_control_add_user(self):
-            self.add_control(                
-                "trainingmanager:add-user",
-                api.url_for(UserCollection),
-                method="POST",
-                encoding="json",
-                title="Add new user"
-            )
+            self.add_control_template("trainingmanager:add-user", "add-user")
+        def add_control_import_users(self):
+            self.add_control_template("trainingmanager:import-users", "import-users")
         def add_control_delete_user(self,id):
-            self.add_control(
-                "trainingmanager:delete-user",
-                api.url_for(UserItem, id=id),
-                method="DELETE",
-                title="Delete this user"
-            )
+            self.add_control_template("trainingmanager:delete-user", "delete-user", id)
         def add_control_modify_user(self,id):
-            self.add_control(
-                "edit",
-                api.url_for(UserItem, id=id),
-                method="PUT",
-                encoding="json",
-                title="Edit this user"    
-            )
+            self.add_control_template("edit", "edit-user", id)
 
 class MediaBuilder(MasonBuilder):
-        def add_control_add_media(self):
-            self.add_control(                
-                "trainingmanager:add-media",
-                api.url_for(CourseMediaCollection),
-                method="POST",
-                encoding="json",
-                title="Add new media"
-            )
+        def add_control_add_media(self, course):
+            self.add_control_template("trainingmanager:add-media", "add-media", course)
 
 class TrainingCourseBuilder(MasonBuilder):
         def add_control_delete_course(self, course):
-            self.add_control(
-                "trainingmanager:delete-course",
-                api.url_for(TrainingCourseItem, course=course),
-                method="DELETE",
-                title="Delete this course"
-            )
+            self.add_control_template("trainingmanager:delete-course", "delete-course", course)
 
         def add_control_add_course(self):
-            self.add_control(
-                "trainingmanager:add-course",
-                api.url_for(TrainingCourseCollection),
-                method="POST",
-                encoding="json",
-                title="Add new course"
-            )
+            self.add_control_template("trainingmanager:add-course", "add-course")
 
         def add_control_modify_course(self, course):
-            self.add_control(
-                "edit",
-                api.url_for(TrainingCourseItem, course=course),
-                method="PUT",
-                encoding="json",
-                title="Edit this course"          
-            )
+            self.add_control_template("edit", "edit-course", course)
 
         def add_control_add_media(self, course):
-            self.add_control(
-                "addmedia",
-                api.url_for(CourseMediaCollection, course=course),
-                method="POST",
-                encoding="json",
-                title="Add media to course"
-                )
+            self.add_control_template("addmedia", "add-course-media", course)
+
         def add_control_add_user_to_course(self, course):
-            self.add_control(
-                "addcourseuser",
-                api.url_for(TrainingCourseItem, course=course),
-                method="POST",
-                encoding="json",
-                title="Add user to course"
-                )
+            self.add_control_template("addcourseuser", "add-course-user", course)
+
+
+class ItemVersion(object):
+    """
+    Strong ETag and Last-Modified of item resource. Both are computed from row
+    updated_at, so conditional requests are answered before body is built.
+    """
+    def __init__(self, updated_at):
+        self.last_modified = updated_at
+        version = "{}|{}".format(request.full_path, updated_at.isoformat() if updated_at else "")
+        self.etag = hashlib.sha1(version.encode("utf-8")).hexdigest()
+
+    def is_not_modified(self):
+        if request.if_none_match:
+            return request.if_none_match.contains(self.etag)
+        since = request.if_modified_since
+        if since is None or self.last_modified is None:
+            return False
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        #http dates have one second resolution
+        return self.last_modified.replace(microsecond=0) <= since
+
+    def add_headers(self, response):
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified.replace(tzinfo=timezone.utc)
+        return response
+
+    def create_not_modified_response(self):
+        return self.add_headers(Response(status=304))
+
+def cached_get(method):
+    """
+    Serve GET from response cache. Handler tags the response with add_cache_tags,
+    write handlers drop tagged responses with invalidate_cache after commit.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        #batch operations may see uncommitted rows of their batch
+        if not current_app.config["RESPONSE_CACHE_ENABLED"] or wants_export() or in_batch():
+            return method(*args, **kwargs)
+        key = request.full_path
+        response_cache = get_response_cache()
+        entry = response_cache.get(key)
+        if entry is not None:
+            response = Response(entry.data, entry.status, headers=entry.headers)
+            return response.make_conditional(request)
+
+        #read before handler reads rows, writes committed after it make the response stale
+        generation = response_cache.generation()
+        g.cache_tags = set()
+        response = method(*args, **kwargs)
+        if response.status_code == 200 and not response.is_streamed:
+            response_cache.set(key, response.status_code, list(response.headers),
+                response.get_data(), g.cache_tags, generation)
+        return response
+    return wrapper
+
+def add_cache_tags(*tags):
+    if "cache_tags" in g:
+        g.cache_tags.update(tags)
+
+def get_response_cache():
+    return current_app.extensions["response_cache"]
+
+def in_batch():
+    """
+    True when request is operation of batch, see BatchTransaction
+    """
+    return "batch_invalidated" in g
+
+def invalidate_cache(*tags):
+    if in_batch():
+        g.batch_invalidated.update(tags)
+        return
+    get_response_cache().invalidate(*tags)
+
+def course_tag(course):
+    return "course:{}".format(course)
 
+def touch_course(course_id):
+    """
+    Medias are part of course representation, so media changes give course new version
+    """
+    TrainingCourse.query.filter_by(id=course_id).update(
+        {"updated_at": datetime.utcnow()}, synchronize_session=False
+    )
+
+class QueryCounter(object):
+    """
+    Counts SQL statements executed while counter is active, for example in tests:
+        with QueryCounter() as counter:
+            client.get(url)
+        assert counter.count <= 2
+    """
+    active = []
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        QueryCounter.active.append(self)
+        return self
+
+    def __exit__(self, *args):
+        QueryCounter.active.remove(self)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    for counter in QueryCounter.active:
+        counter.count += 1
+        counter.statements.append(statement)
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+    if has_app_context() and "metrics" in current_app.extensions:
+        current_app.extensions["metrics"].observe_statement(statement)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def profile_query_start(conn, cursor, statement, parameters, context, executemany):
+    profiling.query_started(conn)
+
+@event.listens_for(Engine, "after_cursor_execute")
+def profile_query_end(conn, cursor, statement, parameters, context, executemany):
+    profiling.query_finished(conn)
+
+def start_request_profile():
+    if current_app.config["PROFILING_ENABLED"]:
+        profiling.start_request(current_app.extensions.get("slowest_profiles"))
+
+def finish_request_profile(response):
+    return profiling.finish_request(current_app.extensions.get("slowest_profiles"),
+        request.method, request.path, response)
+
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+
+def record_request_metrics(response):
+    """
+    Count request and its latency, labelled by resource class and method
+    """
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        view = current_app.view_functions.get(request.endpoint)
+        resource = getattr(view, "view_class", view).__name__ if view else "unmatched"
+        current_app.extensions["metrics"].observe_request(resource, request.method,
+            response.status_code, time.perf_counter() - start)
+    return response
+
+def add_query_count_header(response):
+    if current_app.config["QUERY_COUNT_HEADER"]:
+        response.headers["X-Query-Count"] = str(g.get("query_count", 0))
+    return response
 
 """
 Database ORM classes (SQLAlchemy)
@@ -147,14 +648,24 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     firstname = db.Column(db.String(30))
     lastname = db.Column(db.String(30))
-    email = db.Column(db.String(100))
+    email = db.Column(db.String(100), index=True)
     isAdmin = db.Column(db.Boolean, nullable=False)
     creationdate = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     courses = db.relationship("TrainingCourse",secondary=courseuserrelation,back_populates="users")
 
     def __repr__(self):
         return "<User %s %s>" % (self.firstname,self.lastname)
 
+class CourseContent(db.Model):
+    """
+    Course body (html) keyed by sha256 of body, courses with identical
+    body share one row
+    """
+    __tablename__ = 'CourseContent'
+    hash = db.Column(db.String(64), primary_key=True)
+    body = db.Column(db.Text, nullable=False)
+
 class TrainingCourse(db.Model):
     __tablename__ = 'TrainingCourse'
     id = db.Column(db.Integer, primary_key=True)
@@ -162,61 +673,342 @@ class TrainingCourse(db.Model):
     creationdate = db.Column(db.DateTime)
     startdate = db.Column(db.DateTime)
     enddate = db.Column(db.DateTime)
-    coursedatajson = db.Column(db.String)
+    content_hash = db.Column(db.String(64), db.ForeignKey("CourseContent.hash"), index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     medialist = db.relationship("CourseMedia",backref="trainingcourse", lazy=True)
     users = db.relationship("User",secondary=courseuserrelation,back_populates="courses")
+    #body is loaded only when asked (selectinload), course queries never read it
+    content = db.relationship("CourseContent", lazy="raise")
+
+    @property
+    def coursedatajson(self):
+        if self.content_hash is None:
+            return None
+        return self.content.body
 
     def __repr__(self):
-        return "TrainingCourse name : %s \n medias: %s \n users: %s \n" % (self.name,self.medialist,self.users)
+        return "<TrainingCourse %s>" % (self.name)
+
+def hash_content(body):
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def store_content(body):
+    """
+    Add course body to content store (if not there already), returns its hash
+    """
+    if body is None:
+        return None
+    content_hash = hash_content(body)
+    db.session.execute(sqlite_insert(CourseContent.__table__).values(
+        hash=content_hash, body=body
+    ).on_conflict_do_nothing())
+    return content_hash
+
+def release_content(content_hash):
+    """
+    Delete content which no course refers to anymore, after course changes are flushed
+    """
+    if content_hash is None:
+        return
+    db.session.execute(CourseContent.__table__.delete().where(and_(
+        CourseContent.hash == content_hash,
+        ~exists().where(TrainingCourse.content_hash == content_hash)
+    )))
 
 class CourseMedia(db.Model):
     __tablename__ = 'CourseMedia'
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(255))
     type = db.Column(db.String(20))
-    course_id = db.Column(db.Integer, db.ForeignKey('TrainingCourse.id', ondelete="SET NULL"))
+    course_id = db.Column(db.Integer, db.ForeignKey('TrainingCourse.id', ondelete="SET NULL"), index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return "<CourseMedia %s %s>" % (self.url,self.type)
 
     def serialize(self):
-        return {
-            'id': self.id, 
-            'url': self.url,
-            'type': self.type,
-        }
+        return MEDIA_FIELDS.serialize(self)
+
+#changelog triggers are created with whichever of the tables is created last
+for table, (entity, item, parent) in CHANGELOG_ENTITIES.items():
+    for operation in ("insert", "update", "delete"):
+        name = "changelog_{}_{}".format(entity, operation)
+        event.listen(db.metadata.tables[table], "after_create",
+            DDL(create_trigger_sql(name)).execute_if(callable_=table_exists("changelog")))
+        event.listen(changelog, "after_create",
+            DDL(create_trigger_sql(name)).execute_if(callable_=table_exists(table)))
+
+"""
+Export of full tables, rows are streamed from database one batch at a time
+"""
+#exported columns for each entity, first column(s) give export order
+EXPORT_ENTITIES = {
+    "users": (User.id, User.firstname, User.lastname, User.email,
+        User.isAdmin, User.creationdate),
+    "trainingcourses": (TrainingCourse.id, TrainingCourse.name,
+        TrainingCourse.creationdate, TrainingCourse.startdate, TrainingCourse.enddate),
+    "enrollments": tuple(courseuserrelation.c),
+}
+EXPORT_ORDER = {
+    "enrollments": (courseuserrelation.c.courseid, courseuserrelation.c.userid),
+}
+
+def wants_export():
+    """
+    True if client asked collection as ndjson stream with Accept header
+    """
+    return request.accept_mimetypes.best_match([MASON, "application/json", NDJSON]) == NDJSON
+
+def create_export_response(entity, as_json_array=False):
+    """
+    Stream all rows of entity as ndjson (one object per line) or as one json array.
+    Only plain column tuples are loaded, so memory use does not grow with table size.
+    """
+    columns = EXPORT_ENTITIES[entity]
+    keys = [str(column.key) for column in columns]
+    query = db.session.query(*columns).order_by(
+        *EXPORT_ORDER.get(entity, columns[:1])
+    ).yield_per(current_app.config["EXPORT_BATCH_SIZE"])
+
+    def generate():
+        if as_json_array:
+            yield b"["
+        for index, row in enumerate(query):
+            line = serializer.dumps(dict(zip(keys, row)))
+            if not as_json_array:
+                yield line + b"\n"
+            elif index == 0:
+                yield line
+            else:
+                yield b"," + line
+        if as_json_array:
+            yield b"]"
+
+    mimetype = "application/json" if as_json_array else NDJSON
+    return Response(stream_with_context(generate()), 200, mimetype=mimetype)
+
+"""
+Bulk import of users
+"""
+BOOLEAN_VALUES = {
+    "true": True, "1": True, "yes": True,
+    "false": False, "0": False, "no": False,
+}
+
+def validate_user_row(row):
+    """
+    Check one imported user (dict from json or csv). Returns column values for
+    insert, raises ValueError with reason if row is not valid.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("user must be object")
+    values = {}
+    for name, maxlength, required in (("firstname", 30, True), ("lastname", 30, True), ("email", 100, False)):
+        value = row.get(name)
+        if value in (None, ""):
+            if required:
+                raise ValueError("{} is required".format(name))
+            value = None
+        elif not isinstance(value, str) or len(value) > maxlength:
+            raise ValueError("{} must be text of at most {} characters".format(name, maxlength))
+        values[name] = value
+
+    is_admin = row.get("isAdmin")
+    if isinstance(is_admin, str):
+        is_admin = BOOLEAN_VALUES.get(is_admin.strip().lower())
+    if not isinstance(is_admin, bool):
+        raise ValueError("isAdmin must be true or false")
+    values["isAdmin"] = is_admin
+    return values
+
+def read_import_rows():
+    """
+    Rows of import request, json array or csv with header line
+    """
+    if request.mimetype == "text/csv":
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        raise ValueError("Request body must be JSON array of users")
+    return rows
+
+def insert_users(values):
+    """
+    Insert users with one executemany per chunk, chunk is committed in one
+    transaction. Returns ids of inserted users in same order.
+    """
+    ids = []
+    chunk_size = current_app.config["IMPORT_CHUNK_SIZE"]
+    now = datetime.utcnow()
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        for row in chunk:
+            row["creationdate"] = now
+        db.session.execute(User.__table__.insert(), chunk)
+        #sqlite gives rowid max + 1 to new rows, and transaction holds write lock
+        #until commit, so chunk got consecutive ids ending at current max
+        last_id = db.session.query(func.max(User.id)).scalar()
+        db.session.commit()
+        ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+    return ids
+
+"""
+Enrollments (courseuserrelation)
+"""
+#sqlite INTEGER is 64-bit signed, larger ints fail when bound to statement
+SQLITE_INTEGER_MIN = -2 ** 63
+SQLITE_INTEGER_MAX = 2 ** 63 - 1
+
+def is_integer_id(value):
+    """
+    True for json integer (not boolean) sqlite can store
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        SQLITE_INTEGER_MIN <= value <= SQLITE_INTEGER_MAX
+
+def read_enrollments(data):
+    """
+    Enrollment request is one object or list of objects with userid and optional
+    canModify. Returns dict userid -> canModify (None when not given).
+    """
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        raise ValueError("Request body must be enrollment object or non-empty list of them")
+    enrollments = {}
+    for index, item in enumerate(data):
+        if not isinstance(item, dict) or not is_integer_id(item.get("userid")):
+            raise ValueError("Enrollment {} must have integer userid".format(index))
+        can_modify = item.get("canModify")
+        if can_modify is not None and not isinstance(can_modify, bool):
+            raise ValueError("Enrollment {} canModify must be true or false".format(index))
+        enrollments[item["userid"]] = can_modify
+    return enrollments
+
+def enroll_users(course_id, enrollments):
+    """
+    Enroll users to course in one transaction. New enrollments are inserted and
+    existing ones updated (canModify) with executemany, so enrolling same user
+    again does not create duplicates. Inserts are upserts on the unique
+    (courseid, userid) index, enrollment made by concurrent request after the
+    existence check does not fail. Returns counts and ids of unknown users.
+    """
+    table = courseuserrelation
+    userids = list(enrollments)
+    chunk_size = current_app.config["ENROLL_CHUNK_SIZE"]
+    inserts = []
+    updates = []
+    known = set()
+    now = datetime.utcnow()
+    for start in range(0, len(userids), chunk_size):
+        chunk = userids[start:start + chunk_size]
+        known.update(id for (id,) in db.session.query(User.id).filter(User.id.in_(chunk)))
+        existing = set(id for (id,) in db.session.query(table.c.userid).filter(
+            table.c.courseid == course_id, table.c.userid.in_(chunk)
+        ))
+        for userid in chunk:
+            if userid not in known:
+                continue
+            can_modify = enrollments[userid]
+            if userid in existing:
+                if can_modify is not None:
+                    updates.append({"b_userid": userid, "b_canModify": can_modify})
+            else:
+                inserts.append({
+                    "courseid": course_id,
+                    "userid": userid,
+                    "addedtocourse": now,
+                    "canModify": bool(can_modify),
+                })
+
+    if inserts:
+        insert = sqlite_insert(table)
+        index = [table.c.courseid, table.c.userid]
+        #given canModify wins over concurrent enrollment, default does not
+        given = [row for row in inserts if enrollments[row["userid"]] is not None]
+        default = [row for row in inserts if enrollments[row["userid"]] is None]
+        if given:
+            db.session.execute(insert.on_conflict_do_update(index_elements=index,
+                set_={"canModify": insert.excluded.canModify}), given)
+        if default:
+            db.session.execute(insert.on_conflict_do_nothing(index_elements=index), default)
+    if updates:
+        db.session.execute(
+            table.update().where(and_(
+                table.c.courseid == course_id,
+                table.c.userid == bindparam("b_userid")
+            )).values(canModify=bindparam("b_canModify")),
+            updates
+        )
+    db.session.commit()
+    return {
+        "enrolled": len(inserts),
+        "updated": len(updates),
+        "notfound": [userid for userid in userids if userid not in known],
+    }
+
+def enrollment_columns(names=ENROLLMENT_FIELDS.names):
+    return [getattr(courseuserrelation.c, name) for name in names]
+
+def split_enrollment_fields(fields):
+    """
+    Fieldset of enrolled user or course as (row fields, enrollment fields)
+    """
+    enrollment = tuple(name for name in fields if name in ENROLLMENT_FIELDS.names)
+    return tuple(name for name in fields if name not in enrollment), enrollment
 
 """
 Resource classes for rest api
 """
 class TrainingCourseItem(Resource):
+    @cached_get
     def get(self,course):
-        db_course = TrainingCourse.query.filter_by(id=course).first()
+        try:
+            fields = read_fieldset(serializer.COURSE_ITEM_FIELDS + ("coursedatajson", "medialist"),
+                serializer.COURSE_ITEM_FIELDS + ("medialist",))
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        course_fields = tuple(name for name in fields if name != "medialist")
+        #medias and course body are loaded only when listed
+        options = [
+            load_fields(TrainingCourse, [name for name in course_fields if name != "coursedatajson"],
+                "updated_at", "content_hash"),
+            raiseload(TrainingCourse.users),
+        ]
+        if "medialist" in fields:
+            options.append(selectinload(TrainingCourse.medialist))
+        if "coursedatajson" in fields:
+            options.append(selectinload(TrainingCourse.content))
+        db_course = TrainingCourse.query.options(*options).filter_by(id=course).first()
         if db_course is None:
             return create_error_response(404, "Not found", 
                 "No course was found with the id {}".format(course)
             )
-
-        body = TrainingCourseBuilder(
-            id=db_course.id,
-            name=db_course.name,
-            coursedatajson=db_course.coursedatajson,
-            medialist=[e.serialize() for e in db_course.medialist]
-        )
+        add_cache_tags(course_tag(db_course.id))
+        version = ItemVersion(db_course.updated_at)
+        if version.is_not_modified():
+            return version.create_not_modified_response()
+
+        body = TrainingCourseBuilder(COURSE_FIELDS.serialize(db_course, course_fields))
+        if "medialist" in fields:
+            body["medialist"] = [e.serialize() for e in db_course.medialist]
+        if not wants_controls():
+            return version.add_headers(Response(encode_body(body), 200, mimetype=MASON))
         body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(TrainingCourseItem, course=course))
-        body.add_control("collection", api.url_for(TrainingCourseCollection))
+        body.add_control_template("self", "course", course)
+        body.add_control_template("collection", "courses")
         body.add_control_delete_course(course)
         body.add_control_modify_course(course)
         body.add_control_add_media(course)
         body.add_control_add_user_to_course(course)
 
-        body.add_control("trainingmanager:coursemedias",
-            api.url_for(CourseMediaCollection, course=course)
-        )
+        body.add_control_template("trainingmanager:coursemedias", "course-medias", course)
+        body.add_control_template("trainingmanager:courseusers", "course-users", course)
+        body.add_control_template("trainingmanager:coursecontent", "course-content", course)
+        body.add_control_template("trainingmanager:coursestats", "course-stats", course)
         #print(db_course.medialist)
         
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return version.add_headers(Response(encode_body(body), 200, mimetype=MASON))
 
     def put(self,course):
         db_course = TrainingCourse.query.filter_by(id=course).first()
@@ -230,14 +1022,21 @@ class TrainingCourseItem(Resource):
             )
 
         db_course.name = request.json["name"]
-        db_course.coursedatajson = request.json["coursedatajson"]
+        #body is optional here, it can be replaced also in content resource
+        old_hash = db_course.content_hash
+        if "coursedatajson" in request.json:
+            db_course.content_hash = store_content(request.json["coursedatajson"])
         
         try:
+            db.session.flush()
+            if old_hash != db_course.content_hash:
+                release_content(old_hash)
             db.session.commit()
         except IntegrityError:
             return create_error_response(409, "Already exists", 
                 "Course with name '{}' already exists.".format(request.json["name"])
             )
+        invalidate_cache("courses", course_tag(db_course.id))
         
         return Response(status=204)
 
@@ -248,33 +1047,143 @@ class TrainingCourseItem(Resource):
                 "No course was found with the name {}".format(course)
             )
         
+        content_hash = db_course.content_hash
         db.session.delete(db_course)
+        db.session.flush()
+        release_content(content_hash)
         db.session.commit()
+        invalidate_cache("courses", course_tag(db_course.id))
         
         return Response(status=204)
 
+class CourseContentItem(Resource):
+    """
+    Course body, kept apart from course so that course queries do not load it
+    """
+    @cached_get
+    def get(self, course):
+        row = db.session.query(TrainingCourse.id, TrainingCourse.content_hash, CourseContent.body).outerjoin(
+            CourseContent, CourseContent.hash == TrainingCourse.content_hash
+        ).filter(TrainingCourse.id == course).first()
+        if row is None:
+            return create_error_response(404, "Not found",
+                "No course was found with the id {}".format(course)
+            )
+        add_cache_tags(course_tag(row.id))
+        body = TrainingCourseBuilder(coursedatajson=row.body)
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("self", "course-content", row.id)
+        body.add_control_template("up", "course", row.id)
+        body.add_control_template("edit", "edit-course-content", row.id)
+        response = Response(encode_body(body), 200, mimetype=MASON)
+        if row.content_hash is not None:
+            #same body has same hash, no need to hash response
+            response.set_etag(row.content_hash)
+        return response.make_conditional(request)
+
+    def put(self, course):
+        db_course = TrainingCourse.query.options(raiseload("*")).filter_by(id=course).first()
+        if db_course is None:
+            return create_error_response(404, "Not found",
+                "No course was found with the id {}".format(course)
+            )
+        if not request.json or not isinstance(request.json.get("coursedatajson"), str):
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON with coursedatajson string"
+            )
+        old_hash = db_course.content_hash
+        db_course.content_hash = store_content(request.json["coursedatajson"])
+        db.session.flush()
+        if old_hash != db_course.content_hash:
+            release_content(old_hash)
+        db.session.commit()
+        invalidate_cache(course_tag(db_course.id))
+        return Response(status=204)
+
+def score_percentile(histogram, scored, percent):
+    """
+    Nearest-rank percentile from (score, count) rows in score order
+    """
+    rank = max(1, -(-scored * percent // 100))
+    seen = 0
+    for score, count in histogram:
+        seen += count
+        if seen >= rank:
+            return score
+    return None
+
+class CourseStatsItem(Resource):
+    """
+    Enrollment and completion statistics of course, read from aggregate tables
+    """
+    def get(self, course):
+        stats = coursestats.c
+        row = db.session.query(TrainingCourse.id, stats.enrolled, stats.completed, stats.scored,
+            stats.score_sum).outerjoin(
+            coursestats, coursestats.c.courseid == TrainingCourse.id
+        ).filter(TrainingCourse.id == course).first()
+        if row is None:
+            return create_error_response(404, "Not found",
+                "No course was found with the id {}".format(course)
+            )
+        enrolled = row.enrolled or 0
+        completed = row.completed or 0
+        scored = row.scored or 0
+        histogram = []
+        if scored:
+            histogram = db.session.query(coursescorehistogram.c.score, coursescorehistogram.c.count).filter(
+                coursescorehistogram.c.courseid == row.id
+            ).order_by(coursescorehistogram.c.score).all()
+        body = TrainingCourseBuilder(
+            enrolled=enrolled,
+            completed=completed,
+            completionRate=completed / enrolled if enrolled else None,
+            scored=scored,
+            meanScore=row.score_sum / scored if scored else None,
+            medianScore=score_percentile(histogram, scored, 50) if scored else None,
+            p90Score=score_percentile(histogram, scored, 90) if scored else None,
+        )
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("self", "course-stats", row.id)
+        body.add_control_template("up", "course", row.id)
+        return Response(encode_body(body), 200, mimetype=MASON)
+
 class TrainingCourseCollection(Resource):
+    @cached_get
     def get(self):
+        if wants_export():
+            return create_export_response("trainingcourses")
+
+        try:
+            fields = read_fieldset(serializer.COURSE_COLLECTION_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        controls = wants_controls()
 
         body = TrainingCourseBuilder()
         body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(TrainingCourseCollection))
+        body.add_control_template("self", "courses")
         body.add_control_add_course()
 
+        try:
+            page = KeysetPage(TrainingCourse.query.options(
+                load_fields(TrainingCourse, fields), raiseload("*")), TrainingCourse.id)
+        except ValueError as e:
+            return create_error_response(400, "Invalid page parameters", str(e))
+        body.add_page_controls(CONTROL_TEMPLATES["courses"].href(), page)
+        add_cache_tags("courses")
+
         body["items"] = []
 
-        for item in TrainingCourse.query.all():
+        for item in page.items:
 
-            newitem = TrainingCourseBuilder(
-                id=item.id,
-                name=item.name,
-                creationdate=item.creationdate,
-                startdate=item.startdate,
-                enddate=item.enddate,                
-            )            
-            newitem.add_control("self", api.url_for(TrainingCourseItem, course=item.id))  
+            newitem = TrainingCourseBuilder(COURSE_FIELDS.serialize(item, fields))
+            if controls:
+                newitem.add_control_template("self", "course", item.id)
             body["items"].append(newitem)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if not controls:
+            strip_controls(body)
+        return Response(encode_body(body), 200, mimetype=MASON)
 
 
     def post(self):
@@ -285,12 +1194,14 @@ class TrainingCourseCollection(Resource):
 
         course = TrainingCourse(
             name=request.json["name"],
-            coursedatajson=request.json["coursedatajson"]
+            #body is optional, as in put
+            content_hash=store_content(request.json.get("coursedatajson"))
         )
 
         try:
             db.session.add(course)
-            db.session.commit()            
+            db.session.commit()
+            invalidate_cache("courses")
             return Response(str(course.id),status=201, headers={
             "Location": api.url_for(TrainingCourseItem, course=course.id)
             })
@@ -301,24 +1212,24 @@ class TrainingCourseCollection(Resource):
         
 class CourseMediaCollection(Resource):
     def get(self,course):
+        try:
+            fields = read_fieldset(serializer.MEDIA_ITEM_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
         body = MediaBuilder()
         body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(CourseMediaCollection, course=course))
+        body.add_control_template("self", "course-medias", course)
         #print(body)
 
-        items = CourseMedia.query.filter_by(course_id=course)
-        returnlist = []
-        for item in items:            
-
-            newitem = {
-                "url":item.url,
-                "type":item.type
-            }
-            
-            returnlist.append(newitem)
-        return returnlist
+        #list has no controls, so ?controls=false changes nothing
+        items = CourseMedia.query.options(
+            load_fields(CourseMedia, fields), raiseload("*")).filter_by(course_id=course)
+        returnlist = [MEDIA_FIELDS.serialize(item, fields) for item in items]
+        return Response(encode_body(returnlist), 200, mimetype="application/json")
 
     def post(self,course):
+        if isinstance(request.get_json(silent=True), list):
+            return self._post_list(course, request.json)
         if not request.json:
             return create_error_response(415, "Unsupported media type",
                 "Requests must be JSON"
@@ -332,34 +1243,79 @@ class CourseMediaCollection(Resource):
             
         try:
             db.session.add(newmedia)
+            touch_course(course)
             db.session.commit()
         except IntegrityError as e:
             print(e)
             return create_error_response(409, "Integrityerror, media add")
+        invalidate_cache(course_tag(newmedia.course_id))
 
         return Response(status=201, headers={
             "Location": api.url_for(MediaItem, id=newmedia.id)
         })
 
+    def _post_list(self, course, medias):
+        """
+        Attach list of medias to course in one transaction, body lists locations of new medias,
+        Location header is location of first one
+        """
+        if not medias:
+            return create_error_response(400, "Invalid media list", "List of medias is empty")
+        newmedias = []
+        for index, media in enumerate(medias):
+            if not isinstance(media, dict) or "url" not in media or "type" not in media:
+                return create_error_response(400, "Invalid media list",
+                    "Media {} must have url and type".format(index)
+                )
+            newmedias.append(CourseMedia(url=media["url"], type=media["type"], course_id=course))
+
+        try:
+            db.session.add_all(newmedias)
+            touch_course(course)
+            #ids are taken before commit, commit expires the objects
+            db.session.flush()
+            ids = [media.id for media in newmedias]
+            db.session.commit()
+        except IntegrityError as e:
+            print(e)
+            return create_error_response(409, "Integrityerror, media add")
+        invalidate_cache(course_tag(course))
+
+        body = MediaBuilder(items=[])
+        for id in ids:
+            item = MediaBuilder(id=id)
+            item.add_control_template("self", "media", id)
+            body["items"].append(item)
+        return Response(encode_body(body), 201, mimetype=MASON, headers={
+            "Location": CONTROL_TEMPLATES["media"].href(ids[0])
+        })
+
 class MediaItem(Resource):
     def get(self,id):        
-        db_media = CourseMedia.query.filter_by(id=id).first()
+        try:
+            fields = read_fieldset(serializer.MEDIA_ITEM_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        db_media = CourseMedia.query.options(
+            load_fields(CourseMedia, fields, "updated_at"), raiseload("*")
+        ).filter_by(id=id).first()
         if db_media is None:
             return create_error_response(404, "Not found", 
                 "No media was found with the id {}".format(id)
             )
+        version = ItemVersion(db_media.updated_at)
+        if version.is_not_modified():
+            return version.create_not_modified_response()
 
-        body = MediaBuilder(
-            url=db_media.url,
-            type=db_media.type
-        )
+        body = MediaBuilder(MEDIA_FIELDS.serialize(db_media, fields))
+        if not wants_controls():
+            return version.add_headers(Response(encode_body(body), 200, mimetype=MASON))
         body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(MediaItem, id=id))
+        body.add_control_template("self", "media", id)
         #Should return all media items, not implemented
         #body.add_control("collection", api.url_for(AllMediaCollection))
 
-        #print(json.dumps(body))
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return version.add_headers(Response(encode_body(body), 200, mimetype=MASON))
     def put(self,id):
         db_media = CourseMedia.query.filter_by(id=id).first()
         if db_media is None:
@@ -372,6 +1328,7 @@ class MediaItem(Resource):
             )      
         db_media.url = request.json["url"]
         db_media.type = request.json["type"]       
+        touch_course(db_media.course_id)
 
         try:
             db.session.commit()
@@ -379,39 +1336,54 @@ class MediaItem(Resource):
             return create_error_response(409, "Already exists", 
                 "Media with id '{}' put error".format(request.json["id"])
             )
+        invalidate_cache(course_tag(db_media.course_id))
         
         return Response(status=204) 
-    def delete(self):
+    def delete(self,id):
         db_media = CourseMedia.query.filter_by(id=id).first()
         if db_media is None:
             return create_error_response(404, "Not found", 
                 "No media was found with the id {}".format(id)
             )
         
+        course_id = db_media.course_id
+        touch_course(course_id)
         db.session.delete(db_media)
         db.session.commit()
+        invalidate_cache(course_tag(course_id))
         
         return Response(status=204)
 
 class UserCollection(Resource):
     def get(self):
+        if wants_export():
+            return create_export_response("users")
+        try:
+            fields = read_fieldset(serializer.USER_COLLECTION_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        controls = wants_controls()
         body = UserBuilder()
         body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserCollection))
+        body.add_control_template("self", "users")
         body.add_control_add_user()
+        body.add_control_import_users()
+        try:
+            page = KeysetPage(User.query.options(load_fields(User, fields), raiseload("*")), User.id)
+        except ValueError as e:
+            return create_error_response(400, "Invalid page parameters", str(e))
+        body.add_page_controls(CONTROL_TEMPLATES["users"].href(), page)
+
         body["items"] = []
-        for item in User.query.all():         
+        for item in page.items:
 
-            newitem = UserBuilder(
-                id=item.id,
-                firstname=item.firstname,
-                lastname=item.lastname,
-                email=item.email
-            )
-            newitem.add_control("self", api.url_for(UserItem, id=item.id))            
+            newitem = UserBuilder(USER_FIELDS.serialize(item, fields))
+            if controls:
+                newitem.add_control_template("self", "user", item.id)
             body["items"].append(newitem)
-            
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if not controls:
+            strip_controls(body)
+        return Response(encode_body(body), 200, mimetype=MASON)
 
     def post(self):
         if not request.json:
@@ -436,26 +1408,738 @@ class UserCollection(Resource):
             "Location": api.url_for(UserItem, id=newuser.id)
         })
 
+class CourseUserCollection(Resource):
+    def get(self, course):
+        try:
+            user_fields, fields = split_enrollment_fields(read_fieldset(serializer.COURSE_USER_FIELDS))
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        controls = wants_controls()
+        db_course = db.session.query(TrainingCourse.id).filter_by(id=course).first()
+        if db_course is None:
+            return create_error_response(404, "Not found",
+                "No course was found with the id {}".format(course)
+            )
+        columns = [getattr(User, name) for name in user_fields if name != "id"]
+        query = db.session.query(User.id, *columns, *enrollment_columns(fields)).join(
+            courseuserrelation, courseuserrelation.c.userid == User.id
+        ).filter(courseuserrelation.c.courseid == db_course.id)
+        try:
+            #paging by relation column follows index order
+            page = KeysetPage(query, courseuserrelation.c.userid)
+        except ValueError as e:
+            return create_error_response(400, "Invalid page parameters", str(e))
+
+        body = UserBuilder()
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("self", "course-users", db_course.id)
+        body.add_control_template("up", "course", db_course.id)
+        body.add_control_template("trainingmanager:enroll-users", "add-course-user", db_course.id)
+        body.add_page_controls(CONTROL_TEMPLATES["course-users"].href(db_course.id), page)
+        body["items"] = []
+        for row in page.items:
+            item = UserBuilder(USER_FIELDS.serialize(row, user_fields))
+            item.update(ENROLLMENT_FIELDS.serialize(row, fields))
+            if controls:
+                item.add_control_template("self", "user", row.id)
+            body["items"].append(item)
+        if not controls:
+            strip_controls(body)
+        return Response(encode_body(body), 200, mimetype=MASON)
+
+    def post(self, course):
+        db_course = db.session.query(TrainingCourse.id).filter_by(id=course).first()
+        if db_course is None:
+            return create_error_response(404, "Not found",
+                "No course was found with the id {}".format(course)
+            )
+        if not request.is_json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+        try:
+            enrollments = read_enrollments(request.get_json(silent=True))
+        except ValueError as e:
+            return create_error_response(400, "Invalid enrollment", str(e))
+
+        body = UserBuilder(enroll_users(db_course.id, enrollments))
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("collection", "course-users", db_course.id)
+        return Response(encode_body(body), 200, mimetype=MASON)
+
+class UserCourseCollection(Resource):
+    def get(self, id):
+        try:
+            course_fields, fields = split_enrollment_fields(read_fieldset(serializer.USER_COURSE_FIELDS))
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        controls = wants_controls()
+        db_user = db.session.query(User.id).filter_by(id=id).first()
+        if db_user is None:
+            return create_error_response(404, "Not found",
+                "No user was found with the id {}".format(id)
+            )
+        columns = [getattr(TrainingCourse, name) for name in course_fields if name != "id"]
+        query = db.session.query(TrainingCourse.id, *columns, *enrollment_columns(fields)).join(
+            courseuserrelation, courseuserrelation.c.courseid == TrainingCourse.id
+        ).filter(courseuserrelation.c.userid == db_user.id)
+        try:
+            page = KeysetPage(query, courseuserrelation.c.courseid)
+        except ValueError as e:
+            return create_error_response(400, "Invalid page parameters", str(e))
+
+        body = TrainingCourseBuilder()
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("self", "user-courses", db_user.id)
+        body.add_control_template("up", "user", db_user.id)
+        body.add_page_controls(CONTROL_TEMPLATES["user-courses"].href(db_user.id), page)
+        body["items"] = []
+        for row in page.items:
+            item = TrainingCourseBuilder(COURSE_FIELDS.serialize(row, course_fields))
+            item.update(ENROLLMENT_FIELDS.serialize(row, fields))
+            if controls:
+                item.add_control_template("self", "course", row.id)
+            body["items"].append(item)
+        if not controls:
+            strip_controls(body)
+        return Response(encode_body(body), 200, mimetype=MASON)
+
+"""
+Completion events
+"""
+COMPLETION_SCORE_MIN = 0
+COMPLETION_SCORE_MAX = 100
+
+def read_completion_events(data):
+    """
+    Completion request is one event object or list of them. Event has
+    idempotencyKey, courseid, userid and optional score (0-100) and completed
+    (true sets completion date). Returns events for write queue.
+    """
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        raise ValueError("Request body must be completion event or non-empty list of them")
+    now = datetime.utcnow()
+    events = []
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise ValueError("Event {} must be object".format(index))
+        key = item.get("idempotencyKey")
+        if not isinstance(key, str) or not 0 < len(key) <= 100:
+            raise ValueError("Event {} must have idempotencyKey string of at most 100 characters".format(index))
+        for name in ("courseid", "userid"):
+            if not is_integer_id(item.get(name)):
+                raise ValueError("Event {} must have integer {}".format(index, name))
+        score = item.get("score")
+        if score is not None and (not isinstance(score, int) or isinstance(score, bool)
+                or not COMPLETION_SCORE_MIN <= score <= COMPLETION_SCORE_MAX):
+            raise ValueError("Event {} score must be integer from {} to {}".format(
+                index, COMPLETION_SCORE_MIN, COMPLETION_SCORE_MAX))
+        completed = item.get("completed", False)
+        if not isinstance(completed, bool):
+            raise ValueError("Event {} completed must be true or false".format(index))
+        events.append({
+            "key": key,
+            "courseid": item["courseid"],
+            "userid": item["userid"],
+            "score": score,
+            "completed": now if completed else None,
+            "received": now,
+        })
+    return events
+
+def write_completions(app, events):
+    """
+    Write group of completion events in one transaction (runs in writer thread).
+    Events with already written idempotency key and events of unknown course
+    or user are dropped, others are upserted to courseuserrelation.
+    """
+    relation = courseuserrelation
+    with app.app_context(), db.engine.begin() as conn:
+        keys = set(conn.execute(select(completionkey.c.key).where(
+            completionkey.c.key.in_([item["key"] for item in events])
+        )).scalars())
+        courses = set(conn.execute(select(TrainingCourse.id).where(
+            TrainingCourse.id.in_(set(item["courseid"] for item in events))
+        )).scalars())
+        users = set(conn.execute(select(User.id).where(
+            User.id.in_(set(item["userid"] for item in events))
+        )).scalars())
+        new = []
+        for item in events:
+            if item["key"] in keys or item["courseid"] not in courses or item["userid"] not in users:
+                continue
+            keys.add(item["key"])
+            new.append(item)
+        if new:
+            conn.execute(completionkey.insert(),
+                [{"key": item["key"], "received": item["received"]} for item in new])
+            insert = sqlite_insert(relation)
+            conn.execute(insert.on_conflict_do_update(
+                index_elements=[relation.c.courseid, relation.c.userid],
+                set_={
+                    "courseCompletionScore": func.coalesce(insert.excluded.courseCompletionScore,
+                        relation.c.courseCompletionScore),
+                    "courseCompletionDate": func.coalesce(insert.excluded.courseCompletionDate,
+                        relation.c.courseCompletionDate),
+                }
+            ), [{
+                "courseid": item["courseid"],
+                "userid": item["userid"],
+                "addedtocourse": item["received"],
+                "canModify": False,
+                "courseCompletionScore": item["score"],
+                "courseCompletionDate": item["completed"],
+            } for item in new])
+        cutoff = datetime.utcnow() - timedelta(seconds=app.config["COMPLETION_KEY_TTL"])
+        conn.execute(completionkey.delete().where(completionkey.c.received < cutoff))
+
+class CompletionCollection(Resource):
+    def post(self):
+        if not request.is_json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+        try:
+            events = read_completion_events(request.get_json(silent=True))
+        except ValueError as e:
+            return create_error_response(400, "Invalid completion event", str(e))
+        try:
+            current_app.extensions["completion_queue"].submit(events)
+        except ingest.QueueFull:
+            response = create_error_response(429, "Too many requests",
+                "Completion queue is full, try again later"
+            )
+            response.headers["Retry-After"] = str(current_app.config["COMPLETION_RETRY_AFTER"])
+            return response
+        body = MasonBuilder(accepted=len(events))
+        body.add_control_template("self", "completions")
+        return Response(encode_body(body), 202, mimetype=MASON)
+
+"""
+Batch requests
+"""
+BATCH_METHODS = ("GET", "POST", "PUT", "DELETE")
+#${name.id} or ${name.location} refers to result of earlier operation named name
+BATCH_REFERENCE = re.compile(r"\$\{([A-Za-z0-9_-]+)\.(id|location)\}")
+
+def read_batch(data):
+    """
+    Batch request is object with list of operations and optional atomic flag
+    (default true). Operation has method, path and optional body and id, id
+    names operation so later operations can refer to its result.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("operations"), list) or not data["operations"]:
+        raise ValueError("Request body must be object with non-empty list of operations")
+    atomic = data.get("atomic", True)
+    if not isinstance(atomic, bool):
+        raise ValueError("atomic must be true or false")
+    operations = data["operations"]
+    if len(operations) > current_app.config["BATCH_MAX_OPERATIONS"]:
+        raise ValueError("At most {} operations can be sent at once".format(current_app.config["BATCH_MAX_OPERATIONS"]))
+    batch_path = api.url_for(BatchCollection)
+    names = set()
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("method") not in BATCH_METHODS:
+            raise ValueError("Operation {} must have method {}".format(index, ", ".join(BATCH_METHODS)))
+        path = operation.get("path")
+        if not isinstance(path, str) or not path.startswith("/api/") or path.startswith(batch_path):
+            raise ValueError("Operation {} must have api path other than batch".format(index))
+        name = operation.get("id")
+        if name is not None:
+            if not isinstance(name, str) or not re.fullmatch(r"[A-Za-z0-9_-]+", name) or name in names:
+                raise ValueError("Operation {} id must be unique name of letters, digits, _ and -".format(index))
+            names.add(name)
+    return atomic, operations
+
+def resolve_references(value, references):
+    """
+    Replace references in strings of path or body with results of earlier
+    operations, string which is only reference to id becomes integer id
+    """
+    def lookup(match):
+        result = references.get(match.group(1), {}).get(match.group(2))
+        if result is None:
+            raise ValueError("Unknown reference {}".format(match.group(0)))
+        return result
+
+    if isinstance(value, str):
+        whole = BATCH_REFERENCE.fullmatch(value)
+        if whole:
+            return lookup(whole)
+        return BATCH_REFERENCE.sub(lambda match: str(lookup(match)), value)
+    if isinstance(value, list):
+        return [resolve_references(item, references) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve_references(item, references) for key, item in value.items()}
+    return value
+
+def dispatch_operation(method, path, body):
+    """
+    Run operation as request to api resource in this app and app context
+    (same database session), request hooks are not run for operations.
+    Streamed responses (exports, event stream) are not read, they would hold
+    the batch transaction for as long as the stream runs. Unexpected error of
+    handler fails only its operation (500).
+    """
+    with current_app.test_request_context(path, method=method, json=body):
+        try:
+            rv = current_app.dispatch_request()
+        except HTTPException as e:
+            rv = current_app.handle_user_exception(e)
+            #routing errors (404, 405, 308) come back as exception, which make_response
+            #would turn into streamed wsgi response
+            if isinstance(rv, HTTPException):
+                rv = rv.get_response()
+        except Exception:
+            current_app.logger.exception("Batch operation %s %s failed", method, path)
+            return create_error_response(500, "Internal server error",
+                "Operation failed unexpectedly"
+            )
+        response = current_app.make_response(rv)
+        if response.is_streamed:
+            response.close()
+            return create_error_response(400, "Streaming resource",
+                "Streamed responses can not be batch operations"
+            )
+        response.get_data()
+    return response
+
+class BatchTransaction(object):
+    """
+    Database transaction of batch, each operation runs in its own savepoint.
+    Handlers commit and roll back as usual: legacy session commit releases and
+    rollback rolls back innermost savepoint, so they end only savepoint of
+    operation. Handler which commits several times gets new savepoint for rest
+    of operation. Cache is invalidated when whole batch is committed.
+    """
+    def __init__(self, writes):
+        self.session = db.session()
+        self.in_operation = False
+        g.batch_invalidated = set()
+        #write lock is taken at start, read transaction could not upgrade to write when other worker wrote
+        self.session.execute(text("BEGIN IMMEDIATE" if writes else "BEGIN"))
+        event.listen(self.session, "after_transaction_end", self._restart_savepoint)
+
+    def _restart_savepoint(self, session, transaction):
+        if self.in_operation and transaction.nested:
+            session.begin_nested()
+
+    def run(self, method, path, body):
+        self.session.begin_nested()
+        self.in_operation = True
+        try:
+            response = dispatch_operation(method, path, body)
+        finally:
+            self.in_operation = False
+        savepoint = self.session.get_nested_transaction()
+        if savepoint is not None:
+            if response.status_code < 400:
+                savepoint.commit()
+            else:
+                savepoint.rollback()
+        return response
+
+    def finish(self, commit):
+        event.remove(self.session, "after_transaction_end", self._restart_savepoint)
+        tags = g.pop("batch_invalidated")
+        if not commit:
+            self.session.rollback()
+            return
+        self.session.commit()
+        invalidate_cache(*tags)
+
+def operation_result(operation, response):
+    result = {"status": response.status_code}
+    if operation.get("id") is not None:
+        result["id"] = operation["id"]
+    if "Location" in response.headers:
+        result["location"] = response.headers["Location"]
+    if response.is_json:
+        result["body"] = response.get_json()
+    elif response.data:
+        result["body"] = response.get_data(as_text=True)
+    return result
+
+def operation_reference(response):
+    location = response.headers.get("Location")
+    if location is None:
+        return {}
+    last = location.rstrip("/").rsplit("/", 1)[-1]
+    return {"location": location, "id": int(last) if last.isdigit() else last}
+
+class BatchCollection(Resource):
+    def post(self):
+        """
+        Run list of operations in one request and one transaction. Atomic batch
+        stops at first failed operation and rolls back all, it is answered with
+        status of failed operation. Otherwise failed operations are rolled back
+        alone and rest are committed. Completion events are queued at once and
+        are not part of batch transaction.
+        """
+        if not request.is_json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+        try:
+            atomic, operations = read_batch(request.get_json(silent=True))
+        except ValueError as e:
+            return create_error_response(400, "Invalid batch", str(e))
+
+        results = []
+        references = {}
+        status = 200
+        transaction = BatchTransaction(any(operation["method"] != "GET" for operation in operations))
+        try:
+            for operation in operations:
+                try:
+                    path = resolve_references(operation["path"], references)
+                    body = resolve_references(operation.get("body"), references)
+                except ValueError as e:
+                    response = create_error_response(400, "Invalid reference", str(e))
+                else:
+                    response = transaction.run(operation["method"], path, body)
+                results.append(operation_result(operation, response))
+                if response.status_code >= 400:
+                    if atomic:
+                        status = response.status_code
+                        break
+                elif operation.get("id") is not None:
+                    references[operation["id"]] = operation_reference(response)
+        except Exception:
+            transaction.finish(commit=False)
+            raise
+        transaction.finish(commit=status < 400)
+
+        body = MasonBuilder(committed=status < 400, results=results)
+        body.add_control_template("self", "batch")
+        return Response(encode_body(body), status, mimetype=MASON)
+
+"""
+Change log (delta sync)
+"""
+def compact_changelog(conn, retention):
+    """
+    Remove change log entries older than retention seconds, newest entry is
+    always kept so oldest valid token can be found. Returns removed count.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=retention)
+    #entries are removed from start of log only, token older than first entry has gaps
+    last_old = conn.execute(select(func.max(changelog.c.id)).where(changelog.c.changed_at < cutoff)).scalar()
+    newest = conn.execute(select(func.max(changelog.c.id))).scalar()
+    if last_old is None:
+        return 0
+    return conn.execute(changelog.delete().where(
+        changelog.c.id <= min(last_old, newest - 1)
+    )).rowcount
+
+def compact_changelog_after_write(response):
+    if request.method == "GET" or response.status_code >= 400:
+        return response
+    interval = current_app.config["CHANGELOG_COMPACT_INTERVAL"]
+    state = current_app.extensions["changelog_compacted"]
+    now = time.monotonic()
+    if now - state["at"] < interval:
+        return response
+    state["at"] = now
+    with db.engine.begin() as conn:
+        compact_changelog(conn, current_app.config["CHANGELOG_RETENTION"])
+    return response
+
+def changed_items(entries):
+    """
+    Current representation of changed rows, dict (entity, item, parent) -> item.
+    Deleted rows are missing.
+    """
+    ids = {}
+    for entry in entries:
+        if entry.operation != "delete":
+            ids.setdefault(entry.entity, set()).add((entry.itemid, entry.parentid))
+    items = {}
+    if "user" in ids:
+        users = User.query.options(load_fields(User, serializer.USER_COLLECTION_FIELDS)).filter(
+            User.id.in_([item for item, parent in ids["user"]]))
+        for user in users:
+            items[("user", user.id, None)] = UserBuilder(USER_FIELDS.serialize(user, serializer.USER_COLLECTION_FIELDS))
+            items[("user", user.id, None)].add_control_template("self", "user", user.id)
+    if "course" in ids:
+        courses = TrainingCourse.query.options(load_fields(TrainingCourse, serializer.COURSE_COLLECTION_FIELDS)).filter(
+            TrainingCourse.id.in_([item for item, parent in ids["course"]]))
+        for course in courses:
+            items[("course", course.id, None)] = TrainingCourseBuilder(
+                COURSE_FIELDS.serialize(course, serializer.COURSE_COLLECTION_FIELDS))
+            items[("course", course.id, None)].add_control_template("self", "course", course.id)
+    if "media" in ids:
+        medias = CourseMedia.query.options(raiseload("*")).filter(
+            CourseMedia.id.in_([item for item, parent in ids["media"]]))
+        for media in medias:
+            items[("media", media.id, media.course_id)] = MediaBuilder(media.serialize())
+            items[("media", media.id, media.course_id)].add_control_template("self", "media", media.id)
+    if "enrollment" in ids:
+        relation = courseuserrelation
+        keys = list(ids["enrollment"])
+        #two parameters per key, chunks stay within ENROLL_CHUNK_SIZE parameters
+        chunk_size = max(current_app.config["ENROLL_CHUNK_SIZE"] // 2, 1)
+        for start in range(0, len(keys), chunk_size):
+            rows = db.session.query(relation.c.userid, relation.c.courseid, *enrollment_columns()).filter(
+                tuple_(relation.c.userid, relation.c.courseid).in_(keys[start:start + chunk_size]))
+            for row in rows:
+                item = MasonBuilder(ENROLLMENT_FIELDS.serialize(row))
+                item.add_control_template("course", "course", row.courseid)
+                item.add_control_template("user", "user", row.userid)
+                items[("enrollment", row.userid, row.courseid)] = item
+    return items
+
+def changelog_bounds():
+    """
+    First and newest token in change log, newest is 0 when log is empty
+    """
+    first, newest = db.session.query(func.min(changelog.c.id), func.max(changelog.c.id)).one()
+    return first, newest or 0
+
+def is_valid_token(token, first, newest):
+    """
+    Token newer than log is from other database, older than first entry has compacted changes after it
+    """
+    return token <= newest and (first is None or token >= first - 1)
+
+def read_changelog(since, limit):
+    return db.session.query(changelog.c.id, changelog.c.entity, changelog.c.operation,
+        changelog.c.itemid, changelog.c.parentid).filter(changelog.c.id > since).order_by(
+        changelog.c.id).limit(limit).all()
+
+def describe_change(entry, items):
+    """
+    Change log entry for clients, items from changed_items. Row which no
+    longer exists is reported deleted.
+    """
+    key = (entry.entity, entry.itemid, entry.parentid)
+    change = {"token": entry.id, "entity": entry.entity, "operation": entry.operation}
+    if entry.entity == "enrollment":
+        change.update(course=entry.parentid, user=entry.itemid)
+    else:
+        change["id"] = entry.itemid
+    if entry.entity == "media":
+        change["course"] = entry.parentid
+    if key in items:
+        change["item"] = items[key]
+    else:
+        change["operation"] = "delete"
+    return change
+
+class ChangeCollection(Resource):
+    def get(self):
+        """
+        Changes after token given in ?since=. Without since only current token
+        is returned: client takes token, loads collections and then follows
+        changes. Each changed row is listed once per page with its last
+        operation and current representation. Token older than compacted
+        part of log (or from other database) is answered with 410, client
+        must load collections again.
+        """
+        try:
+            since = KeysetPage._get_int_arg("since", None)
+            limit = KeysetPage._get_int_arg("limit", current_app.config["PAGE_SIZE_DEFAULT"])
+            if limit < 1:
+                raise ValueError("limit must be positive")
+        except ValueError as e:
+            return create_error_response(400, "Invalid change token", str(e))
+        limit = min(limit, current_app.config["PAGE_SIZE_MAX"])
+
+        first, newest = changelog_bounds()
+        body = MasonBuilder()
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("trainingmanager:users-all", "users")
+        body.add_control_template("trainingmanager:courses-all", "courses")
+        if since is None:
+            body.update(token=newest, more=False, items=[])
+            body.add_control_template("self", "changes")
+            body["@controls"]["next"] = {"href": CONTROL_TEMPLATES["changes"].href() + "?since={}".format(newest)}
+            return Response(encode_body(body), 200, mimetype=MASON)
+        if not is_valid_token(since, first, newest):
+            return create_error_response(410, "Token expired",
+                "Changes after token {} are not available, load collections again".format(since)
+            )
+
+        entries = read_changelog(since, limit + 1)
+        more = len(entries) > limit
+        entries = entries[:limit]
+        token = entries[-1].id if entries else since
+        #row changed many times on this page is listed once, at its last change,
+        #row inserted on this page stays insert
+        last = {}
+        inserted = set()
+        for entry in entries:
+            key = (entry.entity, entry.itemid, entry.parentid)
+            if key not in last and entry.operation == "insert":
+                inserted.add(key)
+            last.pop(key, None)
+            last[key] = entry
+        items = changed_items(last.values())
+
+        body.update(token=token, more=more, items=[])
+        for key, entry in last.items():
+            change = describe_change(entry, items)
+            if key in inserted and "item" in change:
+                change["operation"] = "insert"
+            body["items"].append(change)
+        href = CONTROL_TEMPLATES["changes"].href()
+        body["@controls"]["self"] = {"href": href + "?since={}".format(since)}
+        body["@controls"]["next"] = {"href": href + "?since={}".format(token)}
+        return Response(encode_body(body), 200, mimetype=MASON)
+
+"""
+Change events (server-sent events)
+"""
+def read_change_events(app, token):
+    """
+    Events of change log entries after token for event hub, runs in hub reader thread
+    """
+    #request context for building control urls of items
+    with app.test_request_context():
+        first, newest = changelog_bounds()
+        if token is None:
+            return newest, []
+        if not is_valid_token(token, first, newest):
+            return newest, None
+        entries = read_changelog(token, app.config["EVENTS_READ_LIMIT"])
+        if not entries:
+            return token, []
+        items = changed_items(entries)
+        return entries[-1].id, [(entry.id, describe_change(entry, items)) for entry in entries]
+
+def notify_event_subscribers(response):
+    """
+    Write requests wake event hub at once, writes of other processes are found by polling
+    """
+    if request.method != "GET" and response.status_code < 400:
+        current_app.extensions["event_hub"].notify()
+    return response
+
+def format_event(change):
+    if change is None:
+        return b": keepalive\n\n"
+    token, data = change
+    if data is None:
+        return "id: {0}\nevent: reset\ndata: {{\"token\": {0}}}\n\n".format(token).encode("utf-8")
+    return "id: {}\nevent: change\ndata: ".format(token).encode("utf-8") + serializer.dumps(data) + b"\n\n"
+
+class EventStream(Resource):
+    def get(self):
+        """
+        Change events as text/event-stream. Event id is change token, browser
+        sends it back in Last-Event-ID header when it reconnects, ?since= gives
+        token to start from. Data of change event is same as item of change
+        feed. Reset event means changes were missed, client syncs with change
+        feed from its own token. Comment line is sent when nothing happens.
+        """
+        token = request.headers.get("Last-Event-ID") or request.args.get("since")
+        if token is not None:
+            try:
+                token = int(token)
+            except ValueError:
+                return create_error_response(400, "Invalid change token", "Token must be integer")
+        hub = current_app.extensions["event_hub"]
+        heartbeat = current_app.config["EVENTS_HEARTBEAT"]
+        if not hub.open_stream(current_app.config["EVENTS_MAX_STREAMS"]):
+            response = create_error_response(503, "Too many event streams",
+                "Server has no room for more event streams, use change feed or try again later"
+            )
+            response.headers["Retry-After"] = str(current_app.config["EVENTS_RETRY_AFTER"])
+            return response
+
+        def generate():
+            yield b"retry: 3000\n\n"
+            for change in hub.subscribe(token, heartbeat):
+                yield format_event(change)
+
+        response = Response(generate(), 200, mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            #proxies must not buffer the stream
+            "X-Accel-Buffering": "no",
+        })
+        #server closes response also when stream was never read
+        response.call_on_close(hub.close_stream)
+        return response
+
+class UserImport(Resource):
+    def post(self):
+        if not request.is_json and request.mimetype != "text/csv":
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON or CSV"
+            )
+        try:
+            rows = read_import_rows()
+        except (ValueError, csv.Error) as e:
+            return create_error_response(400, "Invalid import", str(e))
+        if len(rows) > current_app.config["IMPORT_MAX_ROWS"]:
+            return create_error_response(413, "Too many users",
+                "At most {} users can be imported at once".format(current_app.config["IMPORT_MAX_ROWS"])
+            )
+
+        results = []
+        valid = []
+        for index, row in enumerate(rows):
+            try:
+                valid.append(validate_user_row(row))
+                results.append({"row": index, "status": 201})
+            except ValueError as e:
+                results.append({"row": index, "status": 400, "error": str(e)})
+
+        try:
+            ids = insert_users(valid)
+        except IntegrityError as e:
+            db.session.rollback()
+            return create_error_response(409, "Integrityerror, user import", str(e.orig))
+
+        created = iter(ids)
+        for result in results:
+            if result["status"] == 201:
+                result["id"] = next(created)
+                result["@controls"] = {"self": CONTROL_TEMPLATES["user"].stamp(result["id"])}
+
+        body = UserBuilder(created=len(ids), failed=len(results) - len(ids), items=results)
+        body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
+        body.add_control_template("collection", "users")
+        return Response(encode_body(body), 200, mimetype=MASON)
+
+class ExportCollection(Resource):
+    def get(self, entity):
+        if entity not in EXPORT_ENTITIES:
+            return create_error_response(404, "Not found",
+                "No export for {}, valid are: {}".format(entity, ", ".join(sorted(EXPORT_ENTITIES)))
+            )
+        return create_export_response(entity, request.args.get("format") == "json")
+
 class UserItem(Resource):
     def get(self,id):
-        db_user = User.query.filter_by(id=id).first()
+        try:
+            fields = read_fieldset(serializer.USER_ITEM_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid fields", str(e))
+        db_user = User.query.options(
+            load_fields(User, fields, "updated_at"), raiseload("*")
+        ).filter_by(id=id).first()
         if db_user is None:
             return create_error_response(404, "Not found", 
                 "No user was found with the id {}".format(id)
             )
+        version = ItemVersion(db_user.updated_at)
+        if version.is_not_modified():
+            return version.create_not_modified_response()
 
-        body = UserBuilder(
-            firstname=db_user.firstname,
-            lastname=db_user.lastname
-        )
+        body = UserBuilder(USER_FIELDS.serialize(db_user, fields))
+        if not wants_controls():
+            return version.add_headers(Response(encode_body(body), 200, mimetype=MASON))
         body.add_namespace("trainingmanager", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserItem, id=id))
-        body.add_control("collection", api.url_for(UserCollection))
+        body.add_control_template("self", "user", id)
+        body.add_control_template("collection", "users")
         body.add_control_delete_user(id)
         body.add_control_modify_user(id)
+        body.add_control_template("trainingmanager:usercourses", "user-courses", id)
 
-        #print(json.dumps(body))
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return version.add_headers(Response(encode_body(body), 200, mimetype=MASON))
 
     def put(self,id):
         db_user = User.query.filter_by(id=id).first()
@@ -493,35 +2177,308 @@ class UserItem(Resource):
         
         return Response(status=204)
 
+#control templates used by builders and collection items
+CONTROL_TEMPLATES = {
+    "users": ControlTemplate(UserCollection),
+    "user": ControlTemplate(UserItem, "id"),
+    "add-user": ControlTemplate(UserCollection,
+        method="POST", encoding="json", title="Add new user"),
+    "import-users": ControlTemplate(UserImport,
+        method="POST", encoding="json", title="Import list of users (JSON array or CSV)"),
+    "delete-user": ControlTemplate(UserItem, "id",
+        method="DELETE", title="Delete this user"),
+    "edit-user": ControlTemplate(UserItem, "id",
+        method="PUT", encoding="json", title="Edit this user"),
+    "courses": ControlTemplate(TrainingCourseCollection),
+    "course": ControlTemplate(TrainingCourseItem, "course"),
+    "add-course": ControlTemplate(TrainingCourseCollection,
+        method="POST", encoding="json", title="Add new course"),
+    "delete-course": ControlTemplate(TrainingCourseItem, "course",
+        method="DELETE", title="Delete this course"),
+    "edit-course": ControlTemplate(TrainingCourseItem, "course",
+        method="PUT", encoding="json", title="Edit this course"),
+    "course-content": ControlTemplate(CourseContentItem, "course"),
+    "edit-course-content": ControlTemplate(CourseContentItem, "course",
+        method="PUT", encoding="json", title="Replace course content"),
+    "course-stats": ControlTemplate(CourseStatsItem, "course"),
+    "completions": ControlTemplate(CompletionCollection),
+    "changes": ControlTemplate(ChangeCollection),
+    "events": ControlTemplate(EventStream),
+    "batch": ControlTemplate(BatchCollection,
+        method="POST", encoding="json", title="Run list of operations in one request"),
+    "course-users": ControlTemplate(CourseUserCollection, "course"),
+    "add-course-user": ControlTemplate(CourseUserCollection, "course",
+        method="POST", encoding="json", title="Add user to course"),
+    "user-courses": ControlTemplate(UserCourseCollection, "id"),
+    "course-medias": ControlTemplate(CourseMediaCollection, "course"),
+    "add-course-media": ControlTemplate(CourseMediaCollection, "course",
+        method="POST", encoding="json", title="Add media to course"),
+    "add-media": ControlTemplate(CourseMediaCollection, "course",
+        method="POST", encoding="json", title="Add new media"),
+    "media": ControlTemplate(MediaItem, "id"),
+}
+
 api.add_resource(UserCollection, "/api/users/")
+api.add_resource(UserImport, "/api/users/import/")
 api.add_resource(UserItem, "/api/users/<id>/")
 api.add_resource(TrainingCourseCollection, "/api/trainingcourses/")
 api.add_resource(TrainingCourseItem,"/api/trainingcourses/<course>/")
+api.add_resource(CourseContentItem, "/api/trainingcourses/<course>/content/")
+api.add_resource(CourseStatsItem, "/api/trainingcourses/<course>/stats/")
 api.add_resource(MediaItem, "/api/coursemedia/<id>/")
 #all medias from all cources, not implemented:
 #api.add_resource(MediaItemCollection, "/api/coursemedia/") 
 api.add_resource(CourseMediaCollection, "/api/trainingcourses/<course>/medias/")
+api.add_resource(CourseUserCollection, "/api/trainingcourses/<course>/users/")
+api.add_resource(UserCourseCollection, "/api/users/<id>/courses/")
+api.add_resource(ExportCollection, "/api/export/<entity>/")
+api.add_resource(CompletionCollection, "/api/completions/")
+api.add_resource(BatchCollection, "/api/batch/")
+api.add_resource(ChangeCollection, "/api/changes/")
+api.add_resource(EventStream, "/api/events/")
+
+def api_query_plans():
+    """
+    Sqlite query plans of queries which api uses to find rows by other than primary key
+    """
+    relation = courseuserrelation
+    queries = {
+        "course medias": CourseMedia.query.filter_by(course_id=1),
+        "course users": db.session.query(User.id, relation.c.addedtocourse).join(
+            relation, relation.c.userid == User.id
+        ).filter(relation.c.courseid == 1, relation.c.userid > 0).order_by(relation.c.userid).limit(10),
+        "user courses": db.session.query(TrainingCourse.id, relation.c.addedtocourse).join(
+            relation, relation.c.courseid == TrainingCourse.id
+        ).filter(relation.c.userid == 1, relation.c.courseid > 0).order_by(relation.c.courseid).limit(10),
+        "enrollment lookup": db.session.query(relation.c.userid).filter(
+            relation.c.courseid == 1, relation.c.userid.in_([1, 2])
+        ),
+        "user by email": User.query.filter_by(email="user@example.com"),
+        "courses by content": db.session.query(TrainingCourse.id).filter(
+            TrainingCourse.content_hash == hash_content("")
+        ),
+        "users page": User.query.filter(User.id > 0).order_by(User.id).limit(10),
+    }
+    conn = db.session.connection()
+    return dict((name, migrate.explain_query_plan(conn, query.statement)) for name, query in queries.items())
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """Create database tables (does nothing if tables already exist)."""
+    db.create_all()
+    print("database created")
+
+def migrate_course_content(conn):
+    """
+    Move course bodies from TrainingCourse.coursedatajson (old versions) to content store
+    """
+    columns = [column["name"] for column in inspect(conn).get_columns("TrainingCourse")]
+    if "coursedatajson" not in columns:
+        return []
+    rows = conn.execute(text(
+        'SELECT id, coursedatajson FROM "TrainingCourse" WHERE coursedatajson IS NOT NULL'
+    )).fetchall()
+    contents = dict((hash_content(body), body) for course_id, body in rows)
+    if contents:
+        conn.execute(sqlite_insert(CourseContent.__table__).on_conflict_do_nothing(),
+            [{"hash": content_hash, "body": body} for content_hash, body in contents.items()])
+        conn.execute(TrainingCourse.__table__.update().where(
+            TrainingCourse.id == bindparam("course_id")
+        ).values(content_hash=bindparam("new_hash")),
+            [{"course_id": course_id, "new_hash": hash_content(body)} for course_id, body in rows])
+    steps = ["moved {} course bodies ({} distinct) to CourseContent".format(len(rows), len(contents))]
+    return steps + migrate.drop_column(conn, "TrainingCourse", "coursedatajson")
+
+def migrate_course_stats(conn):
+    """
+    Fill course stats of database which had enrollments before stats tables
+    """
+    if conn.execute(select(func.count()).select_from(coursestats)).scalar():
+        return []
+    if not conn.execute(select(func.count()).select_from(courseuserrelation)).scalar():
+        return []
+    return ["computed stats of {} courses".format(rebuild_course_stats(conn))]
+
+def migrate_schema(engine):
+    return migrate.migrate_database(engine, db.metadata,
+        unique_rows=[("courseuserrelation", ("courseid", "userid"))],
+        data_steps=[migrate_course_content, migrate_course_stats]
+    )
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """Add missing tables, columns and indexes to existing database."""
+    steps = migrate_schema(db.engine)
+    for step in steps:
+        print(step)
+    print("database is up to date" if not steps else "migration done, {} steps".format(len(steps)))
+    for name, plan in api_query_plans().items():
+        print("{:20} {} {}".format(name, "ok" if migrate.uses_index(plan) else "NO INDEX", "; ".join(plan)))
+
+@click.command("seed")
+@click.option("--users", default=10000, help="Number of users.")
+@click.option("--courses", default=1000, help="Number of courses.")
+@click.option("--medias", default=10000, help="Number of medias, spread over new courses.")
+@click.option("--enrollments", default=100, help="Enrolled users per new course.")
+@click.option("--completion-rate", default=0.5, help="Share of enrollments with completion score.")
+@click.option("--seed", "seed_value", default=2019, help="Random seed, same seed gives same data.")
+@with_appcontext
+def seed_command(users, courses, medias, enrollments, completion_rate, seed_value):
+    """Fill database with synthetic data for load tests."""
+    start = datetime.now()
+    with db.engine.begin() as conn:
+        counts = seed_database(conn, users, courses, medias, enrollments, completion_rate, seed_value)
+    seconds = (datetime.now() - start).total_seconds()
+    print(", ".join("{} {}".format(count, name) for name, count in counts.items()))
+    print("{} rows in {:.1f} s".format(sum(counts.values()), seconds))
+
+@click.command("rebuild-stats")
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute course statistics from enrollments."""
+    with db.engine.begin() as conn:
+        courses = rebuild_course_stats(conn)
+    print("stats of {} courses rebuilt".format(courses))
+
+@click.command("compact-changes")
+@click.option("--retention", type=int, default=None, help="Keep changes of this many seconds (default from config).")
+@with_appcontext
+def compact_changes_command(retention):
+    """Remove old entries from change log."""
+    if retention is None:
+        retention = current_app.config["CHANGELOG_RETENTION"]
+    with db.engine.begin() as conn:
+        removed = compact_changelog(conn, retention)
+    print("{} changes removed".format(removed))
 
-@app.route(LINK_RELATIONS_URL)
 def send_link_relations():
     return "link relations"
 
 #todo debug only, remove all database content
-@app.route("/trainingmanager/truncate/")
 def delete_all_data():
     print("database tables data delete")
+    #relation and medias first, foreign keys are enforced
+    db.session.execute(courseuserrelation.delete())
+    db.session.query(CourseMedia).delete()
     db.session.query(User).delete()
+    db.session.execute(coursestats.delete())
+    db.session.execute(coursescorehistogram.delete())
+    db.session.execute(completionkey.delete())
     db.session.query(TrainingCourse).delete()
-    db.session.query(CourseMedia).delete()
+    db.session.query(CourseContent).delete()
     db.session.commit()
+    get_response_cache().clear()
 
     return Response("Database content deleted",status=200)
 
-@app.route("/trainingmanager/client/")
+def cache_stats():
+    return Response(encode_body(get_response_cache().stats()), 200, mimetype="application/json")
+
+def metrics_view():
+    """
+    Metrics of this worker process in Prometheus text format
+    """
+    gauges = []
+    pool = db.get_engine().pool
+    if hasattr(pool, "checkedout"):
+        gauges += [
+            ("db_pool_size", "gauge", "Connections kept in pool.", pool.size()),
+            ("db_pool_checked_out", "gauge", "Pool connections in use.", pool.checkedout()),
+            ("db_pool_checked_in", "gauge", "Idle pool connections.", pool.checkedin()),
+            ("db_pool_overflow", "gauge", "Connections opened over pool size.", max(pool.overflow(), 0)),
+        ]
+    stats = get_response_cache().stats()
+    gauges += [
+        ("cache_hits_total", "counter", "Response cache hits.", stats["hits"]),
+        ("cache_misses_total", "counter", "Response cache misses.", stats["misses"]),
+        ("cache_hit_ratio", "gauge", "Response cache hits per lookup.", stats["hit_ratio"]),
+        ("cache_entries", "gauge", "Responses in cache.", stats["size"]),
+    ]
+    completions = current_app.extensions["completion_queue"]
+    gauges += [
+        ("completion_queue_depth", "gauge", "Completion events waiting in write queue.", completions.depth()),
+        ("completion_events_written_total", "counter", "Completion events written.", completions.written),
+        ("completion_events_failed_total", "counter", "Completion events lost in failed writes.",
+            completions.failed),
+        ("completion_batches_total", "counter", "Completion event groups committed.", completions.batches),
+    ]
+    hub = current_app.extensions["event_hub"]
+    gauges += [
+        ("event_subscribers", "gauge", "Open change event streams.", hub.subscribers),
+        ("events_published_total", "counter", "Change events read for subscribers.", hub.published),
+    ]
+    return Response(current_app.extensions["metrics"].render(gauges), 200,
+        content_type="text/plain; version=0.0.4; charset=utf-8")
+
 def client_site():
     print("send client html")
-    return app.send_static_file("client.html")
+    return current_app.send_static_file("client.html")
 
-#create sqlite database (does nothing if database already exits)
-db.create_all()
+def dispose_engine_after_fork(app):
+    """
+    Call in worker process right after fork. Pooled sqlite connections and
+    sessions inherited from parent are dropped without closing them (closing
+    would release locks parent still holds), worker opens its own connections.
+    """
+    with app.app_context():
+        db.session.registry.clear()
+        db.get_engine().dispose(close=False)
+
+def create_app(config=None):
+    """
+    Create and configure app. Nothing touches database here, engine is created
+    when first needed and tables with "flask init-db".
+    """
+    app = Flask(__name__, static_folder="static")
+    app.config.update(DEFAULT_CONFIG)
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    api.init_app(app)
+    app.extensions["response_cache"] = ResponseCache(
+        app.config["RESPONSE_CACHE_SIZE"], app.config["RESPONSE_CACHE_TTL"]
+    )
+    #writer thread starts with first event
+    app.extensions["completion_queue"] = ingest.GroupCommitQueue(
+        functools.partial(write_completions, app),
+        app.config["COMPLETION_QUEUE_SIZE"],
+        app.config["COMPLETION_BATCH_SIZE"],
+        app.config["COMPLETION_FLUSH_MS"] / 1000.0,
+    )
+    app.after_request(add_query_count_header)
+    #first compaction after one interval, not on first write of every worker
+    app.extensions["changelog_compacted"] = {"at": time.monotonic()}
+    app.after_request(compact_changelog_after_write)
+    #reader thread starts with first subscriber
+    app.extensions["event_hub"] = eventhub.EventHub(
+        functools.partial(read_change_events, app),
+        app.config["EVENTS_BUFFER_SIZE"],
+        app.config["EVENTS_POLL_INTERVAL"],
+    )
+    app.after_request(notify_event_subscribers)
+    if app.config["PROFILING_ENABLED"] and app.config["PROFILE_DIR"]:
+        app.extensions["slowest_profiles"] = profiling.SlowestProfiles(
+            app.config["PROFILE_DIR"], app.config["PROFILE_SLOWEST"]
+        )
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    if app.config["METRICS_ENABLED"]:
+        app.extensions["metrics"] = metrics.Metrics()
+        app.before_request(start_request_metrics)
+        app.after_request(record_request_metrics)
+        app.add_url_rule("/trainingmanager/metrics", "metrics_view", metrics_view)
+
+    app.add_url_rule(LINK_RELATIONS_URL, "send_link_relations", send_link_relations)
+    app.add_url_rule("/trainingmanager/truncate/", "delete_all_data", delete_all_data)
+    app.add_url_rule("/trainingmanager/cache/", "cache_stats", cache_stats)
+    app.add_url_rule("/trainingmanager/client/", "client_site", client_site)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(compact_changes_command)
+    return app
 
@@ -0,0 +1,120 @@
+"""
+In-process cache for GET responses.
+
+Entries are kept in LRU order and expire after ttl seconds. Each entry has
+tags (for example "course:1"), write handlers invalidate the tags they change.
+
+Invalidation moves the cache generation forward. Response is stored only if
+none of its tags was invalidated after the generation read before handler
+ran, so a response built from rows read before a concurrent write does not
+get back into the cache.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class CachedResponse(object):
+    def __init__(self, status, headers, data, tags, expires):
+        self.status = status
+        self.headers = headers
+        self.data = data
+        self.tags = tags
+        self.expires = expires
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache with TTL, keyed by route and query string
+    """
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        #generation of last invalidation of each tag, oldest evicted first
+        self._invalidated = OrderedDict()
+        self._generation = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, status, headers, data, tags, generation=None):
+        """
+        Store response, skipped when a tag was invalidated after generation
+        """
+        with self._lock:
+            if generation is not None and self._is_stale(tags, generation):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CachedResponse(status, headers, data, tags,
+                time.monotonic() + self.ttl)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, *tags):
+        """
+        Remove all entries having any of the tags
+        """
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = self._generation
+            while len(self._invalidated) > self.maxsize:
+                tag, self._floor = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._invalidated.clear()
+            self._generation += 1
+            self._floor = self._generation
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _is_stale(self, tags, generation):
+        #generations of evicted tags are not known, any of them may be newer
+        if generation < self._floor:
+            return True
+        return any(self._invalidated.get(tag, 0) > generation for tag in tags)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -0,0 +1,169 @@
+"""
+Fan-out of change events to server-sent events subscribers.
+
+One reader thread per process reads new change log entries (read function)
+and appends them to a ring buffer. Subscribers do not have queues of their
+own: each remembers token of last event it sent and waits on one condition,
+so publishing an event is one append and one notify_all whatever number of
+subscribers. With gevent worker, threads and condition are greenlets and an
+idle subscriber costs a greenlet and a socket instead of an OS thread.
+
+Reader reads change log while there are subscribers, when woken by a write
+request of this process or every poll_interval (writes of other processes).
+Subscriber which is behind the oldest buffered event gets reset event and
+must sync again with change feed.
+
+Open streams are counted from request to close of response, so a worker
+whose streams hold request threads (gthread) can refuse more of them.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class EventHub(object):
+    def __init__(self, read, capacity=1000, poll_interval=1.0):
+        """
+        read(token) returns (newest token, events) where events is list of
+        (token, data) after token, or None when events after token are no
+        longer available. Token None means start from newest.
+        """
+        self.read = read
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.subscribers = 0
+        self.published = 0
+        self.streams = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.subscribers = 0
+        self.streams = 0
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._events = deque(maxlen=self.capacity)
+        self._condition = threading.Condition()
+        self._wakeup = threading.Event()
+        self._token = None
+        self._floor = None
+        self._thread = threading.Thread(target=self._run, name="event-hub-reader", daemon=True)
+        self._thread.start()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+
+    def open_stream(self, limit=None):
+        """
+        Count stream opened by request, False when limit streams are already open
+        """
+        with self._lock:
+            if limit is not None and self.streams >= limit:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self.streams -= 1
+
+    def notify(self):
+        """
+        Wake reader after write, does nothing when nobody listens
+        """
+        if self._pid == os.getpid() and self.subscribers:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self.subscribers:
+                continue
+            try:
+                self._read()
+            except Exception:
+                logger.exception("reading change events failed")
+
+    def _read(self):
+        newest, events = self.read(self._token)
+        with self._condition:
+            if self._token is None or events is None:
+                #first read, or log was compacted past reader: buffer starts from newest
+                self._events.clear()
+                self._floor = newest
+                events = []
+            elif newest == self._token:
+                return
+            for event in events:
+                if len(self._events) == self.capacity:
+                    self._floor = self._events[0][0]
+                self._events.append(event)
+            self._token = newest
+            self.published += len(events)
+            self._condition.notify_all()
+        if events:
+            #more may be waiting than one read returns
+            self._wakeup.set()
+
+    def _events_after(self, token):
+        events = []
+        for event in reversed(self._events):
+            if event[0] <= token:
+                break
+            events.append(event)
+        events.reverse()
+        return events
+
+    def subscribe(self, token=None, heartbeat=15.0):
+        """
+        Generator of events after token: (token, data) for event, (token, None)
+        when events after given token are not available (subscriber must sync
+        again and continue from returned token) and None as heartbeat when
+        nothing happened in heartbeat seconds. Token None starts from now.
+        """
+        self._ensure_started()
+        with self._condition:
+            self.subscribers += 1
+        self._wakeup.set()
+        try:
+            sent = time.monotonic()
+            while True:
+                events = None
+                with self._condition:
+                    if self._token is not None:
+                        if token is None:
+                            token = self._token
+                        if token < self._floor or token > self._token:
+                            token = self._token
+                            events = [(token, None)]
+                        else:
+                            events = self._events_after(token)
+                    if not events:
+                        remaining = sent + heartbeat - time.monotonic()
+                        if remaining > 0:
+                            self._condition.wait(remaining)
+                            continue
+                if not events:
+                    events = [None]
+                for event in events:
+                    if event is not None:
+                        token = event[0]
+                    yield event
+                sent = time.monotonic()
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+                if not self.subscribers:
+                    #reader stops, next subscriber starts buffer again from newest
+                    self._token = None
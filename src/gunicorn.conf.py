@@ -0,0 +1,39 @@
+"""
+Gunicorn settings for running the app: gunicorn -c gunicorn.conf.py wsgi:app
+
+Sqlite allows one writer at a time, more workers add read capacity only.
+Keep threads at most pool_size of storage profile (5 in production profile),
+otherwise request threads wait for pooled connections.
+"""
+import os
+import importlib.util
+
+bind = os.environ.get("TRAININGMANAGER_BIND", "127.0.0.1:8000")
+#two workers per cpu core is enough, writes are serialized by sqlite anyway
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * os.cpu_count()))
+#with gthread every open event stream (/api/events/) holds a thread of its worker,
+#gevent worker serves idle streams as greenlets, up to worker_connections per worker.
+#gevent is used when it is installed (pip install gevent)
+default_worker_class = "gevent" if importlib.util.find_spec("gevent") else "gthread"
+worker_class = os.environ.get("TRAININGMANAGER_WORKER_CLASS", default_worker_class)
+threads = int(os.environ.get("TRAININGMANAGER_THREADS", 4))
+worker_connections = int(os.environ.get("TRAININGMANAGER_CONNECTIONS", 1000))
+if worker_class == "gthread":
+    #streams may take all but one thread of worker, others get 503 (see wsgi.py)
+    event_streams = os.environ.get("TRAININGMANAGER_EVENT_STREAMS", max(threads - 1, 0))
+    raw_env = ["TRAININGMANAGER_EVENT_STREAMS={}".format(event_streams)]
+#import app once in master, workers share its memory after fork. gevent patches
+#threading when worker starts, so with it app is imported in worker after that
+preload_app = worker_class != "gevent"
+timeout = 30
+
+
+def post_fork(server, worker):
+    #engine (and sessions) of master must not be used by workers. Without preload
+    #there is nothing to drop, and importing here would create app before gevent
+    #worker patches threading (post_fork runs before worker init_process)
+    if not server.cfg.preload_app:
+        return
+    from app import dispose_engine_after_fork
+    from wsgi import app
+    dispose_engine_after_fork(app)
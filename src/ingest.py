@@ -0,0 +1,122 @@
+"""
+In-process write queue with group commit.
+
+Request handlers put events to bounded queue and return at once. One writer
+thread takes events from queue and passes them to write function in groups:
+group is written when it has batch_size events or flush_interval seconds
+have passed since its first event, so sqlite commits once per group instead
+of once per event. Full queue is reported to caller (backpressure). Failed
+group is tried again (database may be locked for a while), after that its
+events are written one at a time, so one bad event does not drop the rest.
+
+Writer thread is started when first event arrives. Forked worker process
+does not have the thread of its parent, so queue and thread are created
+again in new process.
+"""
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+class GroupCommitQueue(object):
+    def __init__(self, write, maxsize=10000, batch_size=500, flush_interval=0.05,
+            retries=2, retry_delay=0.1):
+        self.write = write
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        #lock may be held by request thread of parent when process is forked
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.maxsize)
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush, 5)
+
+    def submit(self, events):
+        """
+        Queue all events or none of them, raises QueueFull when there is no room
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            #only writer thread takes from queue, so room can not shrink here
+            if self.maxsize - self._queue.qsize() < len(events):
+                raise QueueFull()
+            for event in events:
+                self._queue.put_nowait(event)
+
+    def depth(self):
+        if self._pid != os.getpid():
+            return 0
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """
+        Wait until queued events are written
+        """
+        if self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _write(self, batch, retries):
+        """
+        Write events, tried retries more times with growing delay, returns True when written
+        """
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.write(batch)
+                self.written += len(batch)
+                return True
+            except Exception:
+                logger.exception("writing %d queued events failed (attempt %d)", len(batch), attempt + 1)
+        return False
+
+    def _run(self):
+        events_queue = self._queue
+        while True:
+            batch = [events_queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(events_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if not self._write(batch, self.retries):
+                for event in batch:
+                    if not self._write([event], 0):
+                        self.failed += 1
+            self.batches += 1
+            for event in batch:
+                events_queue.task_done()
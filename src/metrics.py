@@ -0,0 +1,109 @@
+"""
+Request, sql and cache metrics in Prometheus text format.
+
+Counters are sharded per thread: each request thread increments its own dict
+without locking, scrape sums the shards. Lock is taken only when a new thread
+gets its shard. Metrics are per worker process, with several workers each
+one reports its own values.
+"""
+import bisect
+import threading
+
+#upper bounds of request latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PREFIX = "trainingmanager_"
+
+
+class ShardedCounters(object):
+    """
+    Counters keyed by any hashable key, one shard dict per thread
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def inc(self, key, amount=1):
+        shard = self.shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._shards)
+        totals = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels) + "}"
+
+class Metrics(object):
+    def __init__(self):
+        self.counters = ShardedCounters()
+
+    def observe_request(self, resource, method, status, seconds):
+        shard = self.counters.shard()
+        for key in (
+            ("requests", resource, method, status),
+            ("latency_bucket", resource, method, bisect.bisect_left(LATENCY_BUCKETS, seconds)),
+            ("latency_count", resource, method),
+        ):
+            shard[key] = shard.get(key, 0) + 1
+        key = ("latency_sum", resource, method)
+        shard[key] = shard.get(key, 0) + seconds
+
+    def observe_statement(self, statement):
+        self.counters.inc(("sql", statement.split(None, 1)[0].upper()))
+
+    def render(self, gauges=()):
+        """
+        Metrics text, gauges are (name, type, help, value) measured at scrape time
+        """
+        totals = self.counters.totals()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append("# HELP {}{} {}".format(PREFIX, name, help_text))
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+
+        def sample(name, labels, value):
+            lines.append("{}{}{} {}".format(PREFIX, name, format_labels(labels), value))
+
+        family("requests_total", "counter", "Requests by resource class, method and status.")
+        for key in sorted(k for k in totals if k[0] == "requests"):
+            sample("requests_total", (("resource", key[1]), ("method", key[2]), ("status", key[3])),
+                totals[key])
+
+        family("request_duration_seconds", "histogram", "Request latency by resource class and method.")
+        for key in sorted(k for k in totals if k[0] == "latency_count"):
+            labels = (("resource", key[1]), ("method", key[2]))
+            cumulative = 0
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                cumulative += totals.get(("latency_bucket", key[1], key[2], index), 0)
+                sample("request_duration_seconds_bucket", labels + (("le", bound),), cumulative)
+            sample("request_duration_seconds_bucket", labels + (("le", "+Inf"),), totals[key])
+            sample("request_duration_seconds_sum", labels, totals[("latency_sum", key[1], key[2])])
+            sample("request_duration_seconds_count", labels, totals[key])
+
+        family("sql_statements_total", "counter", "SQL statements executed, by statement type.")
+        for key in sorted(k for k in totals if k[0] == "sql"):
+            sample("sql_statements_total", (("statement", key[1]),), totals[key])
+
+        for name, kind, help_text, value in gauges:
+            family(name, kind, help_text)
+            sample(name, (), value)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,104 @@
+"""
+Schema migration for existing sqlite database files.
+
+Brings database created by older version up to current models: creates missing
+tables, adds missing columns, runs data steps of app (moving data to new
+tables), removes duplicate enrollments (so unique index can be created) and
+creates missing indexes. Every step checks current schema first, so running
+migration again does nothing.
+"""
+from sqlalchemy import inspect, text
+
+
+def create_missing_tables(conn, metadata):
+    steps = []
+    inspector = inspect(conn)
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            table.create(bind=conn)
+            steps.append("created table {}".format(table.name))
+    return steps
+
+def add_missing_columns(conn, metadata):
+    steps = []
+    inspector = inspect(conn)
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            coltype = column.type.compile(dialect=conn.dialect)
+            conn.execute(text('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                table.name, column.name, coltype)))
+            steps.append("added column {}.{}".format(table.name, column.name))
+    return steps
+
+def remove_duplicate_rows(conn, table, columns):
+    """
+    Keep first row (lowest rowid) of rows having same values in columns
+    """
+    column_list = ", ".join('"{}"'.format(name) for name in columns)
+    result = conn.execute(text(
+        'DELETE FROM "{0}" WHERE rowid NOT IN '
+        '(SELECT min(rowid) FROM "{0}" GROUP BY {1})'.format(table, column_list)
+    ))
+    if result.rowcount:
+        return ["removed {} duplicate rows from {}".format(result.rowcount, table)]
+    return []
+
+def create_missing_indexes(conn, metadata):
+    steps = []
+    inspector = inspect(conn)
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            index.create(bind=conn)
+            steps.append("created index {}".format(index.name))
+    return steps
+
+def drop_column(conn, table, column):
+    """
+    Drop column (sqlite 3.35+), older sqlite can only empty it
+    """
+    if conn.dialect.dbapi.sqlite_version_info >= (3, 35, 0):
+        conn.execute(text('ALTER TABLE "{}" DROP COLUMN "{}"'.format(table, column)))
+        return ["dropped column {}.{}".format(table, column)]
+    conn.execute(text('UPDATE "{}" SET "{}" = NULL'.format(table, column)))
+    return ["emptied column {}.{}".format(table, column)]
+
+def migrate_database(engine, metadata, unique_rows=(), data_steps=()):
+    """
+    Migrate database in one transaction. unique_rows lists (table name, columns)
+    to deduplicate before unique indexes are created, data_steps are functions
+    (conn) -> steps run after tables and columns exist. Returns performed steps.
+    """
+    steps = []
+    with engine.begin() as conn:
+        steps += create_missing_tables(conn, metadata)
+        steps += add_missing_columns(conn, metadata)
+        for data_step in data_steps:
+            steps += data_step(conn)
+        for table, columns in unique_rows:
+            steps += remove_duplicate_rows(conn, table, columns)
+        steps += create_missing_indexes(conn, metadata)
+    return steps
+
+def explain_query_plan(conn, statement):
+    """
+    Sqlite query plan lines for compiled SQLAlchemy statement
+    """
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled))
+    return [row[-1] for row in rows]
+
+def uses_index(plan):
+    """
+    True if every table in query plan is searched with index (or primary key), none is scanned
+    """
+    return all(not line.startswith("SCAN") for line in plan)
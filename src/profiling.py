@@ -0,0 +1,125 @@
+"""
+Opt-in per-request profiling.
+
+When enabled, each request gets RequestProfile (in flask.g) which collects time
+spent in SQL execution (cursor events) and in response serialization, the
+rest of handler time is body construction (ORM objects and Mason building).
+Times are sent in Server-Timing header. With dump directory set, requests are
+also run under cProfile and stats of the slowest ones are kept on disk.
+"""
+import os
+import re
+import heapq
+import itertools
+import cProfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+
+class RequestProfile(object):
+    def __init__(self, profiler=None):
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.queries = 0
+        self.serialize = 0.0
+        self.profiler = profiler
+
+    def server_timing(self, total):
+        """
+        Server-Timing header value, durations in milliseconds
+        """
+        build = max(total - self.db - self.serialize, 0.0)
+        return ", ".join([
+            'db;dur={:.2f};desc="SQL ({} queries)"'.format(self.db * 1000, self.queries),
+            'build;dur={:.2f};desc="Body construction"'.format(build * 1000),
+            'serialize;dur={:.2f};desc="Serialization"'.format(self.serialize * 1000),
+            'total;dur={:.2f}'.format(total * 1000),
+        ])
+
+def current_profile():
+    if has_request_context():
+        return g.get("profile")
+    return None
+
+@contextmanager
+def timed_serialize():
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.serialize += time.perf_counter() - start
+
+def query_started(conn):
+    if current_profile() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+def query_finished(conn):
+    profile = current_profile()
+    starts = conn.info.get("profile_query_start")
+    if profile is not None and starts:
+        profile.db += time.perf_counter() - starts.pop()
+        profile.queries += 1
+
+class SlowestProfiles(object):
+    """
+    Keeps cProfile stats files of the slowest requests in directory,
+    file of faster request is removed when slower one takes its place
+    """
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self._slowest = []
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+
+    def is_slow(self, duration):
+        return len(self._slowest) < self.keep or duration > self._slowest[0][0]
+
+    def add(self, duration, method, path, profiler):
+        name = "{:.0f}ms-{}-{}-{}-{}.prof".format(duration * 1000, method,
+            re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_"), os.getpid(), next(self._sequence))
+        filename = os.path.join(self.directory, name)
+        with self._lock:
+            if not self.is_slow(duration):
+                return
+            profiler.dump_stats(filename)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, (duration, filename))
+                return
+            faster = heapq.heapreplace(self._slowest, (duration, filename))
+        if faster[1] != filename:
+            try:
+                os.remove(faster[1])
+            except OSError:
+                pass
+
+    def files(self):
+        with self._lock:
+            return [filename for duration, filename in sorted(self._slowest, reverse=True)]
+
+def start_request(profiles):
+    profiler = None
+    if profiles is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    g.profile = RequestProfile(profiler)
+
+def finish_request(profiles, method, path, response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    if profile.profiler is not None:
+        profile.profiler.disable()
+    total = time.perf_counter() - profile.start
+    response.headers["Server-Timing"] = profile.server_timing(total)
+    if profile.profiler is not None and profiles.is_slow(total):
+        profiles.add(total, method, path, profile.profiler)
+    return response
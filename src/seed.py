@@ -0,0 +1,147 @@
+"""
+Synthetic data for load tests and benchmarks.
+
+Rows are generated from seeded random generator, so same arguments always
+give same data. Rows are written as tuples with driver executemany in chunks
+inside one transaction (SQLAlchemy type processing per value would take most
+of the time), new ids continue after largest existing id of each table.
+"""
+import json
+import random
+import hashlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+CHUNK_SIZE = 20000
+START_DATE = datetime(2019, 8, 1)
+MEDIA_TYPES = ("image", "video", "document")
+
+USER_COLUMNS = ("id", "firstname", "lastname", "email", "isAdmin", "creationdate", "updated_at")
+CONTENT_COLUMNS = ("hash", "body")
+COURSE_COLUMNS = ("id", "name", "creationdate", "startdate", "enddate", "content_hash", "updated_at")
+MEDIA_COLUMNS = ("id", "url", "type", "course_id", "updated_at")
+ENROLLMENT_COLUMNS = ("courseid", "userid", "addedtocourse", "canModify",
+    "courseCompletionScore", "courseCompletionDate")
+
+
+def sqlite_datetime(value):
+    """
+    Datetime in format SQLAlchemy DateTime stores to sqlite
+    """
+    return value.isoformat(" ", "microseconds")
+
+#dates used in generated rows, formatted once
+DAYS = [sqlite_datetime(START_DATE + timedelta(days=day)) for day in range(500)]
+
+def insert_chunked(conn, table, columns, rows, verb="INSERT"):
+    """
+    Insert row tuples (values in columns order), returns number of rows
+    """
+    statement = '{} INTO "{}" ({}) VALUES ({})'.format(
+        verb, table.name,
+        ", ".join('"{}"'.format(name) for name in columns),
+        ", ".join("?" for name in columns),
+    )
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            conn.exec_driver_sql(statement, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        conn.exec_driver_sql(statement, chunk)
+        count += len(chunk)
+    return count
+
+def next_id(conn, table):
+    return (conn.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+def user_rows(first, count, rnd):
+    for i in range(first, first + count):
+        yield (
+            i,
+            "first-{}".format(i),
+            "last-{}".format(i),
+            "user-{}@example.com".format(i),
+            rnd.random() < 0.01,
+            DAYS[i % 365],
+            DAYS[0],
+        )
+
+def course_rows(first, count, contents, rnd):
+    """
+    Course rows, bodies of courses are added to contents (hash -> body)
+    """
+    for i in range(first, first + count):
+        start = rnd.randint(0, 365)
+        body = json.dumps({"chapters": rnd.randint(1, 20)})
+        #same hash as app.hash_content
+        content_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+        contents[content_hash] = body
+        yield (
+            i,
+            "course-{}".format(i),
+            DAYS[0],
+            DAYS[start],
+            DAYS[start + rnd.randint(7, 90)],
+            content_hash,
+            DAYS[0],
+        )
+
+def media_rows(first, count, course_ids, rnd):
+    for i in range(first, first + count):
+        yield (
+            i,
+            "https://example.com/media/{}".format(i),
+            rnd.choice(MEDIA_TYPES),
+            rnd.choice(course_ids) if course_ids else None,
+            DAYS[0],
+        )
+
+def enrollment_rows(course_ids, user_ids, per_course, completion_rate, rnd):
+    per_course = min(per_course, len(user_ids))
+    for course in course_ids:
+        for userid in sorted(rnd.sample(user_ids, per_course)):
+            added = rnd.randint(0, 365)
+            if rnd.random() < completion_rate:
+                score = rnd.randint(0, 100)
+                completed = DAYS[added + rnd.randint(1, 60)]
+            else:
+                score = completed = None
+            yield (course, userid, DAYS[added], rnd.random() < 0.05, score, completed)
+
+def seed_database(conn, metadata, users=0, courses=0, medias=0, enrollments=0,
+        completion_rate=0.5, seed=2019):
+    """
+    Insert synthetic rows. Medias are spread over new courses, each new course
+    gets enrollments (per course) of distinct new users, completion_rate of
+    them have completion score and date. Returns inserted row counts.
+    """
+    rnd = random.Random(seed)
+    user_table = metadata.tables["User"]
+    course_table = metadata.tables["TrainingCourse"]
+    content_table = metadata.tables["CourseContent"]
+    media_table = metadata.tables["CourseMedia"]
+    relation_table = metadata.tables["courseuserrelation"]
+
+    first_user = next_id(conn, user_table)
+    first_course = next_id(conn, course_table)
+    first_media = next_id(conn, media_table)
+    user_ids = range(first_user, first_user + users)
+    course_ids = range(first_course, first_course + courses)
+    #courses refer to their content, so content rows are inserted first
+    contents = {}
+    new_courses = list(course_rows(first_course, courses, contents, rnd))
+    insert_chunked(conn, content_table, CONTENT_COLUMNS, contents.items(), "INSERT OR IGNORE")
+    return {
+        "users": insert_chunked(conn, user_table, USER_COLUMNS,
+            user_rows(first_user, users, rnd)),
+        "courses": insert_chunked(conn, course_table, COURSE_COLUMNS, new_courses),
+        "medias": insert_chunked(conn, media_table, MEDIA_COLUMNS,
+            media_rows(first_media, medias, course_ids, rnd)),
+        "enrollments": insert_chunked(conn, relation_table, ENROLLMENT_COLUMNS,
+            enrollment_rows(course_ids, user_ids, enrollments, completion_rate, rnd)),
+    }
@@ -0,0 +1,101 @@
+"""
+Serializer for api responses.
+
+Each model has a field spec (field name and type). Bodies are encoded with
+orjson when it is installed, otherwise with stdlib json. Datetimes are always
+written as ISO-8601 strings.
+"""
+import json
+from datetime import datetime, date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _iso(value):
+    return value.isoformat()
+
+#converters for field types which json can not write as such
+CONVERTERS = {
+    datetime: _iso,
+    date: _iso,
+}
+
+class FieldSpec(object):
+    """
+    Serialized fields of one model, keyword arguments are field name=type
+    """
+    def __init__(self, **fields):
+        self.fields = fields
+        self.names = tuple(fields)
+
+    def serialize(self, obj, names=None):
+        """
+        Read fields (all or given names) from model object to dict
+        """
+        result = {}
+        for name in self.names if names is None else names:
+            value = getattr(obj, name)
+            convert = CONVERTERS.get(self.fields[name])
+            if convert is not None and value is not None:
+                value = convert(value)
+            result[name] = value
+        return result
+
+USER_FIELDS = FieldSpec(
+    id=int,
+    firstname=str,
+    lastname=str,
+    email=str,
+    isAdmin=bool,
+    creationdate=datetime,
+)
+
+COURSE_FIELDS = FieldSpec(
+    id=int,
+    name=str,
+    creationdate=datetime,
+    startdate=datetime,
+    enddate=datetime,
+    coursedatajson=str,
+)
+
+MEDIA_FIELDS = FieldSpec(
+    id=int,
+    url=str,
+    type=str,
+)
+
+ENROLLMENT_FIELDS = FieldSpec(
+    addedtocourse=datetime,
+    canModify=bool,
+    courseCompletionScore=int,
+    courseCompletionDate=datetime,
+)
+
+#fields shown in collection listings and item views
+USER_COLLECTION_FIELDS = ("id", "firstname", "lastname", "email")
+USER_ITEM_FIELDS = ("id", "firstname", "lastname", "email")
+COURSE_COLLECTION_FIELDS = ("id", "name", "creationdate", "startdate", "enddate")
+#course body (coursedatajson) is served by content resource, items have it only when asked
+COURSE_ITEM_FIELDS = ("id", "name")
+MEDIA_ITEM_FIELDS = ("id", "url", "type")
+#enrolled users of course and courses of user, with enrollment fields
+COURSE_USER_FIELDS = ("id", "firstname", "lastname") + ENROLLMENT_FIELDS.names
+USER_COURSE_FIELDS = ("id", "name") + ENROLLMENT_FIELDS.names
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+def dumps(body):
+    """
+    Encode body (dicts, lists, MasonBuilders) to json bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(body, default=_default)
+    return json.dumps(body, default=_default, separators=(",", ":")).encode("utf-8")
@@ -7,6 +7,12 @@ const PLAINJSON = "application/json";
 //these could be read from /api/ root control
 const USERS_URL = "http://localhost:5000/api/users/"
 const COURSES_URL = "http://localhost:5000/api/trainingcourses/"
+const BATCH_URL = "http://localhost:5000/api/batch/"
+const CHANGES_URL = "http://localhost:5000/api/changes/"
+const EVENTS_URL = "http://localhost:5000/api/events/"
+
+//change token of loaded lists, refresh fetches only changes after it
+let changeToken = null;
 
 function renderError(error) {
     $("#notificationarea").append("<p class='error'>" + error.status +" "+ error.statusText + "</p>");
@@ -97,8 +103,11 @@ function renderCourse(body) {
 	//$("#courseview").append("<h5>"+JSON.stringify(body)+"</h5>")
 	
 	let htmlObject = document.createElement('div');
-	htmlObject.innerHTML=body.coursedatajson;
 	$("#courseview").append(htmlObject);	
+	//course body is loaded from its own resource
+	getResource(body["@controls"]["trainingmanager:coursecontent"]["href"], function(content) {
+		htmlObject.innerHTML=content.coursedatajson;
+	});
 	for (let [key, value] of Object.entries(body.medialist)) {
 
 		$("#courseview").append("<img class='courseimagethumb' src='"+value.url+"'></img>")
@@ -125,40 +134,29 @@ function renderUserList() {
 
 }
 
-function userAdded(data, status, jqxhr)
-{
-	let href = jqxhr.getResponseHeader("Location");
-	renderMsg("User added : "+href)
-	loadUserList()
-}
+const TEST_MEDIAS = [
+	{"url":"https://cdn.pixabay.com/photo/2019/08/15/23/55/light-bulb-4409116_960_720.jpg","type":"image"},
+	{"url":"https://cdn.pixabay.com/photo/2019/08/30/18/43/mountains-4441978_960_720.jpg","type":"image"},
+	{"url":"https://cdn.pixabay.com/photo/2013/11/28/10/36/road-220058_960_720.jpg","type":"image"}
+];
 
-function courseAdded(data, status, jqxhr)
+function testDataAdded(data, status, jqxhr)
 {
-	let href = jqxhr.getResponseHeader("Location");
-	renderMsg("Course added : "+href+" id:"+data)
-	addTestMediasToCourse(data);
-	loadCourseList()
+	for (let result of data.results) {
+		if (result.location) {
+			renderMsg("Added : "+result.location)
+		} else if (result.body && result.body.items) {
+			mediasAdded(result.body)
+		}
+	}
+	loadChanges()
 }
 
-//add some test images to course with the api
-function addTestMediasToCourse(courseid)
-{
-	let MEDIA_URL = "/api/trainingcourses/"+courseid+"/medias/";
-	let data = {"url":"https://cdn.pixabay.com/photo/2019/08/15/23/55/light-bulb-4409116_960_720.jpg","type":"image"}
-	sendData(MEDIA_URL, "POST", data, mediaAdded);
-	data = {"url":"https://cdn.pixabay.com/photo/2019/08/30/18/43/mountains-4441978_960_720.jpg","type":"image"}
-	sendData(MEDIA_URL, "POST", data, mediaAdded);
-	data = {"url":"https://cdn.pixabay.com/photo/2013/11/28/10/36/road-220058_960_720.jpg","type":"image"}
-	sendData(MEDIA_URL, "POST", data, mediaAdded);
-	//https://cdn.pixabay.com/photo/2019/08/30/18/43/mountains-4441978_960_720.jpg
-	//https://cdn.pixabay.com/photo/2019/08/15/23/55/light-bulb-4409116_960_720.jpg
-	//https://cdn.pixabay.com/photo/2013/11/28/10/36/road-220058_960_720.jpg
-}
-
-function mediaAdded(data, status, jqxhr)
+function mediasAdded(data)
 {
-	let href = jqxhr.getResponseHeader("Location");
-	renderMsg("Media added : "+href)	
+	for (let item of data.items) {
+		renderMsg("Media added : "+item["@controls"]["self"]["href"])
+	}
 }
 
 function loadUserList()
@@ -174,21 +172,137 @@ function loadCourseList()
 function usersLoaded(data, status, jqxhr)
 {
 	$("#usertablebody").empty();
+	usersPageLoaded(data, status, jqxhr);
+}
+
+//collections are paged, append page rows and follow next control
+function usersPageLoaded(data, status, jqxhr)
+{
 	//console.log(data.items)
 	for (let [key, value] of Object.entries(data.items)) {
     	//console.log(key, value);
-    	$("#usertablebody").append("<tr><td>"+value.firstname+"</td><td>"+value.lastname+"</td><td><a class='btn btn-primary' type='button' href='"+value["@controls"]["self"]["href"]+"' onClick='followLink(event, this, renderUser)'>Select user</a></td>");
+    	$("#usertablebody").append(userRow(value));
+	}
+	if ("next" in data["@controls"]) {
+		getResource(data["@controls"]["next"]["href"], usersPageLoaded);
 	}
 }
 
 function coursesLoaded(data, status, jqxhr)
 {
 	$("#coursetablebody").empty();
+	coursesPageLoaded(data, status, jqxhr);
+}
+
+function coursesPageLoaded(data, status, jqxhr)
+{
 	//console.log(data.items)
 	for (let [key, value] of Object.entries(data.items)) {
     	//console.log(key, value);
-    	$("#coursetablebody").append("<tr><td>"+value.name+"</td><td><a class='btn btn-primary' type='button' href='"+value["@controls"]["self"]["href"]+"' onClick='followLink(event, this, renderCourse)'>Open course</a></td>");
+    	$("#coursetablebody").append(courseRow(value));
+	}
+	if ("next" in data["@controls"]) {
+		getResource(data["@controls"]["next"]["href"], coursesPageLoaded);
+	}
+}
+
+function userRow(value)
+{
+	return "<tr id='user-"+value.id+"'><td>"+value.firstname+"</td><td>"+value.lastname+"</td><td><a class='btn btn-primary' type='button' href='"+value["@controls"]["self"]["href"]+"' onClick='followLink(event, this, renderUser)'>Select user</a></td>";
+}
+
+function courseRow(value)
+{
+	return "<tr id='course-"+value.id+"'><td>"+value.name+"</td><td><a class='btn btn-primary' type='button' href='"+value["@controls"]["self"]["href"]+"' onClick='followLink(event, this, renderCourse)'>Open course</a></td>";
+}
+
+//replace, add or remove table row of changed user or course
+function applyChange(change)
+{
+	let tablebody = {"user": "#usertablebody", "course": "#coursetablebody"}[change.entity];
+	if (!tablebody) {
+		return;
+	}
+	let row = $("#"+change.entity+"-"+change.id);
+	if (change.operation == "delete") {
+		row.remove();
+		return;
+	}
+	let html = change.entity == "user" ? userRow(change.item) : courseRow(change.item);
+	if (row.length) {
+		row.replaceWith(html);
+	} else {
+		$(tablebody).append(html);
+	}
+}
+
+//token is taken before lists are loaded, so no change falls between
+function loadAll()
+{
+	getResource(CHANGES_URL, function(data) {
+		changeToken = data.token;
+		loadUserList();
+		loadCourseList();
+		listenChanges();
+	});
+}
+
+//server pushes changes, browser reconnects by itself and continues from last event id
+let changeEvents = null;
+function listenChanges()
+{
+	if (changeEvents !== null || !window.EventSource) {
+		return;
 	}
+	changeEvents = new EventSource(EVENTS_URL+"?since="+changeToken);
+	changeEvents.addEventListener("change", function(event) {
+		let change = JSON.parse(event.data);
+		applyChange(change);
+		changeToken = Math.max(changeToken, change.token);
+	});
+	//server could not send all changes, fetch missed ones from change feed
+	changeEvents.addEventListener("reset", function(event) {
+		loadChanges();
+	});
+	//server refused stream (503, too many streams), browser does not reconnect then
+	changeEvents.addEventListener("error", function(event) {
+		if (changeEvents.readyState === EventSource.CLOSED) {
+			changeEvents = null;
+			setTimeout(function() {
+				loadChanges();
+				listenChanges();
+			}, 30000);
+		}
+	});
+}
+
+function loadChanges()
+{
+	if (changeToken === null) {
+		loadAll();
+		return;
+	}
+	$.ajax({
+		url: CHANGES_URL+"?since="+changeToken,
+		success: function(data) {
+			for (let change of data.items) {
+				applyChange(change);
+			}
+			changeToken = data.token;
+			renderMsg(data.items.length+" changes")
+			if (data.more) {
+				loadChanges();
+			}
+		},
+		error: function(error) {
+			//token is older than change log, load everything again
+			if (error.status == 410) {
+				loadAll();
+			} else {
+				renderError(error);
+			}
+		}
+	});
 }
 
 function dataDeleted(data, status, jqxhr)
@@ -209,19 +323,22 @@ $(document).ready(function () {
    $('#createData').on('click', function(event) 
 	{
 		console.log("Create test data");
-		renderMsg("Creating test users...")		
-		let data = {"firstname":"testuser"+Math.floor((Math.random() * 10000) + 1),"lastname":"testuser"+Math.floor((Math.random() * 10000) + 1),"isAdmin":true};
-		sendData(USERS_URL, "POST", data, userAdded);
-		data = {"firstname":"testuser"+Math.floor((Math.random() * 10000) + 1),"lastname":"testuser"+Math.floor((Math.random() * 10000) + 1),"isAdmin":false};
-		sendData(USERS_URL, "POST", data, userAdded);
-		data = {"firstname":"testuser"+Math.floor((Math.random() * 10000) + 1),"lastname":"testuser"+Math.floor((Math.random() * 10000) + 1),"isAdmin":false};
-		sendData(USERS_URL, "POST", data, userAdded);
-		data = {"firstname":"testuser"+Math.floor((Math.random() * 10000) + 1),"lastname":"testuser"+Math.floor((Math.random() * 10000) + 1),"isAdmin":false};
-		sendData(USERS_URL, "POST", data, userAdded);
-
-		data = {"name":"Test course "+Math.floor((Math.random() * 10000) + 1)};
-		data["coursedatajson"]="<p><h5>This is example course introduction title</h5></p><p>Real course or other training would be introduced here.</p>";
-		sendData(COURSES_URL, "POST", data, courseAdded);
+		renderMsg("Creating test data...")
+		//users, course and its medias in one batch request, medias refer to id of new course
+		let operations = [];
+		for (let i = 0; i < 4; i++) {
+			operations.push({"method": "POST", "path": "/api/users/", "body": {
+				"firstname": "testuser"+Math.floor((Math.random() * 10000) + 1),
+				"lastname": "testuser"+Math.floor((Math.random() * 10000) + 1),
+				"isAdmin": i == 0
+			}});
+		}
+		operations.push({"id": "course", "method": "POST", "path": "/api/trainingcourses/", "body": {
+			"name": "Test course "+Math.floor((Math.random() * 10000) + 1),
+			"coursedatajson": "<p><h5>This is example course introduction title</h5></p><p>Real course or other training would be introduced here.</p>"
+		}});
+		operations.push({"method": "POST", "path": "/api/trainingcourses/${course.id}/medias/", "body": TEST_MEDIAS});
+		sendData(BATCH_URL, "POST", {"operations": operations}, testDataAdded);
 	})
 
 	$('#deleteData').on('click', function(event) 
@@ -236,11 +353,11 @@ $(document).ready(function () {
 	{
 		console.log("Refresh data from server");
 		renderMsg("Refresh data from server...")
-		loadUserList()
+		loadChanges()
 	})
 	$("#userview").hide();
 	$(".usernav").hide();
 
-	loadUserList();
+	loadAll();
 });
 
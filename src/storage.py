@@ -0,0 +1,73 @@
+"""
+Sqlite storage profiles.
+
+Profile is selected with app.config["STORAGE_PROFILE"] and applied to every
+new sqlite connection (pragmas) and to engine creation (connection pool).
+"""
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+STORAGE_PROFILES = {
+    #WAL lets readers continue while one writer commits
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "foreign_keys": "ON",
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+    },
+    #temporary test databases, no extra wal files and no fsync
+    "testing": {
+        "journal_mode": "DELETE",
+        "synchronous": "OFF",
+        "busy_timeout": 5000,
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "foreign_keys": "ON",
+        "pool_size": 1,
+        "max_overflow": 5,
+        "pool_timeout": 30,
+    },
+}
+
+PRAGMAS = ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "foreign_keys")
+
+def apply_storage_profile(profile, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute("PRAGMA {}={}".format(pragma, profile[pragma]))
+    cursor.close()
+
+def is_sqlite_file(sa_url):
+    return sa_url.drivername.startswith("sqlite") and sa_url.database not in (None, "", ":memory:")
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy which creates sqlite file engines using storage profile
+    """
+    def apply_driver_hacks(self, app, sa_url, options):
+        if is_sqlite_file(sa_url):
+            profile = STORAGE_PROFILES[app.config["STORAGE_PROFILE"]]
+            options["poolclass"] = QueuePool
+            options["pool_size"] = profile["pool_size"]
+            options["max_overflow"] = profile["max_overflow"]
+            options["pool_timeout"] = profile["pool_timeout"]
+            #pooled connections are used from many request threads
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+            options["storage_profile"] = profile
+        return super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        profile = engine_opts.pop("storage_profile", None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if profile is not None:
+            event.listen(engine, "connect",
+                lambda dbapi_connection, connection_record: apply_storage_profile(
+                    profile, dbapi_connection, connection_record)
+            )
+        return engine
@@ -0,0 +1,18 @@
+"""
+WSGI entry point for production servers.
+
+App is created once here, with gunicorn preload_app it is created in master
+before workers are forked (see gunicorn.conf.py):
+
+    cd src
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+
+from app import create_app
+
+config = {}
+#open event streams per worker, set by gunicorn.conf.py for thread workers
+if os.environ.get("TRAININGMANAGER_EVENT_STREAMS"):
+    config["EVENTS_MAX_STREAMS"] = int(os.environ["TRAININGMANAGER_EVENT_STREAMS"])
+app = create_app(config)
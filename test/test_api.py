@@ -10,28 +10,29 @@ from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
 
-from app import app, db
-from app import User,TrainingCourse,CourseMedia
-
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+from app import create_app, db
+from app import User,TrainingCourse,CourseMedia,CourseContent,QueryCounter
+from app import api,UserItem,TrainingCourseItem,CONTROL_TEMPLATES
 
 @pytest.fixture
 def client():
     
     db_fd, db_fname = tempfile.mkstemp()
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.config["TESTING"] = True
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "STORAGE_PROFILE": "testing",
+    })
 
-    db.create_all()
-    _populate_db()
+    with app.app_context():
+        db.create_all()
+        _populate_db()
 
     yield app.test_client()
 
-    db.session.remove()
+    with app.app_context():
+        db.session.remove()
+        db.get_engine().dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -108,7 +109,9 @@ def _check_control_put_method(ctrl, client, obj):
     assert encoding == "json"
     body = {}
     body["name"] = obj["name"] 
-    body["coursedatajson"] = obj["coursedatajson"]
+    #course body is in content resource, put keeps it when not given
+    if "coursedatajson" in obj:
+        body["coursedatajson"] = obj["coursedatajson"]
     resp = client.put(href, json=body)
     print("Check put control")
     #print(resp)
@@ -144,7 +147,47 @@ class TestTrainingCourseCollection(object):
         assert len(body["items"]) == 3
         for item in body["items"]:   
             assert "id" in item
-            assert "name" in item    
+            assert "name" in item
+
+    def test_get_dates(self, client):
+        print('TrainingCourseCollection api get test, dates are ISO-8601 strings')
+        with client.application.app_context():
+            course = TrainingCourse.query.filter_by(id=1).first()
+            course.creationdate = datetime(2019, 8, 19, 17, 58, 28)
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["items"][0]["creationdate"] == "2019-08-19T17:58:28"
+        assert body["items"][0]["startdate"] is None
+
+    def test_get_paged(self, client):
+        print('TrainingCourseCollection api get test, paging')
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 2
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["test-course-3"]
+
+    def test_get_fields(self, client):
+        print('TrainingCourseCollection api get test, sparse fieldset without controls')
+        with QueryCounter() as counter:
+            resp = client.get(self.RESOURCE_URL + "?fields=name&controls=false")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body == {"items": [{"name": "test-course-{}".format(i)} for i in range(1, 4)]}
+        assert "creationdate" not in counter.statements[0]
+        resp = client.get(self.RESOURCE_URL + "?fields=name,coursedatajson")
+        assert resp.status_code == 400
+
+        #paging controls are kept and carry fieldset to next page
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=2&fields=name&controls=false").data)
+        assert list(body["@controls"]) == ["next"]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert body["items"] == [{"name": "test-course-3"}]
+        assert list(body["@controls"]) == ["prev"]
 
     def test_post(self, client):
         valid = {"name":"test-course-validname","coursedatajson":"<h5>content</h5>"}
@@ -169,6 +212,92 @@ class TestTrainingCourseCollection(object):
         body = json.loads(resp.data)      
         assert body["name"] == "test-course-validname"
 
+        #course body is optional
+        resp = client.post(self.RESOURCE_URL, json={"name": "test-course-nobody"})
+        assert resp.status_code == 201
+        resp = client.get(resp.headers["Location"] + "content/")
+        assert json.loads(resp.data)["coursedatajson"] is None
+
+class TestCourseContent(object):
+
+    RESOURCE_URL = "/api/trainingcourses/1/content/"
+
+    def test_get(self, client):
+        print('Course content api test, body is served from own resource')
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["coursedatajson"] is None
+        course = json.loads(client.get("/api/trainingcourses/1/").data)
+        assert "coursedatajson" not in course
+        assert course["@controls"]["trainingmanager:coursecontent"]["href"] == self.RESOURCE_URL
+        assert client.get("/api/trainingcourses/0/content/").status_code == 404
+
+    def test_put(self, client):
+        print('Course content api test, identical bodies are stored once, unused bodies are removed')
+        resp = client.put(self.RESOURCE_URL, json={"coursedatajson": "<p>shared</p>"})
+        assert resp.status_code == 204
+        client.put("/api/trainingcourses/2/content/", json={"coursedatajson": "<p>shared</p>"})
+        with client.application.app_context():
+            assert CourseContent.query.count() == 1
+
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["coursedatajson"] == "<p>shared</p>"
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+        body = json.loads(client.get("/api/trainingcourses/1/?fields=name,coursedatajson").data)
+        assert body["coursedatajson"] == "<p>shared</p>"
+
+        #course list never reads content table
+        with QueryCounter() as counter:
+            client.get("/api/trainingcourses/")
+        assert not [statement for statement in counter.statements if "CourseContent" in statement]
+
+        client.put(self.RESOURCE_URL, json={"coursedatajson": "<p>own</p>"})
+        client.delete("/api/trainingcourses/2/")
+        with client.application.app_context():
+            assert [content.body for content in CourseContent.query.all()] == ["<p>own</p>"]
+        resp = client.put(self.RESOURCE_URL, json={"coursedatajson": 1})
+        assert resp.status_code == 415
+
+class TestCourseStats(object):
+
+    RESOURCE_URL = "/api/trainingcourses/1/stats/"
+
+    def test_get(self, client):
+        print('Course stats api test, stats follow enrollment and completion changes')
+        from app import courseuserrelation
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["enrolled"] == 3
+        assert body["completed"] == 0
+        assert body["meanScore"] is None
+
+        with client.application.app_context():
+            for userid, score in ((1, 40), (2, 80), (3, 90)):
+                db.session.execute(courseuserrelation.update().where(
+                    (courseuserrelation.c.courseid == 1) & (courseuserrelation.c.userid == userid)
+                ).values(courseCompletionScore=score, courseCompletionDate=datetime(2019, 9, 1)))
+            db.session.commit()
+        with QueryCounter() as counter:
+            body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert counter.count == 2
+        assert body["completed"] == 3
+        assert body["completionRate"] == 1.0
+        assert body["meanScore"] == 70
+        assert body["medianScore"] == 80
+        assert body["p90Score"] == 90
+
+        client.post("/api/users/", json={"firstname": "new", "lastname": "user", "isAdmin": False})
+        client.post("/api/trainingcourses/1/users/", json={"userid": 10})
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["enrolled"] == 4
+        assert body["completionRate"] == 0.75
+        course = json.loads(client.get("/api/trainingcourses/1/").data)
+        assert course["@controls"]["trainingmanager:coursestats"]["href"] == self.RESOURCE_URL
+        assert client.get("/api/trainingcourses/0/stats/").status_code == 404
+
 class TestTrainingCourse(object):
 
     RESOURCE_URL = "/api/trainingcourses/1/"
@@ -187,6 +316,101 @@ class TestTrainingCourse(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_fields(self, client):
+        print('TrainingCourse api test, sparse fieldset, medias are not loaded unless asked')
+        with QueryCounter() as counter:
+            resp = client.get(self.RESOURCE_URL + "?fields=id,name")
+        assert resp.status_code == 200
+        assert counter.count == 1
+        body = json.loads(resp.data)
+        assert body["name"] == "test-course-1"
+        assert "medialist" not in body and "coursedatajson" not in body
+        assert "@controls" in body
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=medialist&controls=false").data)
+        assert list(body) == ["medialist"]
+        assert len(body["medialist"]) == 3
+
+    def test_get_conditional(self, client):
+        print('TrainingCourse api test, ETag and Last-Modified conditional get')
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        resp = client.get(self.RESOURCE_URL, headers={"If-Modified-Since": last_modified})
+        assert resp.status_code == 304
+
+        #new media changes course representation
+        resp = client.post(self.RESOURCE_URL + "medias/", json={"url": "test-new-url", "type": "image"})
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    def test_get_cached(self, client):
+        print('TrainingCourse api test, response cache and invalidation')
+        client.get(self.RESOURCE_URL)
+        hits = json.loads(client.get("/trainingmanager/cache/").data)["hits"]
+        with QueryCounter() as counter:
+            resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert counter.count == 0
+        stats = json.loads(client.get("/trainingmanager/cache/").data)
+        assert stats["hits"] == hits + 1
+
+        #cached response answers conditional get too
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+
+        client.post(self.RESOURCE_URL + "medias/", json={"url": "test-new-url", "type": "image"})
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert len(body["medialist"]) == 4
+
+        client.get("/api/trainingcourses/")
+        valid = {"name": "test-course-renamed", "coursedatajson": "<h5>content</h5>"}
+        assert client.put(self.RESOURCE_URL, json=valid).status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["name"] == "test-course-renamed"
+        body = json.loads(client.get("/api/trainingcourses/").data)
+        assert body["items"][0]["name"] == "test-course-renamed"
+
+    def test_get_query_count(self, client):
+        print('TrainingCourse api test, course and its medias are loaded with two queries')
+        with QueryCounter() as counter:
+            resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["medialist"]) == 3
+        assert counter.count == 2
+
+        with QueryCounter() as counter:
+            resp = client.get("/api/trainingcourses/")
+        assert counter.count == 1
+
+    def test_get_profiled(self, client):
+        print('TrainingCourse api test, Server-Timing header and slowest request profiles')
+        import shutil
+        import profiling
+        resp = client.get(self.RESOURCE_URL)
+        assert "Server-Timing" not in resp.headers
+
+        profile_dir = tempfile.mkdtemp()
+        client.application.config["PROFILING_ENABLED"] = True
+        client.application.config["RESPONSE_CACHE_ENABLED"] = False
+        client.application.extensions["slowest_profiles"] = profiling.SlowestProfiles(profile_dir, 2)
+        try:
+            resp = client.get(self.RESOURCE_URL)
+            timing = dict(part.split(";")[0:2] for part in resp.headers["Server-Timing"].split(", "))
+            assert set(timing) == {"db", "build", "serialize", "total"}
+            assert 'desc="SQL (2 queries)"' in resp.headers["Server-Timing"]
+            for i in range(4):
+                client.get("/api/trainingcourses/{}/".format(i % 3 + 1))
+            assert len(os.listdir(profile_dir)) == 2
+            assert all(name.endswith(".prof") for name in os.listdir(profile_dir))
+        finally:
+            shutil.rmtree(profile_dir)
+
     def test_put(self, client):
         print('TrainingCourse api test, put course')
         valid = {"name":"test-course-validname","coursedatajson":"<h5>content</h5>"}
@@ -244,6 +468,19 @@ class TestUser(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_conditional(self, client):
+        print('User api test, conditional get')
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        valid = {"firstname": "changed", "lastname": "test-lastname-1", "email": "test-email-1"}
+        resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["firstname"] == "changed"
+
     def test_put(self, client):
         print('User api test, put')
     
@@ -280,6 +517,21 @@ class TestUser(object):
         #print(resp)
         assert resp.status_code == 404
 
+def test_control_templates(client):
+    print('Control templates give same hrefs as url_for')
+    with client.application.test_request_context():
+        for value in [1, "12", "non-course-x", "a b/c"]:
+            assert CONTROL_TEMPLATES["user"].href(value) == api.url_for(UserItem, id=value)
+            assert CONTROL_TEMPLATES["delete-course"].stamp(value) == {
+                "method": "DELETE",
+                "title": "Delete this course",
+                "href": api.url_for(TrainingCourseItem, course=value)
+            }
+    with client.application.test_request_context(base_url="http://localhost/prefix/"):
+        assert CONTROL_TEMPLATES["user"].href(1) == "/prefix/api/users/1/"
+    with client.application.test_request_context():
+        assert CONTROL_TEMPLATES["user"].href(1) == "/api/users/1/"
+
 class TestUserCollection(object):
     
     RESOURCE_URL = "/api/users/"
@@ -293,7 +545,57 @@ class TestUserCollection(object):
         assert len(body["items"]) == 9
         for item in body["items"]:            
             assert "id" in item
-            assert "firstname" in item    
+            assert "firstname" in item
+
+    def test_get_query_count(self, client):
+        print('User collection api test, one query per page and X-Query-Count header')
+        with QueryCounter() as counter:
+            resp = client.get(self.RESOURCE_URL)
+        assert counter.count == 1
+        assert "X-Query-Count" not in resp.headers
+
+        client.application.config["QUERY_COUNT_HEADER"] = True
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Query-Count"] == "1"
+
+    def test_get_paged(self, client):
+        print('User collection api test, keyset paging with next and prev controls')
+        resp = client.get(self.RESOURCE_URL + "?limit=4")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [1, 2, 3, 4]
+        assert "prev" not in body["@controls"]
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [5, 6, 7, 8]
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [9]
+        assert "next" not in body["@controls"]
+
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [5, 6, 7, 8]
+        assert "next" in body["@controls"]
+
+        #before past last id has no next page
+        resp = client.get(self.RESOURCE_URL + "?before=100&limit=4")
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [6, 7, 8, 9]
+        assert "next" not in body["@controls"]
+        resp = client.get("/api/trainingcourses/?before=100&fields=name")
+        assert "next" not in json.loads(resp.data)["@controls"]
+
+        #server limits page size
+        resp = client.get(self.RESOURCE_URL + "?limit=100000")
+        assert resp.status_code == 200
+
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=x")
+        assert resp.status_code == 400
 
     def test_post(self, client):
         valid = {"firstname":"test-valid-firstname"}
@@ -321,6 +623,51 @@ class TestUserCollection(object):
         body = json.loads(resp.data)
         assert body["firstname"] == "test-valid-firstname"
 
+class TestUserImport(object):
+    RESOURCE_URL = "/api/users/import/"
+
+    def test_post_json(self, client):
+        print('User import api test, json array with one invalid row')
+        users = [
+            {"firstname": "import-1", "lastname": "last-1", "email": "import-1@test", "isAdmin": False},
+            {"firstname": "import-2", "lastname": "last-2", "isAdmin": True},
+            {"firstname": "import-3", "isAdmin": False},
+        ]
+        resp = client.post(self.RESOURCE_URL, json=users)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["created"] == 2
+        assert body["failed"] == 1
+        assert [item["status"] for item in body["items"]] == [201, 201, 400]
+        assert "lastname" in body["items"][2]["error"]
+
+        resp = client.get(body["items"][1]["@controls"]["self"]["href"])
+        assert json.loads(resp.data)["firstname"] == "import-2"
+
+        resp = client.post(self.RESOURCE_URL, json={"firstname": "not-a-list"})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="firstname", content_type="text/plain")
+        assert resp.status_code == 415
+
+    def test_post_csv(self, client):
+        print('User import api test, csv in several chunks')
+        lines = ["firstname,lastname,email,isAdmin"]
+        lines += ["csv-{0},last-{0},csv-{0}@test,{1}".format(i, i % 2 == 0) for i in range(25)]
+        client.application.config["IMPORT_CHUNK_SIZE"] = 10
+        with QueryCounter() as counter:
+            resp = client.post(self.RESOURCE_URL, data="\n".join(lines), content_type="text/csv")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["created"] == 25
+        #insert and max id for each of three chunks
+        assert counter.count == 6
+        ids = [item["id"] for item in body["items"]]
+        assert ids == list(range(10, 35))
+        with client.application.app_context():
+            user = User.query.filter_by(id=ids[-1]).first()
+            assert user.firstname == "csv-24"
+            assert user.isAdmin is True
+
 class TestMediaItem(object):
     RESOURCE_URL = "/api/coursemedia/1/"
     INVALID_URL = "/api/coursemedia/0/"
@@ -336,6 +683,13 @@ class TestMediaItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_fields(self, client):
+        print('Media api test, sparse fieldset without controls')
+        resp = client.get(self.RESOURCE_URL + "?fields=url&controls=false")
+        assert json.loads(resp.data) == {"url": "test-url-1-1"}
+        resp = client.get(self.RESOURCE_URL + "?fields=course_id")
+        assert resp.status_code == 400
+
     def test_put(self, client):
         print('Media api test, put')
     
@@ -373,6 +727,10 @@ class TestCourseMediaCollection(object):
         for item in body:
             assert "type" in item
             assert "url" in item 
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=id,type").data)
+        assert all(sorted(item) == ["id", "type"] for item in body)
+        resp = client.get(self.RESOURCE_URL + "?fields=nothing")
+        assert resp.status_code == 400
 
     def test_post(self, client):
         valid = {"url":"test-valid-url"}
@@ -398,4 +756,526 @@ class TestCourseMediaCollection(object):
         body = json.loads(resp.data)
         assert body["url"] == "test-valid-url"
 
+    def test_post_list(self, client):
+        print('Media collection api test, attach list of medias')
+        medias = [{"url": "test-list-url-{}".format(i), "type": "image"} for i in range(5)]
+        with QueryCounter() as counter:
+            resp = client.post(self.RESOURCE_URL, json=medias)
+        assert resp.status_code == 201
+        #no reload of new medias after commit
+        assert not [statement for statement in counter.statements if statement.startswith("SELECT")]
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 5
+        assert resp.headers["Location"].endswith(body["items"][0]["@controls"]["self"]["href"])
+        resp = client.get(body["items"][4]["@controls"]["self"]["href"])
+        assert json.loads(resp.data)["url"] == "test-list-url-4"
+        assert len(json.loads(client.get(self.RESOURCE_URL).data)) == 8
+
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+        #nothing is added if one of medias is invalid
+        resp = client.post(self.RESOURCE_URL, json=[{"url": "ok", "type": "image"}, {"url": "no-type"}])
+        assert resp.status_code == 400
+        assert len(json.loads(client.get(self.RESOURCE_URL).data)) == 8
+
 
+
+def test_truncate(client):
+    print('Truncate test, all data is deleted with foreign keys enforced')
+    client.post("/api/trainingcourses/1/users/", json={"userid": 5})
+    resp = client.get("/trainingmanager/truncate/")
+    assert resp.status_code == 200
+    assert json.loads(client.get("/api/users/").data)["items"] == []
+    assert json.loads(client.get("/api/trainingcourses/").data)["items"] == []
+
+class TestExportCollection(object):
+    RESOURCE_URL = "/api/export/{}/"
+
+    def test_get_ndjson(self, client):
+        print('Export api test, users and enrollments as ndjson')
+        resp = client.get(self.RESOURCE_URL.format("users"))
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        lines = resp.data.decode().splitlines()
+        assert len(lines) == 9
+        assert json.loads(lines[0])["firstname"] == "test-firstname-1"
+
+        resp = client.get(self.RESOURCE_URL.format("enrollments"))
+        rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+        assert len(rows) == 9
+        assert rows[0]["courseid"] == 1
+
+        resp = client.get(self.RESOURCE_URL.format("unknown"))
+        assert resp.status_code == 404
+
+    def test_get_json(self, client):
+        print('Export api test, courses as json array')
+        resp = client.get(self.RESOURCE_URL.format("trainingcourses") + "?format=json")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body] == ["test-course-1", "test-course-2", "test-course-3"]
+
+    def test_collection_accept(self, client):
+        print('Export api test, collection resource with ndjson accept header')
+        resp = client.get("/api/users/", headers={"Accept": "application/x-ndjson"})
+        assert resp.mimetype == "application/x-ndjson"
+        assert len(resp.data.decode().splitlines()) == 9
+        resp = client.get("/api/users/")
+        assert resp.mimetype == "application/vnd.mason+json"
+
+class TestCourseUserCollection(object):
+    RESOURCE_URL = "/api/trainingcourses/1/users/"
+
+    def test_get(self, client):
+        print('Course users api test, enrolled users with paging')
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [1, 2]
+        assert "addedtocourse" in body["items"][0]
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert [item["id"] for item in json.loads(resp.data)["items"]] == [3]
+
+        resp = client.get("/api/trainingcourses/99/users/")
+        assert resp.status_code == 404
+
+    def test_get_fields(self, client):
+        print('Course users api test, sparse fieldset without controls, kept when paging')
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=2&fields=firstname,canModify&controls=false").data)
+        assert [sorted(item) for item in body["items"]] == [["canModify", "firstname"]] * 2
+        assert [item["firstname"] for item in body["items"]] == ["test-firstname-1", "test-firstname-2"]
+        assert list(body["@controls"]) == ["next"]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert [item["firstname"] for item in body["items"]] == ["test-firstname-3"]
+        assert sorted(body["items"][0]) == ["canModify", "firstname"]
+        resp = client.get(self.RESOURCE_URL + "?fields=email")
+        assert resp.status_code == 400
+
+    def test_post(self, client):
+        print('Course users api test, bulk enroll with duplicates and unknown users')
+        #course item advertises enrolling
+        course = json.loads(client.get("/api/trainingcourses/1/").data)
+        href = course["@controls"]["addcourseuser"]["href"]
+        assert href == self.RESOURCE_URL
+
+        enrollments = [{"userid": userid} for userid in range(1, 10)]
+        enrollments.append({"userid": 2, "canModify": True})
+        enrollments.append({"userid": 1000})
+        resp = client.post(href, json=enrollments)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["enrolled"] == 6
+        assert body["updated"] == 1
+        assert body["notfound"] == [1000]
+
+        #same request again does not add duplicates
+        resp = client.post(href, json=enrollments)
+        body = json.loads(resp.data)
+        assert body["enrolled"] == 0
+        items = json.loads(client.get(self.RESOURCE_URL).data)["items"]
+        assert len(items) == 9
+        assert [item["canModify"] for item in items if item["id"] == 2] == [True]
+
+        resp = client.post(href, json=[{"userid": "x"}])
+        assert resp.status_code == 400
+        resp = client.post(href, json={"userid": 10 ** 30})
+        assert resp.status_code == 400
+        resp = client.post(href, data="x")
+        assert resp.status_code == 415
+
+class TestUserCourseCollection(object):
+    RESOURCE_URL = "/api/users/1/courses/"
+
+    def test_get(self, client):
+        print('User courses api test')
+        client.post("/api/trainingcourses/2/users/", json={"userid": 1})
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["test-course-1", "test-course-2"]
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=id,addedtocourse&controls=false").data)
+        assert [sorted(item) for item in body["items"]] == [["addedtocourse", "id"]] * 2
+        assert "@controls" not in body
+        user = json.loads(client.get("/api/users/1/").data)
+        assert user["@controls"]["trainingmanager:usercourses"]["href"] == self.RESOURCE_URL
+        resp = client.get("/api/users/0/courses/")
+        assert resp.status_code == 404
+
+class TestMetrics(object):
+    RESOURCE_URL = "/trainingmanager/metrics"
+
+    def test_get(self, client):
+        print('Metrics test, request counters, latency histogram, sql and cache metrics')
+        client.get("/api/trainingcourses/1/")
+        client.get("/api/trainingcourses/1/")
+        client.get("/api/users/")
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        samples = {}
+        for line in resp.data.decode("utf-8").splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        labels = 'resource="TrainingCourseItem",method="GET"'
+        assert samples['trainingmanager_requests_total{' + labels + ',status="200"}'] == 2
+        assert samples['trainingmanager_request_duration_seconds_count{' + labels + '}'] == 2
+        assert samples['trainingmanager_request_duration_seconds_bucket{' + labels + ',le="+Inf"}'] == 2
+        assert samples['trainingmanager_requests_total{resource="UserCollection",method="GET",status="200"}'] == 1
+        assert samples['trainingmanager_sql_statements_total{statement="SELECT"}'] >= 3
+        assert samples["trainingmanager_cache_hits_total"] == 1
+        assert samples["trainingmanager_db_pool_checked_out"] == 0
+
+class TestCompletionCollection(object):
+    RESOURCE_URL = "/api/completions/"
+
+    def _enrollment(self, client, courseid, userid):
+        from app import courseuserrelation
+        with client.application.app_context():
+            return db.session.execute(courseuserrelation.select().where(
+                (courseuserrelation.c.courseid == courseid) & (courseuserrelation.c.userid == userid)
+            )).first()
+
+    def test_post(self, client):
+        print('Completion events api test, queued events are written in groups')
+        queue = client.application.extensions["completion_queue"]
+        resp = client.post(self.RESOURCE_URL, json={
+            "idempotencyKey": "event-1", "courseid": 1, "userid": 1, "score": 70, "completed": True
+        })
+        assert resp.status_code == 202
+        assert json.loads(resp.data)["accepted"] == 1
+        assert queue.flush(5)
+        row = self._enrollment(client, 1, 1)
+        assert row.courseCompletionScore == 70
+        assert row.courseCompletionDate is not None
+
+        #duplicate key is dropped, unknown user is dropped, new user is enrolled
+        events = [
+            {"idempotencyKey": "event-1", "courseid": 1, "userid": 1, "score": 10},
+            {"idempotencyKey": "event-2", "courseid": 1, "userid": 999, "score": 10},
+        ] + [{"idempotencyKey": "progress-{}".format(i), "courseid": 1, "userid": 4, "score": i}
+            for i in range(100)]
+        batches = queue.batches
+        resp = client.post(self.RESOURCE_URL, json=events)
+        assert resp.status_code == 202
+        assert queue.flush(5)
+        assert queue.batches - batches <= 2
+        assert self._enrollment(client, 1, 1).courseCompletionScore == 70
+        assert self._enrollment(client, 1, 999) is None
+        row = self._enrollment(client, 1, 4)
+        assert row.courseCompletionScore == 99
+        assert row.courseCompletionDate is None
+        body = json.loads(client.get("/api/trainingcourses/1/stats/").data)
+        assert body["enrolled"] == 4
+        assert body["completed"] == 1
+        assert body["scored"] == 2
+
+        resp = client.post(self.RESOURCE_URL, json={"courseid": 1, "userid": 1})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"idempotencyKey": "big", "courseid": 1, "userid": 2 ** 63})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"idempotencyKey": "high", "courseid": 1, "userid": 1, "score": 101})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="x")
+        assert resp.status_code == 415
+
+    def test_post_queue_full(self, client):
+        print('Completion events api test, full queue is answered with 429')
+        import threading
+        import ingest
+        release = threading.Event()
+        queue = ingest.GroupCommitQueue(lambda events: release.wait(5), maxsize=2, batch_size=1)
+        client.application.extensions["completion_queue"] = queue
+        completion = {"idempotencyKey": "event", "courseid": 1, "userid": 1}
+        assert client.post(self.RESOURCE_URL, json=completion).status_code == 202
+        #writer holds first event, queue has room for two more
+        time.sleep(0.1)
+        assert client.post(self.RESOURCE_URL, json=[completion, completion]).status_code == 202
+        resp = client.post(self.RESOURCE_URL, json=completion)
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "1"
+        release.set()
+        assert queue.flush(5)
+        assert client.post(self.RESOURCE_URL, json=[completion, completion]).status_code == 202
+        assert queue.flush(5)
+
+class TestBatch(object):
+    RESOURCE_URL = "/api/batch/"
+
+    def _create_data(self):
+        return [
+            {"id": "user", "method": "POST", "path": "/api/users/",
+                "body": {"firstname": "batch-first", "lastname": "batch-last", "isAdmin": False}},
+            {"id": "course", "method": "POST", "path": "/api/trainingcourses/",
+                "body": {"name": "batch-course", "coursedatajson": "batch content"}},
+            {"method": "POST", "path": "/api/trainingcourses/${course.id}/medias/",
+                "body": [{"url": "batch-url-1", "type": "image"}, {"url": "batch-url-2", "type": "video"}]},
+            {"method": "POST", "path": "/api/trainingcourses/${course.id}/users/",
+                "body": {"userid": "${user.id}", "canModify": True}},
+        ]
+
+    def test_post(self, client):
+        print('Batch api test, created ids are used by later operations')
+        resp = client.post(self.RESOURCE_URL, json={"operations": self._create_data()})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        assert [result["status"] for result in body["results"]] == [201, 201, 201, 200]
+        assert body["results"][1]["id"] == "course"
+        course_url = body["results"][1]["location"]
+        resp = client.get(body["results"][0]["location"])
+        assert json.loads(resp.data)["firstname"] == "batch-first"
+        course = json.loads(client.get(course_url).data)
+        assert [media["url"] for media in course["medialist"]] == ["batch-url-1", "batch-url-2"]
+        stats = json.loads(client.get(course_url + "stats/").data)
+        assert stats["enrolled"] == 1
+
+        resp = client.post(self.RESOURCE_URL, json={"operations": []})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"operations": [{"method": "POST", "path": self.RESOURCE_URL}]})
+        assert resp.status_code == 400
+        client.application.config["BATCH_MAX_OPERATIONS"] = 3
+        resp = client.post(self.RESOURCE_URL, json={"operations": self._create_data()})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="x")
+        assert resp.status_code == 415
+
+    def test_post_atomic_failure(self, client):
+        print('Batch api test, failed operation rolls back whole batch')
+        #import commits in several chunks, each chunk gets its own savepoint
+        client.application.config["IMPORT_CHUNK_SIZE"] = 2
+        client.get("/api/trainingcourses/1/")
+        operations = [
+            {"method": "POST", "path": "/api/users/import/",
+                "body": [{"firstname": "import-{}".format(i), "lastname": "x", "isAdmin": False} for i in range(5)]},
+            {"method": "PUT", "path": "/api/trainingcourses/1/", "body": {"name": "renamed"}},
+            {"method": "POST", "path": "/api/trainingcourses/",
+                "body": {"name": "test-course-2", "coursedatajson": "duplicate name"}},
+            {"method": "DELETE", "path": "/api/users/1/"},
+        ]
+        resp = client.post(self.RESOURCE_URL, json={"operations": operations})
+        assert resp.status_code == 409
+        body = json.loads(resp.data)
+        assert body["committed"] is False
+        assert [result["status"] for result in body["results"]] == [200, 204, 409]
+        with client.application.app_context():
+            assert User.query.count() == 9
+        assert json.loads(client.get("/api/trainingcourses/1/").data)["name"] == "test-course-1"
+
+        resp = client.post(self.RESOURCE_URL, json={"operations": [
+            {"method": "GET", "path": "/api/trainingcourses/${missing.id}/"}
+        ]})
+        assert resp.status_code == 400
+        assert json.loads(resp.data)["committed"] is False
+
+    def test_post_partial(self, client):
+        print('Batch api test, non-atomic batch commits successful operations')
+        client.get("/api/trainingcourses/1/")
+        operations = [
+            {"method": "PUT", "path": "/api/trainingcourses/1/", "body": {"name": "renamed"}},
+            {"method": "POST", "path": "/api/trainingcourses/",
+                "body": {"name": "test-course-2", "coursedatajson": "duplicate name"}},
+            {"method": "GET", "path": "/api/trainingcourses/0/"},
+            #handler raises KeyError for missing lastname
+            {"method": "POST", "path": "/api/users/", "body": {"firstname": "x"}},
+            {"id": "user", "method": "POST", "path": "/api/users/",
+                "body": {"firstname": "batch-first", "lastname": "batch-last", "isAdmin": False}},
+            {"method": "GET", "path": "/api/users/${user.id}/"},
+        ]
+        resp = client.post(self.RESOURCE_URL, json={"atomic": False, "operations": operations})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        assert [result["status"] for result in body["results"]] == [204, 409, 404, 500, 201, 200]
+        assert body["results"][5]["body"]["firstname"] == "batch-first"
+        #cached course response was invalidated when batch committed
+        assert json.loads(client.get("/api/trainingcourses/1/").data)["name"] == "renamed"
+        with client.application.app_context():
+            assert TrainingCourse.query.count() == 3
+
+    def test_post_streamed(self, client):
+        print('Batch api test, streamed resources are not run as operations')
+        operations = [
+            {"method": "GET", "path": "/api/events/"},
+            {"method": "GET", "path": "/api/export/users/"},
+            {"method": "GET", "path": "/api/users/1/"},
+        ]
+        resp = client.post(self.RESOURCE_URL, json={"atomic": False, "operations": operations})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [result["status"] for result in body["results"]] == [400, 400, 200]
+
+        #routing errors keep their own status
+        operations = [
+            {"method": "GET", "path": "/api/nothing/"},
+            {"method": "GET", "path": "/api/users"},
+        ]
+        resp = client.post(self.RESOURCE_URL, json={"atomic": False, "operations": operations})
+        results = json.loads(resp.data)["results"]
+        assert [result["status"] for result in results] == [404, 308]
+        assert results[1]["location"].endswith("/api/users/")
+        resp = client.post(self.RESOURCE_URL, json={"operations": operations[:1]})
+        assert resp.status_code == 404
+        assert client.application.extensions["event_hub"].subscribers == 0
+        assert client.application.extensions["event_hub"].streams == 0
+
+class TestChangeCollection(object):
+    RESOURCE_URL = "/api/changes/"
+
+    def test_get(self, client):
+        print('Change feed api test, changes after token')
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["items"] == []
+        token = body["token"]
+        assert body["@controls"]["next"]["href"] == self.RESOURCE_URL + "?since={}".format(token)
+
+        resp = client.post("/api/users/", json={"firstname": "new", "lastname": "user", "isAdmin": False})
+        user_id = int(resp.headers["Location"].rstrip("/").rsplit("/", 1)[-1])
+        client.put("/api/users/{}/".format(user_id), json={"firstname": "renamed", "lastname": "user", "email": "x"})
+        client.put("/api/trainingcourses/2/", json={"name": "renamed-course"})
+        client.delete("/api/coursemedia/1/")
+        client.post("/api/trainingcourses/1/users/", json={"userid": user_id})
+
+        resp = client.get(self.RESOURCE_URL + "?since={}".format(token))
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["more"] is False
+        changes = dict(((item["entity"], item.get("id"), item.get("user")), item) for item in body["items"])
+        #insert and update of same user on one page is one insert with current data
+        assert changes[("user", user_id, None)]["operation"] == "insert"
+        assert changes[("user", user_id, None)]["item"]["firstname"] == "renamed"
+        assert changes[("course", 2, None)]["item"]["name"] == "renamed-course"
+        assert changes[("media", 1, None)]["operation"] == "delete"
+        assert changes[("media", 1, None)]["course"] == 1
+        assert "item" not in changes[("media", 1, None)]
+        enrollment = changes[("enrollment", None, user_id)]
+        assert enrollment["course"] == 1 and enrollment["operation"] == "insert"
+        assert enrollment["item"]["canModify"] is False
+
+        resp = client.get(self.RESOURCE_URL + "?since={}".format(body["token"]))
+        assert json.loads(resp.data)["items"] == []
+
+        #paging
+        body = json.loads(client.get(self.RESOURCE_URL + "?since={}&limit=2".format(token)).data)
+        assert body["more"] is True
+        assert len(body["items"]) <= 2
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+
+        resp = client.get(self.RESOURCE_URL + "?since=abc")
+        assert resp.status_code == 400
+
+    def test_get_enrollments_chunked(self, client):
+        print('Change feed api test, enrollments are read in chunks')
+        client.application.config["ENROLL_CHUNK_SIZE"] = 2
+        token = json.loads(client.get(self.RESOURCE_URL).data)["token"]
+        client.post("/api/trainingcourses/3/users/", json=[{"userid": userid} for userid in range(1, 6)])
+        with QueryCounter() as counter:
+            body = json.loads(client.get(self.RESOURCE_URL + "?since={}".format(token)).data)
+        assert sorted(item["user"] for item in body["items"]) == [1, 2, 3, 4, 5]
+        assert all("item" in item for item in body["items"])
+        assert len([statement for statement in counter.statements if "courseuserrelation.userid" in statement]) == 5
+
+    def test_get_compacted(self, client):
+        print('Change feed api test, token older than compacted log')
+        token = json.loads(client.get(self.RESOURCE_URL).data)["token"]
+        #compaction runs after write request, every entry is older than retention
+        client.application.config["CHANGELOG_COMPACT_INTERVAL"] = 0
+        client.application.config["CHANGELOG_RETENTION"] = -60
+        client.put("/api/trainingcourses/2/", json={"name": "renamed-course"})
+        resp = client.get(self.RESOURCE_URL + "?since=0")
+        assert resp.status_code == 410
+        resp = client.get(self.RESOURCE_URL + "?since={}".format(token + 100))
+        assert resp.status_code == 410
+        #newest change is always kept
+        body = json.loads(client.get(self.RESOURCE_URL + "?since={}".format(token)).data)
+        assert [item["entity"] for item in body["items"]] == ["course"]
+
+class TestEventStream(object):
+    RESOURCE_URL = "/api/events/"
+
+    def _listen(self, client, headers=None, url=None):
+        """
+        Read stream in thread, chunks are put to queue until stop is set
+        """
+        import queue
+        import threading
+        chunks = queue.Queue()
+        stop = threading.Event()
+        resp = client.get(url or self.RESOURCE_URL, headers=headers or {}, buffered=False)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+
+        def read():
+            for chunk in resp.response:
+                chunks.put(chunk.decode("utf-8"))
+                if stop.is_set():
+                    break
+            resp.close()
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        return chunks, stop, thread
+
+    def _next_event(self, chunks, name):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            chunk = chunks.get(timeout=5)
+            if "event: {}\n".format(name) in chunk:
+                return chunk
+        raise AssertionError("no {} event".format(name))
+
+    def test_get(self, client):
+        print('Change event stream api test, writes are pushed to subscribers')
+        client.application.config["EVENTS_HEARTBEAT"] = 0.05
+        hub = client.application.extensions["event_hub"]
+        token = json.loads(client.get("/api/changes/").data)["token"]
+        chunks, stop, thread = self._listen(client, url=self.RESOURCE_URL + "?since={}".format(token))
+        assert chunks.get(timeout=5).startswith("retry:")
+        #keepalive comes when subscriber waits for events
+        assert chunks.get(timeout=5) == ": keepalive\n\n"
+        assert hub.subscribers == 1
+
+        resp = client.put("/api/trainingcourses/2/", json={"name": "renamed-course"})
+        assert resp.status_code == 204
+        chunk = self._next_event(chunks, "change")
+        lines = chunk.strip().split("\n")
+        assert lines[0] == "id: {}".format(token + 1)
+        change = json.loads(lines[2][len("data: "):])
+        assert change["entity"] == "course"
+        assert change["operation"] == "update"
+        assert change["item"]["name"] == "renamed-course"
+        stop.set()
+        thread.join(5)
+        assert hub.subscribers == 0
+
+    def test_get_reset(self, client):
+        print('Change event stream api test, client behind buffered events must sync again')
+        client.application.config["EVENTS_HEARTBEAT"] = 0.05
+        token = json.loads(client.get("/api/changes/").data)["token"]
+        chunks, stop, thread = self._listen(client, headers={"Last-Event-ID": "0"})
+        chunk = self._next_event(chunks, "reset")
+        assert "id: {}\n".format(token) in chunk
+        assert '"token": {}'.format(token) in chunk
+        stop.set()
+        thread.join(5)
+
+        resp = client.get(self.RESOURCE_URL + "?since=abc")
+        assert resp.status_code == 400
+
+    def test_get_limit(self, client):
+        print('Change event stream api test, streams over limit get 503')
+        client.application.config["EVENTS_MAX_STREAMS"] = 1
+        hub = client.application.extensions["event_hub"]
+        resp = client.get(self.RESOURCE_URL, buffered=False)
+        assert resp.status_code == 200
+        assert hub.streams == 1
+        refused = client.get(self.RESOURCE_URL)
+        assert refused.status_code == 503
+        assert refused.headers["Retry-After"] == "30"
+        #stream is released when response is closed, also when it was not read
+        resp.close()
+        assert hub.streams == 0
+        resp = client.get(self.RESOURCE_URL, buffered=False)
+        assert resp.status_code == 200
+        resp.close()
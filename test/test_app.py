@@ -3,6 +3,7 @@ import pytest
 import tempfile
 import time
 import sys
+import json
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
 from datetime import datetime
 from sqlalchemy.engine import Engine
@@ -12,24 +13,22 @@ from sqlalchemy.exc import IntegrityError, StatementError
 import app
 from app import User,TrainingCourse,CourseMedia
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
-
 @pytest.fixture
 def db_handle():
     db_fd, db_fname = tempfile.mkstemp()
-    app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.app.config["TESTING"] = True
+    flask_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "STORAGE_PROFILE": "testing",
+    })
     
-    with app.app.app_context():
+    with flask_app.app_context():
         app.db.create_all()
         
-    yield app.db
+        yield app.db
     
-    app.db.session.remove()
+        app.db.session.remove()
+        app.db.get_engine().dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -225,3 +224,421 @@ def test_coursemedia_columns(db_handle):
     with pytest.raises(AttributeError):
         assert getmedia3.url == 'nameedited'
 
+
+def test_serializer_fallback(monkeypatch):
+    """
+    Stdlib json fallback gives same output as orjson
+    """
+    print("Serializer test, orjson and stdlib json")
+    import serializer
+    body = {"name": "testi", "date": datetime(2019, 8, 19, 17, 58, 28), "items": [1, None, True]}
+    fast = serializer.dumps(body)
+    monkeypatch.setattr(serializer, "orjson", None)
+    assert serializer.dumps(body) == fast
+    assert json.loads(fast)["date"] == "2019-08-19T17:58:28"
+
+def test_response_cache():
+    """
+    Response cache LRU eviction, ttl and tag invalidation
+    """
+    print("Response cache test")
+    from cache import ResponseCache
+    cache = ResponseCache(maxsize=2, ttl=60)
+    cache.set("/a", 200, [], b"a", {"course:1", "courses"})
+    cache.set("/b", 200, [], b"b", {"course:2"})
+    assert cache.get("/a").data == b"a"
+    cache.set("/c", 200, [], b"c", {"course:3"})
+    #b was least recently used
+    assert cache.get("/b") is None
+    cache.invalidate("courses")
+    assert cache.get("/a") is None
+    assert cache.get("/c").data == b"c"
+    assert cache.stats()["hits"] == 2
+
+    cache = ResponseCache(maxsize=2, ttl=0)
+    cache.set("/a", 200, [], b"a", set())
+    time.sleep(0.01)
+    assert cache.get("/a") is None
+
+def test_response_cache_concurrent_write():
+    """
+    Response built before concurrent invalidation of its tag is not stored
+    """
+    print("Response cache generation test")
+    from cache import ResponseCache
+    cache = ResponseCache(maxsize=2, ttl=60)
+    generation = cache.generation()
+    cache.invalidate("course:1")
+    assert not cache.set("/a", 200, [], b"old", {"course:1"}, generation)
+    assert cache.get("/a") is None
+    assert cache.set("/b", 200, [], b"b", {"course:2"}, generation)
+    generation = cache.generation()
+    assert cache.set("/a", 200, [], b"new", {"course:1"}, generation)
+    #tags evicted from invalidation history are treated as invalidated
+    cache.invalidate("course:3", "course:4", "course:5")
+    assert not cache.set("/b", 200, [], b"b", {"course:2"}, generation)
+
+def test_event_hub():
+    """
+    Event hub fan-out to several subscribers and reset of subscriber behind buffer
+    """
+    print("Event hub test")
+    from eventhub import EventHub
+    log = []
+
+    def read(token):
+        if token is None:
+            return len(log), []
+        events = [(index + 1, data) for index, data in enumerate(log) if index + 1 > token][:2]
+        return (events[-1][0] if events else token), events
+
+    def next_event(subscription):
+        event = next(subscription)
+        while event is None:
+            event = next(subscription)
+        return event
+
+    hub = EventHub(read, capacity=3, poll_interval=0.01)
+    first = hub.subscribe(heartbeat=0.2)
+    second = hub.subscribe(heartbeat=0.2)
+    #heartbeat while nothing happens, reader has started from newest
+    assert next(first) is None
+    assert next(second) is None
+    assert hub.subscribers == 2
+    log.extend(["a", "b"])
+    hub.notify()
+    assert [next_event(first) for i in range(2)] == [(1, "a"), (2, "b")]
+    #reader needs two reads for three events, buffer keeps last three
+    log.extend(["c", "d", "e"])
+    hub.notify()
+    assert [next_event(first) for i in range(3)] == [(3, "c"), (4, "d"), (5, "e")]
+    #second did not read a and b before they were dropped from buffer
+    assert next_event(second) == (5, None)
+    log.append("f")
+    hub.notify()
+    assert next_event(first) == (6, "f")
+    assert next_event(second) == (6, "f")
+    first.close()
+    second.close()
+    assert hub.subscribers == 0
+
+OLD_SCHEMA = [
+    'CREATE TABLE "User" (id INTEGER NOT NULL, firstname VARCHAR(30), lastname VARCHAR(30), '
+    'email VARCHAR(100), "isAdmin" BOOLEAN NOT NULL, creationdate DATETIME, PRIMARY KEY (id))',
+    'CREATE TABLE "TrainingCourse" (id INTEGER NOT NULL, name VARCHAR(50), creationdate DATETIME, '
+    'startdate DATETIME, enddate DATETIME, coursedatajson VARCHAR, PRIMARY KEY (id), UNIQUE (name))',
+    'CREATE TABLE "CourseMedia" (id INTEGER NOT NULL, url VARCHAR(255), type VARCHAR(20), course_id INTEGER, '
+    'PRIMARY KEY (id), FOREIGN KEY(course_id) REFERENCES "TrainingCourse" (id) ON DELETE SET NULL)',
+    'CREATE TABLE courseuserrelation (courseid INTEGER, userid INTEGER, addedtocourse DATETIME, '
+    '"canModify" BOOLEAN, "courseCompletionScore" INTEGER, "courseCompletionDate" DATETIME, '
+    'FOREIGN KEY(courseid) REFERENCES "TrainingCourse" (id), FOREIGN KEY(userid) REFERENCES "User" (id))',
+]
+
+def test_group_commit_retry():
+    """
+    Failed group is retried, then written one event at a time
+    """
+    print("Group commit queue retry test")
+    import ingest
+    written = []
+    attempts = []
+
+    def write(events):
+        attempts.append(list(events))
+        #first attempt fails as if database was locked
+        if len(attempts) == 1 or "bad" in events:
+            raise ValueError("write failed")
+        written.extend(events)
+
+    queue = ingest.GroupCommitQueue(write, batch_size=10, flush_interval=0.05, retries=1, retry_delay=0.01)
+    queue.submit(["a", "b"])
+    assert queue.flush(5)
+    assert written == ["a", "b"] and len(attempts) == 2
+    queue.submit(["c", "bad", "d"])
+    assert queue.flush(5)
+    assert written == ["a", "b", "c", "d"]
+    assert queue.written == 4 and queue.failed == 1
+
+def test_migrate_old_database():
+    """
+    Migration adds columns and indexes to database made with first version of app
+    """
+    print("Migration test, old database file")
+    from sqlalchemy import create_engine, inspect, text
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    try:
+        with engine.begin() as conn:
+            for statement in OLD_SCHEMA:
+                conn.execute(text(statement))
+            conn.execute(text('INSERT INTO "User" (id, firstname, "isAdmin") VALUES (1, \'old\', 0)'))
+            conn.execute(text('INSERT INTO "TrainingCourse" (id, name) VALUES (1, \'old\')'))
+            for i in range(2, 4):
+                conn.execute(text('INSERT INTO "TrainingCourse" (id, name, coursedatajson) '
+                    'VALUES ({}, \'copy{}\', \'<p>same</p>\')'.format(i, i)))
+            for i in range(2):
+                conn.execute(text('INSERT INTO courseuserrelation (courseid, userid) VALUES (1, 1)'))
+
+        steps = app.migrate_schema(engine)
+        assert "created table CourseContent" in steps
+        assert "created table changelog" in steps
+        assert "moved 2 course bodies (1 distinct) to CourseContent" in steps
+        assert "dropped column TrainingCourse.coursedatajson" in steps
+        assert "added column User.updated_at" in steps
+        assert "computed stats of 1 courses" in steps
+        assert "removed 1 duplicate rows from courseuserrelation" in steps
+        assert "created index ix_courseuserrelation_courseid_userid" in steps
+        assert "created index ix_CourseMedia_course_id" in steps
+
+        inspector = inspect(engine)
+        assert "updated_at" in [column["name"] for column in inspector.get_columns("TrainingCourse")]
+        with engine.connect() as conn:
+            hashes = conn.execute(text('SELECT content_hash FROM "TrainingCourse" ORDER BY id')).scalars().all()
+            assert hashes == [None, app.hash_content("<p>same</p>"), app.hash_content("<p>same</p>")]
+            assert conn.execute(text('SELECT body FROM "CourseContent"')).scalars().all() == ["<p>same</p>"]
+            #removed duplicate enrollment was subtracted from stats by trigger
+            assert conn.execute(text('SELECT enrolled FROM coursestats')).scalars().all() == [1]
+        #second run has nothing to do
+        assert app.migrate_schema(engine) == []
+    finally:
+        engine.dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def test_query_plans_use_indexes(db_handle):
+    """
+    EXPLAIN QUERY PLAN of api queries searches tables with index
+    """
+    print("App+Db test, api queries use indexes")
+    import migrate
+    plans = app.api_query_plans()
+    for name, plan in plans.items():
+        print(name, plan)
+        assert migrate.uses_index(plan), name
+    #enrollment pages are read in index order
+    assert not [line for line in plans["course users"] + plans["user courses"] if "TEMP B-TREE" in line]
+
+def test_storage_profiles(db_handle):
+    """
+    Storage profile pragmas are applied to every connection
+    """
+    print("App+Db test, storage profiles")
+    import shutil
+    from sqlalchemy import text
+    assert db_handle.session.execute(text("PRAGMA foreign_keys")).scalar() == 1
+    assert db_handle.session.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+
+    tmpdir = tempfile.mkdtemp()
+    production_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(tmpdir, "production.db"),
+        "STORAGE_PROFILE": "production",
+    })
+    try:
+        with production_app.app_context():
+            engine = db_handle.get_engine()
+            with engine.connect() as conn:
+                assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+                assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+                assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+                assert conn.execute(text("PRAGMA foreign_keys")).scalar() == 1
+            assert engine.pool.size() == 5
+            engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_import_has_no_side_effects():
+    """
+    Importing app and creating app does not open database, and stays in time budget
+    """
+    print("App import test")
+    import subprocess
+    code = (
+        "import sqlite3, time\n"
+        "def no_connect(*args, **kwargs):\n"
+        "    raise RuntimeError('database opened')\n"
+        "sqlite3.connect = no_connect\n"
+        "start = time.perf_counter()\n"
+        "import app\n"
+        "app.create_app()\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    src = os.path.dirname(os.path.realpath(__file__)) + "/../src"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=src)
+    #generous limit for slow test machines, bench/bench_import.py has the real budget
+    assert float(output) < 5.0
+
+def test_forked_workers_share_database():
+    """
+    Workers forked from app which has already used database write to same file
+    """
+    print("App test, forked workers")
+    import multiprocessing
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    worker_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(tmpdir, "workers.db"),
+        "STORAGE_PROFILE": "production",
+        "RESPONSE_CACHE_ENABLED": False,
+    })
+
+    def worker(number):
+        app.dispose_engine_after_fork(worker_app)
+        #no connection of parent is left for worker to reuse
+        if app.db.get_engine().pool.checkedin() or app.db.session.registry.has():
+            os._exit(2)
+        client = worker_app.test_client()
+        for i in range(20):
+            resp = client.post("/api/users/", json={
+                "firstname": "worker{}".format(number),
+                "lastname": "user{}".format(i),
+                "isAdmin": False,
+            })
+            if resp.status_code != 201:
+                os._exit(1)
+        os._exit(0)
+
+    try:
+        with worker_app.app_context():
+            app.db.create_all()
+            #parent has pooled connection and open session when workers are forked
+            assert User.query.count() == 0
+            context = multiprocessing.get_context("fork")
+            workers = [context.Process(target=worker, args=(n,)) for n in range(4)]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join(60)
+                assert process.exitcode == 0
+            app.db.session.rollback()
+            assert User.query.count() == 80
+            app.db.session.remove()
+            app.db.get_engine().dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_seed_command(db_handle):
+    """
+    Seed command inserts requested rows after existing ones, same seed gives same data
+    """
+    print("App+Db test, seed")
+    from flask import current_app
+    db_handle.session.add(get_user())
+    db_handle.session.commit()
+    runner = current_app.test_cli_runner()
+    args = ["seed", "--users", "50", "--courses", "5", "--medias", "20",
+        "--enrollments", "10", "--seed", "7"]
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0
+    assert User.query.count() == 51
+    assert TrainingCourse.query.count() == 5
+    assert CourseMedia.query.count() == 20
+    enrollments = db_handle.session.execute(app.courseuserrelation.select().order_by(
+        app.courseuserrelation.c.courseid, app.courseuserrelation.c.userid)).fetchall()
+    assert len(enrollments) == 50
+    assert all(row.userid > 1 for row in enrollments)
+    course = TrainingCourse.query.first()
+    assert isinstance(course.startdate, datetime)
+    assert len(course.users) == 10
+
+    #same seed on empty tables gives same rows
+    db_handle.session.remove()
+    db_handle.drop_all()
+    db_handle.create_all()
+    db_handle.session.add(get_user())
+    db_handle.session.commit()
+    assert runner.invoke(args=args).exit_code == 0
+    assert db_handle.session.execute(app.courseuserrelation.select().order_by(
+        app.courseuserrelation.c.courseid, app.courseuserrelation.c.userid)).fetchall() == enrollments
+
+def test_seed_failure_keeps_triggers(db_handle):
+    """
+    Failed seed rolls back dropping of triggers with its rows
+    """
+    print("App+Db test, failed seed")
+    from flask import current_app
+    from sqlalchemy import text
+    count_triggers = text("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'")
+    triggers = db_handle.session.execute(count_triggers).scalar()
+    assert triggers == len(app.COURSE_STATS_TRIGGERS) + len(app.CHANGELOG_TRIGGERS)
+    #seeded courses 2-6 are named course-2 ... course-6
+    course = get_course()
+    course.name = "course-5"
+    db_handle.session.add(course)
+    db_handle.session.commit()
+    db_handle.session.remove()
+    result = current_app.test_cli_runner().invoke(args=["seed", "--users", "10", "--courses", "5"])
+    assert isinstance(result.exception, IntegrityError)
+    assert db_handle.session.execute(count_triggers).scalar() == triggers
+    assert User.query.count() == 0
+
+def test_course_stats_triggers(db_handle):
+    """
+    Stats kept by triggers equal stats rebuilt from enrollments
+    """
+    print("App+Db test, course stats triggers and rebuild")
+    from flask import current_app
+    from sqlalchemy import text, select, and_, func
+    runner = current_app.test_cli_runner()
+    assert runner.invoke(args=["seed", "--users", "200", "--courses", "10", "--medias", "0",
+        "--enrollments", "50"]).exit_code == 0
+    relation = app.courseuserrelation
+    db_handle.session.execute(relation.update().where(relation.c.courseid == 1).values(
+        courseCompletionScore=100, courseCompletionDate=datetime(2019, 9, 1)))
+    #move one enrollment of course 2 to course 3
+    in_course3 = select(relation.c.userid).where(relation.c.courseid == 3)
+    moved = db_handle.session.execute(select(relation.c.userid).where(and_(
+        relation.c.courseid == 2, relation.c.userid.notin_(in_course3)))).scalars().first()
+    db_handle.session.execute(relation.update().where(and_(
+        relation.c.courseid == 2, relation.c.userid == moved)).values(courseid=3))
+    db_handle.session.execute(relation.delete().where(relation.c.userid < 50))
+    db_handle.session.commit()
+
+    def read_stats():
+        return (
+            db_handle.session.execute(text("SELECT * FROM coursestats ORDER BY courseid")).fetchall(),
+            db_handle.session.execute(text(
+                "SELECT * FROM coursescorehistogram ORDER BY courseid, score")).fetchall(),
+        )
+    stats, histogram = read_stats()
+    enrolled = dict(db_handle.session.execute(select(relation.c.courseid, func.count()).group_by(
+        relation.c.courseid)).fetchall())
+    assert dict((row.courseid, row.enrolled) for row in stats) == enrolled
+    assert [row for row in histogram if row.courseid == 1] == [(1, 100, stats[0].scored)]
+    assert all(row.count > 0 for row in histogram)
+
+    assert runner.invoke(args=["rebuild-stats"]).exit_code == 0
+    db_handle.session.remove()
+    #rebuild has no rows for courses without enrollments
+    assert read_stats() == ([row for row in stats if row.enrolled], histogram)
+
+def test_enroll_users_concurrent(db_handle):
+    """
+    Enrollment inserted by another connection after existence check does not fail
+    """
+    print("App+Db test, concurrent enrollment of same user")
+    user = get_user()
+    other = get_user()
+    other.email = "otheremail"
+    course = get_course()
+    db_handle.session.add_all([user, other, course])
+    db_handle.session.commit()
+    relation = app.courseuserrelation
+    concurrent = [
+        {"courseid": course.id, "userid": user.id, "addedtocourse": datetime(2019, 8, 1), "canModify": True},
+        {"courseid": course.id, "userid": other.id, "addedtocourse": datetime(2019, 8, 1), "canModify": False},
+    ]
+
+    #after existence check of enroll_users, before its insert
+    def enroll_concurrently(conn, cursor, statement, *args):
+        if concurrent and statement.startswith("SELECT courseuserrelation.userid"):
+            with db_handle.engine.begin() as other_conn:
+                other_conn.execute(relation.insert(), concurrent)
+            del concurrent[:]
+
+    event.listen(db_handle.engine, "after_cursor_execute", enroll_concurrently)
+    try:
+        app.enroll_users(course.id, {user.id: None, other.id: True})
+    finally:
+        event.remove(db_handle.engine, "after_cursor_execute", enroll_concurrently)
+    rows = db_handle.session.execute(relation.select().order_by(relation.c.userid)).fetchall()
+    assert [(row.userid, row.canModify) for row in rows] == [(user.id, True), (other.id, True)]